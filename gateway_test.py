@@ -1,7 +1,6 @@
 from mqtt_client_paho import MQTTClientPaho
 from mqttsn_gateway import MQTTSNGateway
 from mqttsn_transport_udp import MQTTSNTransportUDP
-import time
 import logging
 import sys
 
@@ -24,8 +23,9 @@ mqttc.connect()
 # enter main loop
 while True:
     try:
-        time.sleep(0.05)
-        gateway.loop()
-        mqttc.loop()
+        # wakes up for MQTT-SN and broker traffic alike,
+        # and at least once a sec for the MQTT client's own keepalive
+        gateway.loop(timeout=1)
+        mqttc.loop(timeout=0)
     except KeyboardInterrupt:
         break
@@ -18,3 +18,7 @@ class MQTTClient:
     @abc.abstractmethod
     def unsubscribe(self, topic):
         pass
+
+    # file descriptors to wait on for broker traffic, if any
+    def filenos(self):
+        return []
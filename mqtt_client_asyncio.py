@@ -0,0 +1,650 @@
+from typing import Dict
+
+from mqtt_client import MQTTClient
+from mqttsn_messages import MQTTSNFlags
+import asyncio
+import collections
+import threading
+import logging
+import random
+import select
+import socket
+import struct
+import time
+
+# MQTT control packet types
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK, \
+    UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = range(1, 15)
+
+# protocol levels
+MQTT_V311 = 4
+MQTT_V5 = 5
+
+# in seconds, reconnect delay doubles from min to max while the broker's unreachable
+MQTT_MIN_RECONNECT_DELAY = 1
+MQTT_MAX_RECONNECT_DELAY = 60
+
+# QoS 0 publish msgs held while we're not connected, oldest dropped first
+MQTT_MAX_QUEUED_PUBLISH = 1000
+
+# QoS 1 publish msgs sent but not yet acked, less if the broker's receive maximum says so,
+# and how many more can wait their turn, oldest dropped first
+MQTT_MAX_INFLIGHT = 100
+MQTT_MAX_WAITING_PUBLISH = 65536
+
+# MQTT 5 property IDs by type, just so we can step over the ones we don't use
+MQTT_PROP_RECEIVE_MAX = 0x21
+MQTT_PROP_SIZES = {0x01: 1, 0x17: 1, 0x19: 1, 0x24: 1, 0x25: 1, 0x28: 1, 0x29: 1, 0x2A: 1,
+                   0x13: 2, 0x21: 2, 0x22: 2, 0x23: 2,
+                   0x02: 4, 0x11: 4, 0x18: 4, 0x27: 4}
+
+
+def encode_length(length):
+    out = bytearray()
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        out.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(out)
+
+
+def encode_string(value: bytes):
+    return struct.pack('>H', len(value)) + value
+
+
+def pack_packet(ptype, flags, body):
+    return bytes([(ptype << 4) | flags]) + encode_length(len(body)) + body
+
+
+# splits a byte stream into MQTT packets, as (type, flags, body)
+class MQTTPacketReader:
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        self.buf += data
+
+        packets = []
+        buf = self.buf
+        pos = 0
+        while len(buf) - pos >= 2:
+            # remaining length is 1 - 4 bytes, 7 bits each
+            length = 0
+            shift = 0
+            idx = pos + 1
+            while idx < len(buf):
+                byte = buf[idx]
+                length |= (byte & 0x7F) << shift
+                shift += 7
+                idx += 1
+                if not byte & 0x80:
+                    break
+            else:
+                break
+
+            end = idx + length
+            if end > len(buf):
+                break
+
+            packets.append((buf[pos] >> 4, buf[pos] & 0x0F, bytes(buf[idx:end])))
+            pos = end
+
+        del buf[:pos]
+        return packets
+
+
+def decode_length(body, pos):
+    length = 0
+    shift = 0
+    while True:
+        byte = body[pos]
+        pos += 1
+        length |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return length, pos
+
+
+# skip over an MQTT 5 properties block, returning where it ends
+def skip_properties(body, pos):
+    length, pos = decode_length(body, pos)
+    return pos + length
+
+
+# the fixed size properties in an MQTT 5 properties block as {ID: value},
+# strings and binary data are stepped over
+def parse_properties(body, pos):
+    length, pos = decode_length(body, pos)
+    end = pos + length
+
+    props = {}
+    while pos < end:
+        prop = body[pos]
+        pos += 1
+        size = MQTT_PROP_SIZES.get(prop)
+        if size:
+            props[prop] = int.from_bytes(body[pos:pos + size], 'big')
+            pos += size
+        elif prop == 0x0B:
+            props[prop], pos = decode_length(body, pos)
+        elif prop == 0x26:
+            # user property, a pair of strings
+            for _ in range(2):
+                pos += 2 + struct.unpack_from('>H', body, pos)[0]
+        else:
+            pos += 2 + struct.unpack_from('>H', body, pos)[0]
+    return props
+
+
+class MQTTProtocol(asyncio.Protocol):
+    def __init__(self, client):
+        self.client = client
+        self.reader = MQTTPacketReader()
+
+    def connection_made(self, transport):
+        self.client._connection_made(transport)
+
+    def data_received(self, data):
+        for ptype, flags, body in self.reader.feed(data):
+            self.client._handle_packet(ptype, flags, body)
+
+    def connection_lost(self, exc):
+        self.client._connection_lost(exc)
+
+
+# MQTT 3.1.1 / 5 client on asyncio, running in a thread of its own.
+# publish msgs are pipelined with QoS 1 acks tracked as they come, and everything written
+# in one pass of the event loop goes out in one socket write.
+# whoever owns the client calls loop() to get connection updates and msgs via the registered handlers,
+# and can wait on filenos() for them
+class MQTTClientAsyncio(MQTTClient):
+    def __init__(self, server, port, cid='', username='', password='', keepalive=60, version=MQTT_V311):
+        self.server = server
+        self.port = port
+        self.cid = cid
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+        self.version = version
+
+        # callback registered by mqttsn broker to know of conn/disconns
+        self.broker_conn_cb = None
+        self.broker_msg_cb = None
+
+        # the event loop and its thread, and the current connection
+        self.loop_thread = None
+        self.aloop = None
+        self.run_task = None
+        self.transport = None
+        self.connected = False
+        self.stopping = False
+        self.conn_lost = None
+
+        # requests from the caller's thread, picked up by the event loop in batches
+        self.requests = collections.deque()
+        self.requests_pending = False
+
+        # events for the caller's thread, with a socketpair to wake it up
+        self.events = collections.deque()
+        self.events_pending = False
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+
+        # writes waiting for the end of this pass of the event loop
+        self.out_buf = bytearray()
+        self.flush_pending = False
+
+        # QoS 1 publish msgs awaiting a PUBACK by packet ID, resent on reconnect,
+        # and the IDs of those we've yet to resend on this connection
+        self.inflight: Dict[int, bytes] = collections.OrderedDict()
+        self.unsent = collections.deque()
+        self.curr_packet_id = 0
+
+        # how many can be unacked at once, and QoS 1 publish msgs waiting till there's room
+        self.receive_max = MQTT_MAX_INFLIGHT
+        self.waiting = collections.deque(maxlen=MQTT_MAX_WAITING_PUBLISH)
+
+        # IDs of SUBSCRIBE and UNSUBSCRIBE msgs awaiting their acks
+        self.pending_ids = set()
+
+        # QoS 0 publish msgs held while we're not connected
+        self.queued = collections.deque(maxlen=MQTT_MAX_QUEUED_PUBLISH)
+
+        # keepalive
+        self.last_out = 0
+        self.ping_sent = 0
+        self.ping_timer = None
+
+    # start the event loop thread, it connects and keeps reconnecting till disconnect()
+    def connect(self):
+        if self.loop_thread:
+            return
+
+        self.stopping = False
+        self.aloop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self._thread_main, daemon=True)
+        self.loop_thread.start()
+
+    def disconnect(self):
+        if not self.loop_thread:
+            return
+
+        self.stopping = True
+        self.aloop.call_soon_threadsafe(self._stop)
+        self.loop_thread.join()
+        self.loop_thread = None
+
+    # register handlers for connection updates
+    # and incoming PUBLISH msgs
+    def register_handlers(self, conn_disconn_cb, msg_cb):
+        self.broker_conn_cb = conn_disconn_cb
+        self.broker_msg_cb = msg_cb
+
+    def publish(self, topic, data, qos=0, retain=False):
+        self._request(self._publish, topic, data, qos, retain)
+
+    def subscribe(self, topic, qos=0):
+        self._request(self._subscribe, topic, qos)
+
+    def unsubscribe(self, topic):
+        self._request(self._unsubscribe, topic)
+
+    def filenos(self):
+        return [self.wake_r.fileno()]
+
+    # hand any connection updates and msgs that came in over to the registered handlers
+    def loop(self, timeout=1.0):
+        if not self.events and timeout:
+            select.select([self.wake_r], [], [], timeout)
+
+        self.events_pending = False
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while self.events:
+            event = self.events.popleft()
+            if event[0] == CONNACK:
+                if self.broker_conn_cb:
+                    self.broker_conn_cb(event[1])
+            elif self.broker_msg_cb:
+                self.broker_msg_cb(*event[1:])
+
+    def _post(self, *event):
+        self.events.append(event)
+        if not self.events_pending:
+            self.events_pending = True
+            self.wake_w.send(b'x')
+
+    def _request(self, func, *args):
+        self.requests.append((func, args))
+        if not self.requests_pending and self.aloop:
+            self.requests_pending = True
+            self.aloop.call_soon_threadsafe(self._handle_requests)
+
+    def _handle_requests(self):
+        self.requests_pending = False
+        while self.requests:
+            func, args = self.requests.popleft()
+            func(*args)
+
+    def _thread_main(self):
+        asyncio.set_event_loop(self.aloop)
+        self.aloop.call_soon(self._handle_requests)
+        self.run_task = self.aloop.create_task(self._run())
+        try:
+            self.aloop.run_until_complete(self.run_task)
+        except asyncio.CancelledError:
+            pass
+        self.aloop.close()
+
+    def _stop(self):
+        # a live connection ends the run once it's closed, else there's nothing to wait for
+        if self.transport:
+            self._close(True)
+        else:
+            self.run_task.cancel()
+
+    async def _run(self):
+        delay = MQTT_MIN_RECONNECT_DELAY
+        while not self.stopping:
+            self.conn_lost = self.aloop.create_future()
+            try:
+                await self.aloop.create_connection(lambda: MQTTProtocol(self), self.server, self.port)
+                await self.conn_lost
+            except OSError as e:
+                logging.debug('MQTT connect to {}:{} failed: {}'.format(self.server, self.port, e))
+
+            if self.stopping:
+                break
+
+            # start over quickly if we got connected, else back off, with some jitter
+            if self.conn_lost.done() and self.conn_lost.result():
+                delay = MQTT_MIN_RECONNECT_DELAY
+            await asyncio.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, MQTT_MAX_RECONNECT_DELAY)
+
+    def _write(self, data):
+        self.out_buf += data
+        if not self.flush_pending:
+            self.flush_pending = True
+            self.aloop.call_soon(self._flush)
+
+    def _flush(self):
+        self.flush_pending = False
+        if self.transport and self.out_buf:
+            self.transport.write(bytes(self.out_buf))
+            self.last_out = time.time()
+        self.out_buf.clear()
+
+    def _close(self, graceful=False):
+        if not self.transport:
+            return
+
+        if graceful and self.connected:
+            self._write(pack_packet(DISCONNECT, 0, b''))
+            self._flush()
+        self.transport.close()
+
+    def _connection_made(self, transport):
+        self.transport = transport
+        self.out_buf.clear()
+
+        flags = 0x02
+        payload = encode_string(self.cid.encode())
+        if self.username:
+            flags |= 0x80
+            payload += encode_string(self.username.encode())
+        if self.password:
+            flags |= 0x40
+            payload += encode_string(self.password.encode())
+
+        body = encode_string(b'MQTT') + struct.pack('>BBH', self.version, flags, self.keepalive)
+        if self.version == MQTT_V5:
+            body += encode_length(0)
+        self._write(pack_packet(CONNECT, 0, body + payload))
+
+    def _connection_lost(self, exc):
+        was_connected = self.connected
+        self.transport = None
+        self.connected = False
+        self.pending_ids.clear()
+        if self.ping_timer:
+            self.ping_timer.cancel()
+            self.ping_timer = None
+
+        if was_connected:
+            logging.debug('MQTT disconnected: {}'.format(exc))
+            self._post(CONNACK, False)
+
+        if self.conn_lost and not self.conn_lost.done():
+            self.conn_lost.set_result(was_connected)
+
+    def _handle_packet(self, ptype, flags, body):
+        if ptype == CONNACK:
+            self._handle_connack(body)
+        elif ptype == PUBLISH:
+            self._handle_publish(flags, body)
+        elif ptype == PUBACK:
+            packet_id = struct.unpack_from('>H', body)[0]
+            if packet_id not in self.unsent:
+                self.inflight.pop(packet_id, None)
+                self._fill_window()
+        elif ptype in (SUBACK, UNSUBACK):
+            self.pending_ids.discard(struct.unpack_from('>H', body)[0])
+        elif ptype == PUBREL:
+            # QoS 2 msgs are delivered on PUBLISH, this just finishes the exchange
+            self._write(pack_packet(PUBCOMP, 0, body[:2]))
+        elif ptype == PINGRESP:
+            self.ping_sent = 0
+
+    def _handle_connack(self, body):
+        rc = body[1]
+        if rc != 0:
+            logging.debug('MQTT connection refused: {}'.format(rc))
+            self._post(CONNACK, False)
+            self.transport.close()
+            return
+
+        # the broker may not take as many unacked msgs as we'd like
+        self.receive_max = MQTT_MAX_INFLIGHT
+        if self.version == MQTT_V5 and len(body) > 2:
+            self.receive_max = min(self.receive_max, parse_properties(body, 2).get(MQTT_PROP_RECEIVE_MAX, 0xFFFF))
+
+        self.connected = True
+        self.ping_sent = 0
+        self.ping_timer = self.aloop.call_later(self.keepalive / 2, self._keepalive)
+        self._post(CONNACK, True)
+
+        # resend what never got acked and send what's been waiting, as far as the window goes,
+        # then whatever we held on to
+        self.unsent = collections.deque(self.inflight)
+        self._fill_window()
+        while self.queued:
+            self._write(self.queued.popleft())
+
+    def _handle_publish(self, flags, body):
+        qos = (flags >> 1) & 0x03
+        length = struct.unpack_from('>H', body)[0]
+        topic = body[2:2 + length]
+        pos = 2 + length
+
+        packet_id = body[pos:pos + 2]
+        if qos:
+            pos += 2
+        if self.version == MQTT_V5:
+            pos = skip_properties(body, pos)
+
+        if qos == 1:
+            self._write(pack_packet(PUBACK, 0, packet_id))
+        elif qos == 2:
+            self._write(pack_packet(PUBREC, 0, packet_id))
+
+        msg_flags = MQTTSNFlags()
+        msg_flags.retain = flags & 0x01
+        msg_flags.qos = qos
+        self._post(PUBLISH, topic, body[pos:], msg_flags)
+
+    def _keepalive(self):
+        curr_time = time.time()
+        if self.ping_sent and curr_time - self.ping_sent > self.keepalive:
+            # broker's gone quiet on us
+            self.transport.abort()
+            return
+
+        if not self.ping_sent and curr_time - self.last_out >= self.keepalive / 2:
+            self._write(pack_packet(PINGREQ, 0, b''))
+            self.ping_sent = curr_time
+
+        self.ping_timer = self.aloop.call_later(self.keepalive / 2, self._keepalive)
+
+    def _next_packet_id(self):
+        while True:
+            self.curr_packet_id = self.curr_packet_id % 0xFFFF + 1
+            if self.curr_packet_id not in self.inflight and self.curr_packet_id not in self.pending_ids:
+                return self.curr_packet_id
+
+    def _publish(self, topic, data, qos, retain):
+        # QoS 1 waits its turn in the window, and gets its packet ID once it goes out
+        if qos:
+            self.waiting.append((topic, data, retain))
+            self._fill_window()
+            return
+
+        packet = self._pack_publish(topic, data, 0, retain)
+        if self.connected:
+            self._write(packet)
+        else:
+            self.queued.append(packet)
+
+    def _pack_publish(self, topic, data, qos, retain, packet_id=0):
+        body = encode_string(topic)
+        if qos:
+            body += struct.pack('>H', packet_id)
+        if self.version == MQTT_V5:
+            body += encode_length(0)
+        return pack_packet(PUBLISH, (qos << 1) | (1 if retain else 0), body + data)
+
+    # send QoS 1 msgs while there's room: resends first, then those waiting.
+    # each is kept till it's acked, marked as a resend for next time
+    def _fill_window(self):
+        if not self.connected:
+            return
+
+        while len(self.inflight) - len(self.unsent) < self.receive_max:
+            if self.unsent:
+                packet_id = self.unsent.popleft()
+                packet = self.inflight[packet_id]
+            elif self.waiting:
+                topic, data, retain = self.waiting.popleft()
+                packet_id = self._next_packet_id()
+                packet = self._pack_publish(topic, data, 1, retain, packet_id)
+            else:
+                return
+
+            self._write(packet)
+            self.inflight[packet_id] = self._dup(packet)
+
+    # the same PUBLISH, marked as a resend
+    @staticmethod
+    def _dup(packet):
+        return bytes([packet[0] | 0x08]) + packet[1:]
+
+    # held till the SUBACK or UNSUBACK comes, so a publish can't reuse it meanwhile
+    def _reserve_packet_id(self):
+        packet_id = self._next_packet_id()
+        self.pending_ids.add(packet_id)
+        return packet_id
+
+    def _subscribe(self, topic, qos):
+        # the gateway subscribes again anyway once we reconnect
+        if not self.connected:
+            return
+
+        body = struct.pack('>H', self._reserve_packet_id())
+        if self.version == MQTT_V5:
+            body += encode_length(0)
+        body += encode_string(topic) + bytes([min(qos, 1)])
+        self._write(pack_packet(SUBSCRIBE, 0x02, body))
+
+    def _unsubscribe(self, topic):
+        if not self.connected:
+            return
+
+        body = struct.pack('>H', self._reserve_packet_id())
+        if self.version == MQTT_V5:
+            body += encode_length(0)
+        body += encode_string(topic)
+        self._write(pack_packet(UNSUBSCRIBE, 0x02, body))
+
+
+# just enough of a broker to try the client out against, e.g. in the demo below:
+# exact topic matches, QoS 0 and 1
+class StandInBroker(asyncio.Protocol):
+    subs = collections.defaultdict(set)
+
+    # sent to MQTT 5 clients in the CONNACK if set
+    receive_max = 0
+
+    def __init__(self):
+        self.transport = None
+        self.reader = MQTTPacketReader()
+        self.version = MQTT_V311
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        for subscribers in self.subs.values():
+            subscribers.discard(self)
+
+    def data_received(self, data):
+        out = bytearray()
+        for ptype, flags, body in self.reader.feed(data):
+            if ptype == CONNECT:
+                self.version = body[6]
+                props = b''
+                if self.version == MQTT_V5:
+                    if self.receive_max:
+                        props = struct.pack('>BH', MQTT_PROP_RECEIVE_MAX, self.receive_max)
+                    props = encode_length(len(props)) + props
+                out += pack_packet(CONNACK, 0, b'\x00\x00' + props)
+            elif ptype == SUBSCRIBE:
+                pos = 2 if self.version != MQTT_V5 else skip_properties(body, 2)
+                length = struct.unpack_from('>H', body, pos)[0]
+                self.subs[body[pos + 2:pos + 2 + length]].add(self)
+                out += pack_packet(SUBACK, 0, body[:2] + (b'\x00' if self.version == MQTT_V5 else b'') + b'\x01')
+            elif ptype == UNSUBSCRIBE:
+                pos = 2 if self.version != MQTT_V5 else skip_properties(body, 2)
+                length = struct.unpack_from('>H', body, pos)[0]
+                self.subs[body[pos + 2:pos + 2 + length]].discard(self)
+                out += pack_packet(UNSUBACK, 0, body[:2] + (b'\x00\x00' if self.version == MQTT_V5 else b''))
+            elif ptype == PUBLISH:
+                qos = (flags >> 1) & 0x03
+                length = struct.unpack_from('>H', body)[0]
+                topic = body[2:2 + length]
+                pos = 2 + length + (2 if qos else 0)
+                if self.version == MQTT_V5:
+                    pos = skip_properties(body, pos)
+
+                if qos:
+                    out += pack_packet(PUBACK, 0, body[2 + length:4 + length])
+
+                # pass it on at QoS 0
+                for sub in self.subs.get(topic, ()):
+                    fwd = encode_string(topic) + (b'\x00' if sub.version == MQTT_V5 else b'') + body[pos:]
+                    sub.transport.write(pack_packet(PUBLISH, 0, fwd))
+            elif ptype == PINGREQ:
+                out += pack_packet(PINGRESP, 0, b'')
+
+        if out:
+            self.transport.write(bytes(out))
+
+
+if __name__ == '__main__':
+    import sys
+
+    def run_broker(loop, port):
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(loop.create_server(StandInBroker, '127.0.0.1', port))
+        ready.set()
+        loop.run_forever()
+        server.close()
+
+    version = MQTT_V5 if '5' in sys.argv[1:] else MQTT_V311
+    port = 18830
+    ready = threading.Event()
+    threading.Thread(target=run_broker, args=(asyncio.new_event_loop(), port), daemon=True).start()
+    ready.wait()
+
+    state = {'connected': False, 'recvd': 0}
+
+    def on_conn(connected):
+        state['connected'] = connected
+
+    def on_msg(topic, payload, flags):
+        state['recvd'] += 1
+
+    clnt = MQTTClientAsyncio('127.0.0.1', port, cid='demo', version=version)
+    clnt.register_handlers(on_conn, on_msg)
+    clnt.connect()
+    while not state['connected']:
+        clnt.loop()
+
+    clnt.subscribe(b'demo/led', 1)
+
+    # pipeline a burst of QoS 1 publish msgs, and wait for them to come back round
+    count = 20000
+    start = time.time()
+    for i in range(count):
+        clnt.publish(b'demo/led', struct.pack('>I', i), qos=1)
+    while (state['recvd'] < count or clnt.inflight or clnt.waiting) and time.time() - start < 30:
+        clnt.loop(timeout=0.1)
+
+    elapsed = time.time() - start
+    print('MQTT v{}: {} msgs round trip in {:.3f} secs, {:.0f} msgs/sec, {} unacked'.format(
+        '5' if version == MQTT_V5 else '3.1.1', state['recvd'], elapsed, state['recvd'] / elapsed, len(clnt.inflight)))
+    clnt.disconnect()
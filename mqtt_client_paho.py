@@ -1,21 +1,33 @@
 from mqtt_client import MQTTClient
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 import socket
 import time
 from mqttsn_messages import MQTTSNFlags
 
 
+# with mqttv5, topics get broker topic aliases as long as the broker allows more,
+# so repeat publishes to a topic only carry a 2 byte alias instead of its name
 class MQTTClientPaho(MQTTClient):
-    def __init__(self, server, port, cid='', username='', password=''):
+    def __init__(self, server, port, cid='', username='', password='', mqttv5=False):
         self.server = server
         self.port = port
         self.cid = cid
         self.username = username
         self.password = password
+        self.mqttv5 = mqttv5
 
-        self.client = mqtt.Client(cid)
+        self.client = mqtt.Client(cid, protocol=mqtt.MQTTv5 if mqttv5 else mqtt.MQTTv311)
         self.client.username_pw_set(self.username, self.password)
 
+        # topic aliases by topic name, and how many the broker lets us have, for this connection only
+        self.alias_max = 0
+        self.aliases = {}
+
+        # publish msgs are held back in the socket till loop(), so a burst goes out in full segments
+        self.corked = False
+
         # callback registered by mqttsn broker to know of conn/disconns
         self.broker_conn_cb = None
         self.broker_msg_cb = None
@@ -38,13 +50,53 @@ class MQTTClientPaho(MQTTClient):
 
     def publish(self, topic, data, qos=0, retain=False):
         topic = topic.decode()
-        self.client.publish(topic, data, qos, retain)
+        self._cork()
+
+        # QoS 1 and 2 msgs may be resent on a new connection, where an alias means nothing,
+        # so only QoS 0 gets one, and only while we've got a connection for it to mean something on
+        if qos or not self.client.is_connected():
+            self.client.publish(topic, data, qos, retain)
+            return
+
+        # the name goes along the first time only, after that the alias is enough
+        alias = self.aliases.get(topic)
+        if alias is None:
+            if len(self.aliases) >= self.alias_max:
+                self.client.publish(topic, data, qos, retain)
+                return
+            alias = self.aliases[topic] = len(self.aliases) + 1
+        else:
+            topic = ''
+
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.TopicAlias = alias
+        self.client.publish(topic, data, qos, retain, properties)
+
+    def _cork(self):
+        if self.corked or not hasattr(socket, 'TCP_CORK'):
+            return
+
+        sock = self.client.socket()
+        if sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+            self.corked = True
+
+    # let everything held back go out
+    def flush(self):
+        if not self.corked:
+            return
+
+        self.corked = False
+        sock = self.client.socket()
+        if sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
 
     def subscribe(self, topic, qos=0):
         topic = topic.decode()
         self.client.subscribe(topic, qos)
 
     def unsubscribe(self, topic):
+        topic = topic.decode()
         self.client.unsubscribe(topic)
 
     # called whenever we get a PUBLISH message
@@ -55,17 +107,30 @@ class MQTTClientPaho(MQTTClient):
         self.broker_msg_cb(message.topic.encode(), message.payload, flags)
 
     # called whenever we have a conn/disconn event
-    def connect_cb(self, client, userdata, flags, rc):
+    def connect_cb(self, client, userdata, flags, rc, properties=None):
+        # aliases only last as long as the connection
+        self.aliases.clear()
+        self.alias_max = getattr(properties, 'TopicAliasMaximum', 0) if properties else 0
+        self.corked = False
+
         if rc == 0:
             self.broker_conn_cb(True)
         else:
             self.broker_conn_cb(False)
 
-    def disconnect_cb(self, client, userdata, rc):
+    def disconnect_cb(self, client, userdata, rc, properties=None):
+        # the aliases went with the connection
+        self.aliases.clear()
+        self.alias_max = 0
         self.broker_conn_cb(False)
 
-    def loop(self):
-        rc = self.client.loop()
+    def filenos(self):
+        sock = self.client.socket()
+        return [sock.fileno()] if sock else []
+
+    def loop(self, timeout=1.0):
+        self.flush()
+        rc = self.client.loop(timeout)
         if rc != mqtt.MQTT_ERR_SUCCESS:
             try:
                 if time.time() > self.last_connect + 1:
@@ -0,0 +1,145 @@
+from typing import List, Dict
+
+from mqtt_client import MQTTClient
+import bisect
+import hashlib
+import logging
+import select
+
+# points each connection gets on the hash ring, more spreads topics out more evenly
+MQTT_POOL_VNODES = 64
+
+
+# spreads the gateway's broker traffic over several connections.
+# each topic always goes through the same one, so msgs on a topic stay in order,
+# and adding or removing a connection only moves the topics next to it on the ring
+class MQTTClientPool(MQTTClient):
+    def __init__(self, clients: List[MQTTClient], vnodes=MQTT_POOL_VNODES):
+        self.clients = list(clients)
+
+        # sorted ring of (hash, client index)
+        self.ring = sorted((self._hash('{}-{}'.format(i, v).encode()), i)
+                           for i in range(len(self.clients)) for v in range(vnodes))
+        self.keys = [h for h, _ in self.ring]
+
+        # topics we've already looked up, by the index of their connection
+        self.shards: Dict[bytes, int] = {}
+
+        # topics whose own connection is down, and the one standing in for it
+        self.rerouted: Dict[bytes, MQTTClient] = {}
+
+        # what we're subscribed to, with the QoS and the connection it's on (None if none were up)
+        self.subs: Dict[bytes, list] = {}
+
+        # callbacks registered by the gateway, and which connections are up
+        self.broker_conn_cb = None
+        self.conn_states = [False] * len(self.clients)
+        self.connected = False
+
+    @staticmethod
+    def _hash(key: bytes):
+        return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+    # get the connection a topic belongs to: the first point on the ring at or after its hash
+    def client_for(self, topic: bytes):
+        return self.clients[self._shard(topic)]
+
+    def _shard(self, topic: bytes):
+        idx = self.shards.get(topic)
+        if idx is None:
+            pos = bisect.bisect_left(self.keys, self._hash(topic)) % len(self.ring)
+            idx = self.shards[topic] = self.ring[pos][1]
+        return idx
+
+    # get the connection to use for a topic right now: its own if that's up,
+    # else the next one round the ring that is, so only its topics move while it's down.
+    # None if they're all down
+    def _route(self, topic: bytes):
+        idx = self._shard(topic)
+        if self.conn_states[idx]:
+            return self.clients[idx]
+
+        clnt = self.rerouted.get(topic)
+        if clnt is None and any(self.conn_states):
+            pos = bisect.bisect_left(self.keys, self._hash(topic))
+            for i in range(len(self.ring)):
+                idx = self.ring[(pos + i) % len(self.ring)][1]
+                if self.conn_states[idx]:
+                    clnt = self.rerouted[topic] = self.clients[idx]
+                    break
+        return clnt
+
+    def connect(self):
+        for clnt in self.clients:
+            clnt.connect()
+
+    def disconnect(self):
+        for clnt in self.clients:
+            if hasattr(clnt, 'disconnect'):
+                clnt.disconnect()
+
+    def register_handlers(self, conn_disconn_cb, msg_cb):
+        self.broker_conn_cb = conn_disconn_cb
+        for idx, clnt in enumerate(self.clients):
+            clnt.register_handlers(self._conn_handler(idx), msg_cb)
+
+    # the gateway sees us as connected as long as any connection is up.
+    # when one goes down or comes back, only its topics move, and their subs move with them
+    def _conn_handler(self, idx):
+        def handler(conn_state: bool):
+            self.conn_states[idx] = conn_state
+            self.rerouted.clear()
+            logging.debug('MQTT pool connection {} {}.'.format(idx, 'up' if conn_state else 'down'))
+
+            for topic, sub in self.subs.items():
+                qos, prev = sub
+                clnt = self._route(topic)
+                if clnt is None:
+                    sub[1] = None
+                    continue
+
+                # a connection that's just come back has lost its subs, so always redo those
+                if clnt is not prev or (conn_state and clnt is self.clients[idx]):
+                    clnt.subscribe(topic, qos)
+                    sub[1] = clnt
+                if prev is not None and prev is not clnt and prev is not self.clients[idx]:
+                    prev.unsubscribe(topic)
+
+            connected = any(self.conn_states)
+            if connected != self.connected:
+                self.connected = connected
+                self.broker_conn_cb(connected)
+        return handler
+
+    def publish(self, topic, data, qos=0, retain=False):
+        clnt = self._route(topic)
+        if clnt is None:
+            return None
+        return clnt.publish(topic, data, qos, retain)
+
+    # subs made while every connection's down get made once one comes up
+    def subscribe(self, topic, qos=0):
+        clnt = self._route(topic)
+        self.subs[topic] = [qos, clnt]
+        if clnt is None:
+            return None
+        return clnt.subscribe(topic, qos)
+
+    def unsubscribe(self, topic):
+        sub = self.subs.pop(topic, None)
+        clnt = sub[1] if sub else self._route(topic)
+        if clnt is None:
+            return None
+        return clnt.unsubscribe(topic)
+
+    def filenos(self):
+        return [fd for clnt in self.clients for fd in clnt.filenos()]
+
+    # wait on every connection at once, then give each a turn
+    def loop(self, timeout=1.0):
+        fds = self.filenos()
+        if fds and timeout:
+            select.select(fds, [], [], timeout)
+
+        for clnt in self.clients:
+            clnt.loop(timeout=0)
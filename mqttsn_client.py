@@ -1,11 +1,16 @@
-from typing import List, Callable
+from typing import List, Callable, Dict
 
 from mqttsn_messages import *
 from mqttsn_transport import MQTTSNTransport
+from mqttsn_rtt import MQTTSNRtt
 from enum import IntEnum, unique
 import time
 import random
+import select
+import collections
 import logging
+import json
+import os
 
 
 @unique
@@ -26,6 +31,20 @@ class MQTTSNGWInfo:
         self.gwaddr = gwaddr
         self.available = True
 
+        # measured round trip time, which also sets our retry timeouts, and advertised load
+        self.rtt = MQTTSNRtt()
+        self.load = 0
+
+    def update_rtt(self, sample):
+        self.rtt.update(sample)
+        logging.debug('RTT to gateway {}: {:.3f} secs (+/- {:.3f})'.format(self.gwid, self.rtt.srtt,
+                                                                          self.rtt.rttvar))
+
+    # how long we'd expect to wait for a reply from this gateway
+    def expected_rtt(self):
+        rtt = self.rtt.srtt if self.rtt.srtt else MQTTSN_INITIAL_RTT
+        return rtt * (1 + self.load / 128)
+
 
 class MQTTSNPubTopic:
     def __init__(self, name, tid=0):
@@ -40,42 +59,77 @@ class MQTTSNSubTopic:
         self.flags = flags if flags else MQTTSNFlags()
 
 
-class MQTTSNClient:
-    # list of topics
-    pub_topics: List[MQTTSNPubTopic] = []
-    sub_topics: List[MQTTSNSubTopic] = []
+# a unicast msg awaiting a reply, keyed by its msg ID
+class MQTTSNTransaction:
+    def __init__(self, msg_type, msg_id, raw, topic=None, callback=None, timeout=MQTTSN_T_RETRY):
+        self.msg_type = msg_type
+        self.msg_id = msg_id
+        self.raw = raw
+        self.topic = topic
 
-    # list of discovered gateways
-    gateways: List[MQTTSNGWInfo] = []
+        # called with True once acked, or False if we give up on it
+        self.callback = callback
 
-    # publish callback
-    publish_cb: Callable[[bytes, bytes, MQTTSNFlags], None] = None
+        # for retrying the msg
+        self.timer = time.time()
+        self.timeout = timeout
+        self.counter = 0
 
-    # handle incoming messages
-    msg_handlers: List[Callable[[bytes, bytes], None]] = [None] * len(MQTTSN_MSG_TYPES)
+        # times the gateway's told us it's too busy for it
+        self.deferred = 0
 
-    # handle client states
-    state_handlers: List[Callable[[], None]] = [None] * len(MQTTSNState.__members__)
 
-    def __init__(self, client_id, transport: MQTTSNTransport):
+class MQTTSNClient:
+    def __init__(self, client_id, transport: MQTTSNTransport, max_inflight=MQTTSN_MAX_INFLIGHT,
+                 offline_size=MQTTSN_MAX_OFFLINE_PUBLISH, offline_latest=False,
+                 publish_window=MQTTSN_MAX_INFLIGHT_PUBLISH, cache_path=None):
         self.transport = transport
         self.client_id = client_id[:MQTTSN_MAX_CLIENTID_LEN]
         self.state = MQTTSNState.DISCONNECTED
 
+        # list of topics
+        self.pub_topics: List[MQTTSNPubTopic] = []
+        self.sub_topics: List[MQTTSNSubTopic] = []
+
+        # list of discovered gateways
+        self.gateways: List[MQTTSNGWInfo] = []
+
+        # publish callback
+        self.publish_cb: Callable[[bytes, bytes, MQTTSNFlags], None] = None
+
+        # connect callback, called with True on CONNACK or False on failure
+        self.connect_cb: Callable[[bool], None] = None
+
+        # handle incoming messages
+        self.msg_handlers: List[Callable[[bytes, bytes], None]] = [None] * len(MQTTSN_MSG_TYPES)
+
+        # handle client states
+        self.state_handlers: List[Callable[[], None]] = [None] * len(MQTTSNState.__members__)
+
         # store the current gw
         self.curr_gateway = None
         self.num_gateways = 0
 
+        # the gateway holding our session, if any, and whether it said it still has it.
+        # only then are topic IDs it gave us before any good
+        self.session_gwid = 0
+        self.session_present = False
+
         self.connected = False
         self.connect_flags = MQTTSNFlags()
 
-        # store unicast msg so we can use it when retrying
+        # store CONNECT msg so we can use it when retrying
         self.msg_inflight = None
         self.unicast_timer = time.time()
+        self.unicast_timeout = MQTTSN_T_RETRY
         self.unicast_counter = 0
 
         self.keep_alive_duration = MQTTSN_DEFAULT_KEEPALIVE
 
+        # when we next try to reconnect after losing our gateway, and how many tries so far
+        self.reconnect_timer = 0
+        self.reconnect_attempts = 0
+
         # keep track of time since unicast messages that expect a reply
         self.last_out = 0
         self.last_in = 0
@@ -83,6 +137,7 @@ class MQTTSNClient:
         # tracking pings
         self.pingresp_pending = False
         self.pingreq_timer = 0
+        self.pingreq_timeout = MQTTSN_T_RETRY
         self.pingreq_counter = 0
 
         # for keeping track of discovery
@@ -93,10 +148,43 @@ class MQTTSNClient:
         # for messages that expect a reply
         self.curr_msg_id = 0
 
+        # msgs awaiting a reply, by msg ID
+        self.transactions: Dict[int, MQTTSNTransaction] = {}
+
+        # max REGISTER/SUBSCRIBE/UNSUBSCRIBE and QoS 1 PUBLISH in there at once
+        self.max_inflight = max_inflight
+        self.publish_window = publish_window
+        self.publish_inflight = 0
+
         # for counting number of topics
         self.sub_topics_cnt = 0
         self.pub_topics_cnt = 0
 
+        # indexes into our topic lists, by name and by ID
+        self.pub_by_name: Dict[bytes, MQTTSNPubTopic] = {}
+        self.sub_by_name: Dict[bytes, MQTTSNSubTopic] = {}
+        self.sub_by_tid: Dict[int, MQTTSNSubTopic] = {}
+
+        # per-topic publish callbacks, by topic name
+        self.topic_cbs: Dict[bytes, Callable[[bytes, bytes, MQTTSNFlags], None]] = {}
+
+        # publish msgs held while we're offline or the topic is unregistered, flushed once we can send.
+        # always in order, and with offline_latest, a newer value replaces older QoS 0 ones for its topic.
+        # QoS 1 msgs are never replaced
+        self.offline_size = offline_size
+        self.offline_latest = offline_latest
+        self.offline_pubs = collections.deque()
+
+        # optional file for keeping gateways and their topic IDs across runs,
+        # so we can connect and publish right away instead of searching and registering
+        self.cache_path = cache_path
+        self.cache_dirty = False
+        self.cached_gateways = []
+        self.cached_gwid = 0
+        self.resume_gwid = 0
+        self.cached_tids: Dict[int, Dict[bytes, int]] = {}
+        self._load_cache()
+
         self.num_topics = 0
         self._assign_handlers()
 
@@ -109,6 +197,7 @@ class MQTTSNClient:
         self.msg_handlers[SUBACK] = self._handle_suback
         self.msg_handlers[UNSUBACK] = self._handle_unsuback
         self.msg_handlers[PUBLISH] = self._handle_publish
+        self.msg_handlers[PUBACK] = self._handle_puback
         self.msg_handlers[PINGRESP] = self._handle_pingresp
 
         self.state_handlers[MQTTSNState.ACTIVE] = self._active_handler
@@ -121,7 +210,88 @@ class MQTTSNClient:
         self.gateways = gateways
         self.num_gateways = len(gateways)
 
-    def loop(self):
+        # fill any empty slots with gateways we knew of last time
+        for cached in self.cached_gateways:
+            for info in self.gateways:
+                if info.gwid == cached.gwid:
+                    if not info.rtt.srtt:
+                        info.rtt = cached.rtt
+                    break
+            else:
+                for info in self.gateways:
+                    if info.gwid == 0:
+                        info.gwid = cached.gwid
+                        info.gwaddr = cached.gwaddr
+                        info.rtt = cached.rtt
+                        break
+
+    def _load_cache(self):
+        if not self.cache_path:
+            return
+
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+
+            self.cached_gateways = [MQTTSNGWInfo(gw['gwid'], bytes.fromhex(gw['gwaddr']))
+                                    for gw in cache.get('gateways', [])]
+            for info, gw in zip(self.cached_gateways, cache.get('gateways', [])):
+                info.rtt = MQTTSNRtt(gw.get('srtt', 0.0), gw.get('rttvar', 0.0))
+
+            self.cached_gwid = self.resume_gwid = cache.get('gwid', 0)
+            self.cached_tids = {int(gwid): {bytes.fromhex(name): tid for name, tid in tids.items()}
+                                for gwid, tids in cache.get('topics', {}).items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.debug('Ignoring client cache {}: {}'.format(self.cache_path, e))
+            return
+
+        logging.debug('Loaded {} gateways from client cache.'.format(len(self.cached_gateways)))
+
+    def _save_cache(self):
+        self.cache_dirty = False
+        if not self.cache_path:
+            return
+
+        cache = {
+            'gwid': self.curr_gateway.gwid if self.curr_gateway else self.cached_gwid,
+            'gateways': [{'gwid': info.gwid, 'gwaddr': info.gwaddr.hex(),
+                          'srtt': info.rtt.srtt, 'rttvar': info.rtt.rttvar}
+                         for info in self.gateways if info.gwid],
+            'topics': {str(gwid): {name.hex(): tid for name, tid in tids.items()}
+                       for gwid, tids in self.cached_tids.items() if tids},
+        }
+
+        # write it out whole, so a crash never leaves a half-written cache behind
+        tmp_path = self.cache_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logging.debug('Failed to save client cache {}: {}'.format(self.cache_path, e))
+
+    # topic IDs the current gateway gave us before, by name
+    def _gateway_tids(self):
+        if not self.cache_path or not self.curr_gateway:
+            return {}
+        return self.cached_tids.setdefault(self.curr_gateway.gwid, {})
+
+    def _cache_tid(self, name, tid):
+        tids = self._gateway_tids()
+        if not self.cache_path or tids.get(name) == tid:
+            return
+
+        if tid == MQTTSN_TOPIC_NOTASSIGNED:
+            tids.pop(name, None)
+        else:
+            tids[name] = tid
+        self.cache_dirty = True
+
+    # with a timeout, block till a packet arrives, our next deadline
+    # or the timeout, whichever comes first. None waits as long as it takes
+    def loop(self, timeout=0):
+        self._wait(timeout)
+
         # make sure to handle msgs first
         # so that the updated states get selected
         self._handle_messages()
@@ -133,8 +303,55 @@ class MQTTSNClient:
         if self.state_handlers[self.state] is not None:
             self.state_handlers[self.state]()
 
+        # send off anything we held while we couldn't
+        self._flush_publish()
+
+        if self.cache_dirty:
+            self._save_cache()
+
+        # everything we had to send this time round goes out together
+        self.transport.flush()
+
         return self.state == MQTTSNState.ACTIVE
 
+    # get the time at which loop() next has something to do, or None if it's idle
+    def next_deadline(self):
+        deadlines = []
+
+        # retries for messages awaiting a reply
+        if self.msg_inflight is not None:
+            deadlines.append(self.unicast_timer + self.unicast_timeout)
+        for transaction in self.transactions.values():
+            deadlines.append(transaction.timer + transaction.timeout)
+
+        if self.state == MQTTSNState.ACTIVE:
+            # keepalive pings and their retries
+            if self.pingresp_pending:
+                deadlines.append(self.pingreq_timer + self.pingreq_timeout)
+            else:
+                deadlines.append(min(self.last_out, self.last_in) + self.keep_alive_duration)
+        elif self.state == MQTTSNState.SEARCHING and self.gwinfo_pending:
+            deadlines.append(self.gwinfo_timer + self.searchgw_interval)
+        elif self.state == MQTTSNState.LOST and self.gateways:
+            deadlines.append(self.reconnect_timer)
+
+        return min(deadlines) if deadlines else None
+
+    def _wait(self, timeout):
+        deadline = self.next_deadline()
+        if deadline is not None:
+            until_deadline = max(0.0, deadline - time.time())
+            timeout = until_deadline if timeout is None else min(timeout, until_deadline)
+
+        if timeout is not None and timeout <= 0:
+            return
+
+        fds = self.transport.filenos()
+        if fds:
+            select.select(fds, [], [], timeout)
+        elif timeout is not None:
+            time.sleep(timeout)
+
     def _handle_messages(self):
         while True:
             # try to read something, return if theres nothing
@@ -159,30 +376,177 @@ class MQTTSNClient:
             self.msg_handlers[idx](pkt[rlen:], from_addr)
 
     def _inflight_handler(self):
-        if self.msg_inflight is None:
-            return
+        curr_time = time.time()
 
-        # check if we've timed out after Nretry * Tretry secs
-        if time.time() - self.unicast_timer >= MQTTSN_T_RETRY:
-            self.unicast_timer = time.time()
-            self.unicast_counter += 1
-            logging.debug('Retrying inflight msg => {}'.format(self.curr_gateway.gwid))
+        if self.msg_inflight is not None:
+            # check if we've timed out, the wait doubling with each retry
+            if curr_time - self.unicast_timer >= self.unicast_timeout:
+                self.unicast_timer = curr_time
+                self.unicast_counter += 1
+                self.unicast_timeout = self.curr_gateway.rtt.timeout(self.unicast_counter)
+                logging.debug('Retrying inflight msg => {}'.format(self.curr_gateway.gwid))
 
-            if self.unicast_counter >= MQTTSN_N_RETRY:
-                self.connected = False
-                self.msg_inflight = None
-                self.state = MQTTSNState.LOST
-                logging.debug('Gateway {} lost.'.format(self.curr_gateway.gwid))
+                if self.unicast_counter >= MQTTSN_N_RETRY:
+                    self._gateway_lost()
+                    return False
 
-                # Mark the gateway as unavailable
-                self.curr_gateway.available = False
-                self.curr_gateway = None
+                # resend msg
+                self.transport.write_packet(self.msg_inflight, self.curr_gateway.gwaddr)
 
+        for transaction in list(self.transactions.values()):
+            if curr_time - transaction.timer < transaction.timeout:
+                continue
+
+            transaction.timer = curr_time
+            transaction.counter += 1
+            transaction.timeout = self.curr_gateway.rtt.timeout(transaction.counter)
+            logging.debug('Retrying msg ID {} => {}'.format(transaction.msg_id, self.curr_gateway.gwid))
+
+            if transaction.counter >= MQTTSN_N_RETRY:
+                self._gateway_lost()
                 return False
 
-            # resend msg
-            self.transport.write_packet(self.msg_inflight, self.curr_gateway.gwaddr)
-            return False
+            # resend msg, a PUBLISH gets its DUP flag set (first byte after the header)
+            if transaction.msg_type == PUBLISH:
+                raw = transaction.raw
+                transaction.raw = raw[:MQTTSN_HEADER_LEN] + bytes([raw[MQTTSN_HEADER_LEN] | 0x80]) + \
+                    raw[MQTTSN_HEADER_LEN + 1:]
+            self.transport.write_packet(transaction.raw, self.curr_gateway.gwaddr)
+
+    def _gateway_lost(self):
+        connecting = self.msg_inflight is not None
+
+        self.connected = False
+        self.msg_inflight = None
+        self._clear_transactions()
+        self.state = MQTTSNState.LOST
+        logging.debug('Gateway {} lost.'.format(self.curr_gateway.gwid))
+
+        # Mark the gateway as unavailable, we'll fail over to another
+        self.curr_gateway.available = False
+        self.curr_gateway = None
+        self._schedule_reconnect()
+
+        if connecting and self.connect_cb:
+            self.connect_cb(False)
+
+    def _schedule_reconnect(self):
+        delay = min(MQTTSN_MIN_RECONNECT_DELAY * 2 ** self.reconnect_attempts, MQTTSN_MAX_RECONNECT_DELAY)
+        self.reconnect_attempts += 1
+        self.reconnect_timer = time.time() + random.uniform(0, delay)
+        logging.debug('Reconnecting in {:.2f} secs.'.format(self.reconnect_timer - time.time()))
+
+    # the gateway's too busy to take us on, so try again later, another gateway if there is one.
+    # if it told us how long to wait, do as it says, else back off as if we'd lost it
+    def _connect_congested(self, wait_time):
+        logging.debug('Gateway {} congested, hint {} secs.'.format(self.curr_gateway.gwid, wait_time))
+
+        self.msg_inflight = None
+        self.state = MQTTSNState.LOST
+        self.curr_gateway.available = False
+        self.curr_gateway = None
+
+        if wait_time:
+            self.reconnect_timer = time.time() + self._congestion_wait(wait_time)
+        else:
+            self._schedule_reconnect()
+
+        if self.connect_cb:
+            self.connect_cb(False)
+
+    # hints are rounded up to whole secs, so spread ourselves over the last one
+    @staticmethod
+    def _congestion_wait(wait_time):
+        return random.uniform(max(0, wait_time - 1), wait_time)
+
+    # resend a transaction the gateway was too busy for once it's had time to catch up.
+    # the resend doesn't count as a retry, and its reply still gets timed
+    def _defer_transaction(self, transaction: MQTTSNTransaction, wait_time):
+        transaction.timer = time.time()
+        transaction.timeout = self._congestion_wait(wait_time)
+        transaction.counter = -1
+
+    # without a hint, back off the way a resend would, but give up on it after as many tries,
+    # telling whoever's waiting, rather than counting it against the gateway
+    def _transaction_congested(self, transaction: MQTTSNTransaction, wait_time):
+        transaction.deferred += 1
+        if not wait_time:
+            if transaction.deferred > MQTTSN_N_RETRY:
+                logging.debug('Gateway still congested, giving up on msg {}'.format(transaction.msg_id))
+                self._complete_transaction(transaction.msg_id, False)
+                return
+            wait_time = MQTTSN_T_RETRY * 2 ** (transaction.deferred - 1)
+
+        self._defer_transaction(transaction, wait_time)
+
+    def _clear_transactions(self):
+        transactions = list(self.transactions.values())
+        self.transactions.clear()
+        self.publish_inflight = 0
+
+        # unacked publish msgs get sent again once we can,
+        # everyone else waiting on a reply gets told it won't come
+        unacked = [t for t in transactions if t.msg_type == PUBLISH]
+        self._requeue_publish(unacked)
+
+        for transaction in transactions:
+            if transaction.msg_type != PUBLISH and transaction.callback:
+                transaction.callback(False)
+
+    # called once the reply to a transaction arrives
+    def _complete_transaction(self, msg_id, success=True):
+        transaction = self.transactions.pop(msg_id)
+        if transaction.msg_type == PUBLISH:
+            self.publish_inflight -= 1
+
+        # only time replies to msgs we didn't have to resend
+        if transaction.counter == 0:
+            self.curr_gateway.update_rtt(time.time() - transaction.timer)
+
+        if transaction.callback:
+            transaction.callback(success)
+
+    def _window_full(self, msg_type):
+        if msg_type == PUBLISH:
+            return self.publish_inflight >= self.publish_window
+        return len(self.transactions) - self.publish_inflight >= self.max_inflight
+
+    def _next_msg_id(self):
+        # always a 16-bit value, 0 is reserved,
+        # and skip any IDs still awaiting a reply
+        while True:
+            self.curr_msg_id = (self.curr_msg_id + 1) & 0xFFFF
+            if self.curr_msg_id and self.curr_msg_id not in self.transactions:
+                return self.curr_msg_id
+
+    def _start_transaction(self, msg_type, msg_id, raw, topic=None, callback=None):
+        # store the msg for later retries and send it off
+        self.transactions[msg_id] = MQTTSNTransaction(msg_type, msg_id, raw, topic, callback,
+                                                      self.curr_gateway.rtt.timeout())
+        if msg_type == PUBLISH:
+            self.publish_inflight += 1
+        self.transport.write_packet(raw, self.curr_gateway.gwaddr)
+        self.last_out = time.time()
+
+    def _pending_topics(self, msg_type):
+        return {t.topic.name for t in self.transactions.values() if t.msg_type == msg_type}
+
+    # if a msg for this topic is already inflight, have its ack call back here too
+    def _join_pending(self, msg_type, name, callback):
+        for t in self.transactions.values():
+            if t.msg_type != msg_type or t.topic.name != name:
+                continue
+
+            if callback:
+                first = t.callback
+
+                def both(success):
+                    if first:
+                        first(success)
+                    callback(success)
+                t.callback = both
+            return True
+        return False
 
     def searchgw(self):
         if self.gwinfo_pending:
@@ -209,6 +573,8 @@ class MQTTSNClient:
         # check if a valid GWID was passed, 0 is reserved
         self.curr_gateway = self._select_gateway(gwid)
         if not self.curr_gateway:
+            # none to be had, back off before the next try
+            self._schedule_reconnect()
             return False
 
         # pack and store the msg for later retries
@@ -219,11 +585,13 @@ class MQTTSNClient:
         logging.debug('CONNECT => {}'.format(self.curr_gateway.gwid))
 
         self.connected = False
+        self.session_present = False
         self.state = MQTTSNState.CONNECTING
 
         # start unicast timer
         self.last_out = time.time()
         self.unicast_timer = time.time()
+        self.unicast_timeout = self.curr_gateway.rtt.timeout()
         self.unicast_counter = 0
         return True
 
@@ -237,161 +605,324 @@ class MQTTSNClient:
 
             return None
 
-        # if no gateway was provided, select any available gateway
+        # if no gateway was provided, select the available gateway we expect to answer quickest
         logging.debug('Selecting gateway automatically.')
-        for i in range(self.num_gateways):
-            if self.gateways[i].gwid and self.gateways[i].available:
-                return self.gateways[i]
+        candidates = [info for info in self.gateways if info.gwid and info.available]
 
         # they're all marked unavailable, lets try them all again
-        for i in range(self.num_gateways):
-            self.gateways[i].available = True
+        if not candidates:
+            for info in self.gateways:
+                info.available = True
+            candidates = [info for info in self.gateways if info.gwid]
 
-        # return the first valid gw
-        for i in range(self.num_gateways):
-            if self.gateways[i].gwid:
-                return self.gateways[i]
+        if not candidates:
+            return None
+
+        # go straight back to the gateway we were on last run, if it's still around
+        if self.resume_gwid:
+            gwid, self.resume_gwid = self.resume_gwid, 0
+            for info in candidates:
+                if info.gwid == gwid:
+                    return info
 
-        return None
+        # pick at random from those close to the best,
+        # so clients with the same view of things don't all pile onto one gateway
+        best = min(info.expected_rtt() for info in candidates)
+        return random.choice([info for info in candidates if info.expected_rtt() <= best * 1.25])
 
     def register_topics(self, topics: List[MQTTSNPubTopic]):
-        self.pub_topics = topics
-        self.pub_topics_cnt = len(topics)
+        # only re-index if we've been handed a different list
+        if topics is not self.pub_topics or len(topics) != self.pub_topics_cnt:
+            self.pub_topics = topics
+            self.pub_topics_cnt = len(topics)
+            self.pub_by_name = {t.name: t for t in topics}
 
-        # if we're not connected or theres a pending reply
-        if not self.is_connected() or self.msg_inflight:
+        # if we're not connected
+        if not self.is_connected():
             return False
 
-        # register any unregistered topics
+        # register any unregistered topics, as many as we can have inflight
+        done = True
+        pending = self._pending_topics(REGISTER)
         for t in self.pub_topics:
-            if t.tid == 0:
-                self._register(t)
-                return False
+            if t.tid != 0:
+                continue
 
-        return True
+            # cached IDs get filled in right away
+            if t.name not in pending and not self._window_full(REGISTER):
+                self._register(t)
+            if t.tid == 0:
+                done = False
+
+        return done
+
+    # add a single topic to our list without touching the rest
+    def add_pub_topic(self, topic: MQTTSNPubTopic):
+        if topic.name in self.pub_by_name:
+            return self.pub_by_name[topic.name]
+
+        self.pub_topics = self.pub_topics + [topic]
+        self.pub_topics_cnt = len(self.pub_topics)
+        self.pub_by_name[topic.name] = topic
+        return topic
+
+    def add_sub_topic(self, topic: MQTTSNSubTopic):
+        if topic.name in self.sub_by_name:
+            return self.sub_by_name[topic.name]
+
+        self.sub_topics = self.sub_topics + [topic]
+        self.sub_topics_cnt = len(self.sub_topics)
+        self.sub_by_name[topic.name] = topic
+        if topic.tid not in (MQTTSN_TOPIC_NOTASSIGNED, MQTTSN_TOPIC_UNSUBSCRIBED):
+            self.sub_by_tid[topic.tid] = topic
+        return topic
+
+    def _index_sub_topics(self):
+        self.sub_by_name = {t.name: t for t in self.sub_topics if t.name}
+        self.sub_by_tid = {t.tid: t for t in self.sub_topics
+                           if t.tid not in (MQTTSN_TOPIC_NOTASSIGNED, MQTTSN_TOPIC_UNSUBSCRIBED)}
+
+    def _register(self, topic: MQTTSNPubTopic, callback=None):
+        # a topic ID this gateway gave us before saves us the round trip,
+        # as long as it kept our session. if it's stale we'll hear about it in a PUBACK
+        tid = self._gateway_tids().get(topic.name) if self.session_present else None
+        if tid:
+            logging.debug('Cached ID {} for topic {}'.format(tid, topic.name))
+            topic.tid = tid
+            if callback:
+                callback(True)
+            return
 
-    def _register(self, topic: MQTTSNPubTopic):
         msg = MQTTSNMessageRegister()
         msg.topic_name = topic.name
         msg.topic_id = 0
-        # 0 is reserved for message IDs
-        self.curr_msg_id = 1 if self.curr_msg_id == 0 else self.curr_msg_id
-        msg.msg_id = self.curr_msg_id
+        msg.msg_id = self._next_msg_id()
 
-        self.msg_inflight = msg.pack()
-        self.transport.write_packet(self.msg_inflight, self.curr_gateway.gwaddr)
+        self._start_transaction(REGISTER, msg.msg_id, msg.pack(), topic, callback)
         logging.debug('REGISTER {} => {}'.format(msg.topic_name, self.curr_gateway.gwid))
 
-        self.last_out = time.time()
-        self.unicast_timer = time.time()
-        self.unicast_counter = 0
+    def publish(self, topic, data, flags=None, callback=None):
+        # get the topic
+        t = self.pub_by_name.get(topic)
+        if t is None:
+            return False
 
-        # always a 16-bit value
-        self.curr_msg_id = (self.curr_msg_id + 1) & 0xFFFF
+        flags = flags if flags else MQTTSNFlags()
 
-    def publish(self, topic, data, flags=None):
-        # if we're not connected
-        if not self.is_connected():
-            return False
+        # hold on to it if we're not connected or the topic isn't registered yet
+        if not self.is_connected() or t.tid == MQTTSN_TOPIC_NOTASSIGNED:
+            return self._hold_publish(t, data, flags, callback)
+
+        # anything held from earlier goes first, and if some of it for this topic
+        # still has to wait, this waits behind it
+        self._flush_publish()
+        if any(entry[0] is t for entry in self.offline_pubs):
+            return self._hold_publish(t, data, flags, callback)
+        if self._send_publish(t, data, flags, callback):
+            return True
 
-        # get the topic id
+        # QoS 1 window is full, so it waits its turn
+        return self._hold_publish(t, data, flags, callback)
+
+    def _send_publish(self, t: MQTTSNPubTopic, data, flags, callback=None):
         msg = MQTTSNMessagePublish()
-        for t in self.pub_topics:
-            if t.name == topic:
-                msg.topic_id = t.tid
-                break
-        else:
-            return False
+        msg.topic_id = t.tid
 
-        flags = flags if flags else MQTTSNFlags()
+        # QoS 1 publish awaits a PUBACK, so it needs room in the window
+        if flags.qos == 1 and self._window_full(PUBLISH):
+            return False
 
         # msgid = 0 for qos 0
         if flags.qos in (1, 2):
-            # 0 is reserved
-            self.curr_msg_id = 1 if self.curr_msg_id == 0 else self.curr_msg_id
-            msg.msg_id = self.curr_msg_id
-
-            # increment, always a 16-bit value
-            self.curr_msg_id = (self.curr_msg_id + 1) & 0xFFFF
+            msg.msg_id = self._next_msg_id()
 
         msg.flags = flags
         msg.data = data
         raw = msg.pack()
-        self.transport.write_packet(raw, self.curr_gateway.gwaddr)
-        logging.debug('PUBLISH {} to topic {} => {}'.format(msg.data, topic, self.curr_gateway.gwid))
+        logging.debug('PUBLISH {} to topic {} => {}'.format(msg.data, t.name, self.curr_gateway.gwid))
+
+        if flags.qos == 1:
+            self._start_transaction(PUBLISH, msg.msg_id, raw, t, callback)
+        else:
+            self.transport.write_packet(raw, self.curr_gateway.gwaddr)
+
+        return True
+
+    def _hold_publish(self, t: MQTTSNPubTopic, data, flags, callback=None):
+        if not self.offline_size:
+            return False
+
+        # the newest value replaces older QoS 0 ones for the same topic
+        evicted = []
+        if self.offline_latest:
+            evicted = [entry for entry in self.offline_pubs if entry[0] is t and entry[2].qos == 0]
+            if evicted:
+                self.offline_pubs = collections.deque(entry for entry in self.offline_pubs
+                                                      if entry[0] is not t or entry[2].qos != 0)
+
+        # make room, dropping the oldest msg
+        if len(self.offline_pubs) >= self.offline_size:
+            evicted.append(self.offline_pubs.popleft())
+        self.offline_pubs.append((t, data, flags, callback))
+
+        # let the caller know a msg won't be delivered
+        for entry in evicted:
+            if entry[3]:
+                entry[3](False)
+
+        logging.debug('PUBLISH {} to topic {} held, {} waiting'.format(data, t.name, len(self.offline_pubs)))
+        return True
+
+    # put unacked publish msgs (in the order they were sent) back at the front of the queue
+    def _requeue_publish(self, transactions: List[MQTTSNTransaction]):
+        if not self.offline_size:
+            for transaction in transactions:
+                if transaction.callback:
+                    transaction.callback(False)
+            return
+
+        entries = []
+        for transaction in transactions:
+            msg = MQTTSNMessagePublish()
+            msg.unpack(transaction.raw[MQTTSN_HEADER_LEN:])
+            msg.flags.dup = 0
+            entries.append((transaction.topic, msg.data, msg.flags, transaction.callback))
+
+        for entry in reversed(entries):
+            self.offline_pubs.appendleft(entry)
 
-        # need to note last_out for QoS 1 publish
+        # drop from the back if we've overflowed
+        while len(self.offline_pubs) > self.offline_size:
+            evicted = self.offline_pubs.pop()
+            if evicted[3]:
+                evicted[3](False)
 
+    def _flush_publish(self):
+        if not self.offline_pubs or not self.is_connected():
+            return
+
+        held = list(self.offline_pubs)
+        self.offline_pubs.clear()
+
+        # send whatever we can in one go, keep the rest in order.
+        # once a msg for a topic has to wait, so does everything after it for that topic
+        unregistered = []
+        waiting = set()
+        for entry in held:
+            t, data, flags, callback = entry
+            if t.name not in waiting and t.tid != MQTTSN_TOPIC_NOTASSIGNED \
+                    and self._send_publish(t, data, flags, callback):
+                continue
+
+            if t.tid == MQTTSN_TOPIC_NOTASSIGNED and t.name not in waiting:
+                unregistered.append(t)
+
+            waiting.add(t.name)
+            self.offline_pubs.append(entry)
+
+        # and get the topics we're still waiting on registered
+        pending = self._pending_topics(REGISTER)
+        for t in unregistered:
+            if self._window_full(REGISTER):
+                break
+            if t.name not in pending:
+                pending.add(t.name)
+                self._register(t)
+
+    # register a single topic, calling back once it's done.
+    # False if it can't go out right now, i.e. we're not connected or the window's full
+    def register(self, topic: MQTTSNPubTopic, callback=None):
+        topic = self.add_pub_topic(topic)
+        if topic.tid != 0:
+            if callback:
+                callback(True)
+            return True
+
+        if not self.is_connected():
+            return False
+        if self._join_pending(REGISTER, topic.name, callback):
+            return True
+        if self._window_full(REGISTER):
+            return False
+
+        self._register(topic, callback)
         return True
 
     def subscribe_topics(self, topics: List[MQTTSNSubTopic]):
-        self.sub_topics = topics
-        self.sub_topics_cnt = len(topics)
+        # only re-index if we've been handed a different list
+        if topics is not self.sub_topics or len(topics) != self.sub_topics_cnt:
+            self.sub_topics = topics
+            self.sub_topics_cnt = len(topics)
+            self._index_sub_topics()
 
-        # if we're not connected or theres a pending reply
-        if not self.is_connected() or self.msg_inflight:
+        # if we're not connected
+        if not self.is_connected():
             return False
 
-        # register any unregistered topics
+        # subscribe to any unsubscribed topics, as many as we can have inflight
+        done = True
+        pending = self._pending_topics(SUBSCRIBE)
         for t in self.sub_topics:
-            if t.tid == 0:
-                self._subscribe(t)
-                return False
+            if t.tid != 0:
+                continue
 
-        return True
+            done = False
+            if t.name in pending:
+                continue
+            if self._window_full(SUBSCRIBE):
+                break
+            self._subscribe(t)
+
+        return done
 
-    def _subscribe(self, topic: MQTTSNSubTopic):
+    def _subscribe(self, topic: MQTTSNSubTopic, callback=None):
         msg = MQTTSNMessageSubscribe()
         msg.topic_id_name = topic.name
-
-        # 0 is reserved for message IDs
-        self.curr_msg_id = 1 if self.curr_msg_id == 0 else self.curr_msg_id
-        msg.msg_id = self.curr_msg_id
+        msg.msg_id = self._next_msg_id()
         msg.flags = topic.flags
 
-        self.msg_inflight = msg.pack()
-        self.transport.write_packet(self.msg_inflight, self.curr_gateway.gwaddr)
+        self._start_transaction(SUBSCRIBE, msg.msg_id, msg.pack(), topic, callback)
         logging.debug('SUBSCRIBE to topic {} => {}'.format(topic.name, self.curr_gateway.gwid))
 
-        self.last_out = time.time()
-        self.unicast_timer = time.time()
-        self.unicast_counter = 0
-
-        # always a 16-bit value
-        self.curr_msg_id = (self.curr_msg_id + 1) & 0xFFFF
+    # subscribe to a single topic, same as register()
+    def subscribe(self, topic: MQTTSNSubTopic, callback=None):
+        topic = self.add_sub_topic(topic)
+        if topic.tid != 0:
+            if callback:
+                callback(True)
+            return True
 
-    def unsubscribe(self, topic: str, flags=None):
-        # if we're not connected or there's a pending transaction
-        if not self.is_connected() or self.msg_inflight:
+        if not self.is_connected():
+            return False
+        if self._join_pending(SUBSCRIBE, topic.name, callback):
+            return True
+        if self._window_full(SUBSCRIBE):
             return False
 
-        msg = MQTTSNMessageUnsubscribe()
+        self._subscribe(topic, callback)
+        return True
 
-        # check our list of subs for this topic
-        for t in self.sub_topics:
-            if t.name == topic:
-                msg.topic_id_name = topic
-                break
-        else:
+    def unsubscribe(self, topic: str, flags=None, callback=None):
+        # if we're not connected or there's no room for another transaction
+        if not self.is_connected() or self._window_full(UNSUBSCRIBE):
             return False
 
-        # 0 is reserved
-        self.curr_msg_id = 1 if self.curr_msg_id == 0 else self.curr_msg_id
-        msg.msg_id = self.curr_msg_id
-        msg.flags = flags
+        # check our list of subs for this topic
+        t = self.sub_by_name.get(topic)
+        if t is None:
+            return False
 
-        self.msg_inflight = msg.pack()
-        self.transport.write_packet(self.msg_inflight, self.curr_gateway.gwaddr)
-        logging.debug('UNSUBSCRIBE to topic {} => {}'.format(topic, self.curr_gateway.gwid))
+        msg = MQTTSNMessageUnsubscribe()
+        msg.topic_id_name = topic
 
-        self.last_out = time.time()
-        self.unicast_timer = time.time()
-        self.unicast_counter = 0
+        msg.msg_id = self._next_msg_id()
+        msg.flags = flags if flags else MQTTSNFlags()
 
-        # always a 16-bit value
-        self.curr_msg_id = (self.curr_msg_id + 1) & 0xFFFF
+        self._start_transaction(UNSUBSCRIBE, msg.msg_id, msg.pack(), t, callback)
+        logging.debug('UNSUBSCRIBE to topic {} => {}'.format(topic, self.curr_gateway.gwid))
 
         # TODO: Consider removing the topic here since unsuback doesnt really matter
+        return True
 
     def ping(self):
         if not self.connected:
@@ -404,13 +935,14 @@ class MQTTSNClient:
 
         self.last_out = time.time()
         self.pingreq_timer = time.time()
+        self.pingreq_timeout = self.curr_gateway.rtt.timeout(self.pingreq_counter)
 
     def transaction_pending(self):
-        if self.msg_inflight is None:
+        if self.msg_inflight is None and not self.transactions:
             return False
 
         self.loop()
-        return self.msg_inflight is not None
+        return self.msg_inflight is not None or bool(self.transactions)
 
     def is_connected(self):
         return self.connected
@@ -425,27 +957,45 @@ class MQTTSNClient:
         logging.debug('DISCONNECT => {}'.format(self.curr_gateway.gwid))
 
         self.connected = False
+        self._clear_transactions()
         self.state = MQTTSNState.DISCONNECTED
 
     def on_message(self, callback):
         self.publish_cb = callback
 
+    # handle publish msgs for this topic with their own callback instead,
+    # or go back to the on_message() callback if None
+    def on_topic_message(self, topic: bytes, callback):
+        if callback is None:
+            self.topic_cbs.pop(topic, None)
+        else:
+            self.topic_cbs[topic] = callback
+
+    def on_connect(self, callback):
+        self.connect_cb = callback
+
     def _handle_advertise(self, pkt, from_addr):
         msg = MQTTSNMessageAdvertise()
         if not msg.unpack(pkt):
             return
 
-        logging.debug('ADVERTISE by ID {}, ADDR {}'.format(msg.gwid, from_addr))
+        logging.debug('ADVERTISE by ID {}, ADDR {}, load {}'.format(msg.gwid, from_addr, msg.load))
 
         # check if its in our gateway list, add it if its not
         for info in self.gateways:
             if info.gwid == msg.gwid:
+                info.load = msg.load
                 return
 
         for i in range(self.num_gateways):
             if self.gateways[i].gwid == 0:
                 self.gateways[i].gwid = msg.gwid
                 self.gateways[i].gwaddr = from_addr
+                self.gateways[i].load = msg.load
+
+                # no need to search anymore
+                self.gwinfo_pending = False
+                self.cache_dirty = bool(self.cache_path)
                 break
 
     def _handle_searchgw(self, pkt, from_addr):
@@ -480,14 +1030,17 @@ class MQTTSNClient:
             if info.gwid == msg.gwid:
                 break
         else:
-            for i in range(self.num_gateways):
-                if self.gateways[i].gwid == 0:
-                    self.gateways[i].gwid = msg.gwid
+            for info in self.gateways:
+                if info.gwid == 0:
+                    info.gwid = msg.gwid
 
                     # check if a gw or client sent the GWINFO
-                    self.gateways[i].gwaddr = msg.gwadd if msg.gwadd else from_addr
+                    info.gwaddr = msg.gwadd if msg.gwadd else from_addr
+                    self.cache_dirty = bool(self.cache_path)
                     break
 
+        # GWINFO isn't timed: gateways hold it back to answer several searches at once,
+        # so it says more about that than the trip. CONNACK and PINGRESP time them instead.
         # cancel any pending wait
         self.gwinfo_pending = False
         # self.state = MQTTSNState.DISCONNECTED
@@ -513,24 +1066,54 @@ class MQTTSNClient:
         msg = MQTTSNMessageConnack()
         if not msg.unpack(pkt):
             return
+        if msg.return_code == MQTTSN_RC_CONGESTION:
+            self._connect_congested(msg.wait_time)
+            return
         if msg.return_code != MQTTSN_RC_ACCEPTED:
             self.msg_inflight = None
             self.state = MQTTSNState.DISCONNECTED
+            if self.connect_cb:
+                self.connect_cb(False)
             return
 
         logging.debug('CONNACK <= {}'.format(from_addr))
 
+        # only time replies to msgs we didn't have to resend
+        if self.unicast_counter == 0:
+            self.curr_gateway.update_rtt(time.time() - self.unicast_timer)
+
         # we are now active
         self.state = MQTTSNState.ACTIVE
         self.connected = True
         self.msg_inflight = None
         self.last_in = time.time()
+        self.reconnect_attempts = 0
+
+        # anything still awaiting a reply belonged to the old connection
+        self._clear_transactions()
+
+        # if the gateway kept our session, our topic IDs are still good,
+        # else re-register and re-sub topics
+        self.session_present = msg.session_present and not self.connect_flags.clean_session
+        resumed = self.session_present and self.session_gwid == self.curr_gateway.gwid
+        self.session_gwid = self.curr_gateway.gwid
 
-        # re-register and re-sub topics
-        for topic in self.sub_topics:
-            topic.tid = 0
-        for topic in self.pub_topics:
-            topic.tid = 0
+        if resumed:
+            logging.debug('Session resumed on {}'.format(self.curr_gateway.gwid))
+        else:
+            for topic in self.sub_topics:
+                topic.tid = 0
+            for topic in self.pub_topics:
+                topic.tid = 0
+            self.sub_by_tid.clear()
+
+        # remember where we connected
+        if self.cache_path:
+            self.cached_gwid = self.curr_gateway.gwid
+            self.cache_dirty = True
+
+        if self.connect_cb:
+            self.connect_cb(True)
 
     def _handle_regack(self, pkt, from_addr):
         # if this is to be used as proof of connectivity,
@@ -538,38 +1121,73 @@ class MQTTSNClient:
         if not self.curr_gateway or from_addr != self.curr_gateway.gwaddr:
             return
 
-        if self.msg_inflight is None:
+        # unpack the response
+        msg = MQTTSNMessageRegack()
+        if not msg.unpack(pkt):
             return
 
-        # unpack the original message
-        header = MQTTSNHeader()
-        hlen = header.unpack(self.msg_inflight)
-        if header.msg_type != REGISTER:
+        # match it to the original message
+        sent = self.transactions.get(msg.msg_id)
+        if sent is None or sent.msg_type != REGISTER:
+            return
+        if msg.return_code == MQTTSN_RC_CONGESTION:
+            self._transaction_congested(sent, msg.wait_time)
+            self.last_in = time.time()
             return
 
-        sent = MQTTSNMessageRegister()
-        sent.unpack(self.msg_inflight[hlen:])
+        # a rejection won't get any better by retrying, the topic stays unassigned
+        if msg.return_code != MQTTSN_RC_ACCEPTED:
+            logging.debug('REGISTER for topic {} rejected: {}'.format(sent.topic.name, msg.return_code))
+            self._complete_transaction(msg.msg_id, False)
+            self.last_in = time.time()
+            return
 
-        # now unpack the response
-        msg = MQTTSNMessageRegack()
-        if not msg.unpack(pkt):
+        logging.debug('REGACK for topic {} ID {} <= {}'.format(sent.topic.name, msg.topic_id, from_addr))
+
+        sent.topic.tid = msg.topic_id
+        self._cache_tid(sent.topic.name, msg.topic_id)
+        self._complete_transaction(msg.msg_id)
+        self.last_in = time.time()
+
+    def _handle_puback(self, pkt, from_addr):
+        if not self.curr_gateway or from_addr != self.curr_gateway.gwaddr:
             return
-        if msg.msg_id != sent.msg_id or msg.return_code != MQTTSN_RC_ACCEPTED:
+
+        msg = MQTTSNMessagePuback()
+        if not msg.unpack(pkt):
             return
 
-        logging.debug('REGACK for topic {} ID {} <= {}'.format(sent.topic_name, msg.topic_id, from_addr))
+        # a QoS 0 publish with a topic ID the gateway doesn't know,
+        # nothing to resend but the topic needs registering again
+        if msg.msg_id == 0x0000 and msg.return_code == MQTTSN_RC_INVALIDTID:
+            for t in self.pub_topics:
+                if t.tid == msg.topic_id:
+                    logging.debug('Topic {} ID {} rejected by gateway'.format(t.name, t.tid))
+                    self._cache_tid(t.name, MQTTSN_TOPIC_NOTASSIGNED)
+                    t.tid = MQTTSN_TOPIC_NOTASSIGNED
+            return
 
-        for i in range(self.pub_topics_cnt):
-            if self.pub_topics[i].name == sent.topic_name:
-                self.pub_topics[i].tid = msg.topic_id
-                break
-        else:
-            # topic not found
+        # match it to the original QoS 1 publish
+        sent = self.transactions.get(msg.msg_id)
+        if sent is None or sent.msg_type != PUBLISH:
             return
 
-        self.msg_inflight = None
+        logging.debug('PUBACK for topic {} ID {} <= {}'.format(sent.topic.name, msg.topic_id, from_addr))
+
         self.last_in = time.time()
 
+        # the gateway doesn't know our topic ID, so register it again and resend
+        if msg.return_code == MQTTSN_RC_INVALIDTID:
+            self.transactions.pop(msg.msg_id)
+            self.publish_inflight -= 1
+            self._cache_tid(sent.topic.name, MQTTSN_TOPIC_NOTASSIGNED)
+            sent.topic.tid = MQTTSN_TOPIC_NOTASSIGNED
+            self._requeue_publish([sent])
+            return
+
+        # any other rejection won't get any better by retrying
+        self._complete_transaction(msg.msg_id, msg.return_code == MQTTSN_RC_ACCEPTED)
+
     def _handle_publish(self, pkt, from_addr):
         # wont check the gw address
         # have faith that only our connected gw will send us msgs
@@ -582,18 +1200,16 @@ class MQTTSNClient:
             return
 
         # get the topic name
-        for t in self.sub_topics:
-            if t.tid == msg.topic_id:
-                topic = t.name
-                break
-        else:
+        t = self.sub_by_tid.get(msg.topic_id)
+        if t is None:
             return
 
-        logging.debug('PUBLISH for topic {} ID {} <= {}'.format(topic, msg.topic_id, from_addr))
+        logging.debug('PUBLISH for topic {} ID {} <= {}'.format(t.name, msg.topic_id, from_addr))
 
-        # call user handler
-        if self.publish_cb:
-            self.publish_cb(topic, msg.data, msg.flags)
+        # call the topic's own handler, else the user handler
+        callback = self.topic_cbs.get(t.name, self.publish_cb)
+        if callback:
+            callback(t.name, msg.data, msg.flags)
 
     # TODO: Consider removing suback and unsuback, no gain in parsing them
     def _handle_suback(self, pkt, from_addr):
@@ -602,37 +1218,34 @@ class MQTTSNClient:
         if not self.curr_gateway or from_addr != self.curr_gateway.gwaddr:
             return False
 
-        if self.msg_inflight is None:
-            return False
-
-        # unpack the original message
-        header = MQTTSNHeader()
-        hlen = header.unpack(self.msg_inflight)
-        if header.msg_type != SUBSCRIBE:
-            return
-
-        sent = MQTTSNMessageSubscribe()
-        sent.unpack(self.msg_inflight[hlen:])
-
-        # now unpack the response
+        # unpack the response
         msg = MQTTSNMessageSuback()
         if not msg.unpack(pkt):
             return
-        if msg.msg_id != sent.msg_id or msg.return_code != MQTTSN_RC_ACCEPTED:
-            return
 
-        logging.debug('SUBACK for topic {} ID {} <= {}'.format(sent.topic_id_name, msg.topic_id, from_addr))
+        # match it to the original message
+        sent = self.transactions.get(msg.msg_id)
+        if sent is None or sent.msg_type != SUBSCRIBE:
+            return
+        if msg.return_code == MQTTSN_RC_CONGESTION:
+            self._transaction_congested(sent, msg.wait_time)
+            self.last_in = time.time()
+            return
 
-        # update the topic id
-        for i in range(self.sub_topics_cnt):
-            if self.sub_topics[i].name == sent.topic_id_name:
-                self.sub_topics[i].tid = msg.topic_id
-                break
-        else:
-            # topic not found
+        # a rejection won't get any better by retrying, the topic stays unassigned
+        if msg.return_code != MQTTSN_RC_ACCEPTED:
+            logging.debug('SUBSCRIBE for topic {} rejected: {}'.format(sent.topic.name, msg.return_code))
+            self._complete_transaction(msg.msg_id, False)
+            self.last_in = time.time()
             return
 
-        self.msg_inflight = None
+        logging.debug('SUBACK for topic {} ID {} <= {}'.format(sent.topic.name, msg.topic_id, from_addr))
+
+        # update the topic id
+        self.sub_by_tid.pop(sent.topic.tid, None)
+        sent.topic.tid = msg.topic_id
+        self.sub_by_tid[msg.topic_id] = sent.topic
+        self._complete_transaction(msg.msg_id)
         self.last_in = time.time()
 
     def _handle_unsuback(self, pkt, from_addr):
@@ -641,37 +1254,25 @@ class MQTTSNClient:
         if not self.curr_gateway or from_addr != self.curr_gateway.gwaddr:
             return
 
-        if self.msg_inflight is None:
-            return
-
-        # unpack the original message
-        header = MQTTSNHeader()
-        hlen = header.unpack(self.msg_inflight)
-        if header.msg_type != UNSUBSCRIBE:
-            return
-
-        sent = MQTTSNMessageUnsubscribe()
-        sent.unpack(self.msg_inflight[hlen:])
-
-        # now unpack the response
+        # unpack the response
         msg = MQTTSNMessageUnsuback()
         if not msg.unpack(pkt):
             return
-        if msg.msg_id != sent.msg_id:
+
+        # match it to the original message
+        sent = self.transactions.get(msg.msg_id)
+        if sent is None or sent.msg_type != UNSUBSCRIBE:
             return
 
-        logging.debug('UNSUBACK for topic {} <= {}'.format(sent.topic_id_name, from_addr))
+        logging.debug('UNSUBACK for topic {} <= {}'.format(sent.topic.name, from_addr))
 
         # remove from list
-        for i in range(self.sub_topics_cnt):
-            if self.sub_topics[i].name == sent.topic_id_name:
-                self.sub_topics[i].name = ''
-                self.sub_topics[i].tid = MQTTSN_TOPIC_UNSUBSCRIBED
-                break
-        else:
-            return
+        self.sub_by_name.pop(sent.topic.name, None)
+        self.sub_by_tid.pop(sent.topic.tid, None)
+        sent.topic.name = ''
+        sent.topic.tid = MQTTSN_TOPIC_UNSUBSCRIBED
 
-        self.msg_inflight = None
+        self._complete_transaction(msg.msg_id)
         self.last_in = time.time()
 
     def _handle_pingresp(self, pkt, from_addr):
@@ -692,6 +1293,10 @@ class MQTTSNClient:
         self.last_in = time.time()
         self.pingresp_pending = False
 
+        # only time replies to pings we didn't have to resend
+        if self.pingreq_counter == 0:
+            self.curr_gateway.update_rtt(self.last_in - self.pingreq_timer)
+
     def _searching_handler(self):
         # if we're still waiting for a GWINFO and the wait interval is over
         if self.gwinfo_pending and time.time() > self.gwinfo_timer + self.searchgw_interval:
@@ -711,7 +1316,10 @@ class MQTTSNClient:
             return
 
     def _lost_handler(self):
-        # try to re-connect to any available gateway
+        if time.time() < self.reconnect_timer:
+            return
+
+        # try to re-connect to any available gateway, connect() backs off if there isn't one
         self.connect(gwid=0, flags=self.connect_flags, duration=self.keep_alive_duration)
 
     def _disconnected_handler(self):
@@ -726,20 +1334,17 @@ class MQTTSNClient:
         curr_time = time.time()
         if curr_time >= self.last_out + duration or curr_time >= self.last_in + duration:
             if not self.pingresp_pending:
+                self.pingreq_counter = 0
                 self.ping()
                 self.pingresp_pending = True
-            elif curr_time - self.pingreq_timer >= MQTTSN_T_RETRY:
+            elif curr_time - self.pingreq_timer >= self.pingreq_timeout:
                 # just keep trying till we hit the keepalive limit
                 if curr_time >= self.last_in + self.keep_alive_duration * 1.5:
                     # we are now lost and the gateway is unavailable
-                    self.state = MQTTSNState.LOST
-                    self.curr_gateway.available = False
-                    logging.debug('Gateway {} lost.'.format(self.curr_gateway.gwid))
-
-                    self.curr_gateway = None
-                    self.connected = False
                     self.pingresp_pending = False
+                    self._gateway_lost()
                 else:
                     # if we still have time, keep pinging
                     logging.debug('Retrying PING.')
+                    self.pingreq_counter += 1
                     self.ping()
@@ -0,0 +1,204 @@
+from typing import Optional
+
+from mqttsn_client import *
+import asyncio
+
+
+# asyncio front-end for MQTTSNClient
+# transactions are awaitables that resolve once their ACK arrives (or we give up on them),
+# the transport is watched with loop readers and the client's timers with loop timers
+class MQTTSNClientAsync:
+    def __init__(self, client_id, transport: MQTTSNTransport, max_inflight=MQTTSN_MAX_INFLIGHT,
+                 publish_window=MQTTSN_MAX_INFLIGHT_PUBLISH):
+        self.transport = transport
+        self.client = MQTTSNClient(client_id, transport, max_inflight, publish_window=publish_window)
+        self.client.on_message(self._on_message)
+        self.client.on_connect(self._on_connect)
+
+        # set up once we're running in a loop
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.reader_fds = set()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.flush_pending = False
+        self.window: Optional[asyncio.Semaphore] = None
+        self.slot_freed: Optional[asyncio.Event] = None
+        self.max_inflight = max_inflight
+
+        self.connect_future: Optional[asyncio.Future] = None
+
+        # incoming publish msgs, for messages()
+        self.queue: Optional[asyncio.Queue] = None
+
+    def _start(self):
+        if self.loop is not None:
+            return
+
+        self.loop = asyncio.get_running_loop()
+        self.window = asyncio.Semaphore(self.max_inflight)
+        self.slot_freed = asyncio.Event()
+        self.queue = asyncio.Queue()
+        self._sync_readers()
+
+    # watch whatever fds the transport has right now, e.g. a stream gives its up once the other end closes,
+    # else its fd would keep waking us up to read nothing
+    def _sync_readers(self):
+        fds = set(self.transport.filenos())
+        for fd in self.reader_fds - fds:
+            self.loop.remove_reader(fd)
+            logging.debug('Transport fd {} closed, no longer waiting on it.'.format(fd))
+        for fd in fds - self.reader_fds:
+            self.loop.add_reader(fd, self._run)
+        self.reader_fds = fds
+
+    def stop(self):
+        if self.loop is None:
+            return
+
+        for fd in self.reader_fds:
+            self.loop.remove_reader(fd)
+        self.reader_fds = set()
+
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        self.loop = None
+
+    def add_gateways(self, gateways: List[MQTTSNGWInfo]):
+        self.client.add_gateways(gateways)
+
+    def is_connected(self):
+        return self.client.is_connected()
+
+    # run the client and arm a timer for whenever it next needs to run
+    def _run(self):
+        if self.loop is None:
+            return
+
+        self.client.loop()
+        self._sync_readers()
+        self._schedule()
+
+        # let anything waiting on the window try again
+        self.slot_freed.set()
+        self.slot_freed = asyncio.Event()
+
+    # flush the transport once everything queued up for this pass of the event loop is written
+    def _flush_soon(self):
+        if self.flush_pending:
+            return
+
+        self.flush_pending = True
+        self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        self.flush_pending = False
+        self.transport.flush()
+
+    def _schedule(self):
+        self._flush_soon()
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        deadline = self.client.next_deadline()
+        if deadline is None:
+            return
+
+        self.timer = self.loop.call_later(max(0.0, deadline - time.time()), self._run)
+
+    def _transaction_done(self, future: asyncio.Future):
+        def callback(success):
+            if not future.done():
+                future.set_result(success)
+        return callback
+
+    async def _transact(self, start):
+        # hold a slot in the window till the transaction is done
+        async with self.window:
+            future = self.loop.create_future()
+
+            # the client's own window can still be full with msgs we didn't send,
+            # so wait our turn as long as we're connected
+            while not start(self._transaction_done(future)):
+                if not self.client.is_connected():
+                    return False
+                await self.slot_freed.wait()
+
+            self._schedule()
+            return await future
+
+    async def connect(self, gwid=0, flags=None, duration=MQTTSN_DEFAULT_KEEPALIVE):
+        self._start()
+
+        # only one CONNECT at a time
+        if self.connect_future and not self.connect_future.done():
+            return await asyncio.shield(self.connect_future)
+
+        self.connect_future = self.loop.create_future()
+
+        # after a failed try, a lost gateway or a congested one, wait out the client's
+        # backoff (or the gateway's hint) before sending another CONNECT
+        delay = self.client.reconnect_timer - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        # the client may have started reconnecting by itself while we waited
+        if self.connect_future.done() or self.client.state == MQTTSNState.CONNECTING:
+            return await self.connect_future
+
+        if not self.client.connect(gwid, flags, duration):
+            self.connect_future.set_result(False)
+
+        self._schedule()
+        return await self.connect_future
+
+    def _on_connect(self, success):
+        if self.connect_future and not self.connect_future.done():
+            self.connect_future.set_result(success)
+
+    async def register(self, topic: MQTTSNPubTopic):
+        self._start()
+        return await self._transact(lambda callback: self.client.register(topic, callback))
+
+    async def subscribe(self, topic: MQTTSNSubTopic):
+        self._start()
+        return await self._transact(lambda callback: self.client.subscribe(topic, callback))
+
+    async def unsubscribe(self, topic: bytes, flags=None):
+        self._start()
+
+        # nothing to wait for if we never subscribed
+        if topic not in self.client.sub_by_name:
+            return False
+        return await self._transact(lambda callback: self.client.unsubscribe(topic, flags, callback))
+
+    # QoS 0 resolves as soon as it's sent (or held), QoS 1 once the PUBACK arrives.
+    # the client's own publish window paces QoS 1, so many can be awaited at once
+    async def publish(self, topic: bytes, data: bytes, flags=None):
+        self._start()
+
+        if not flags or flags.qos != 1:
+            sent = self.client.publish(topic, data, flags)
+            self._flush_soon()
+            return sent
+
+        future = self.loop.create_future()
+        if not self.client.publish(topic, data, flags, self._transaction_done(future)):
+            return False
+
+        self._schedule()
+        return await future
+
+    def _on_message(self, topic, data, flags):
+        self.queue.put_nowait((topic, data, flags))
+
+    # async iterator over incoming publish msgs, as (topic, data, flags)
+    async def messages(self):
+        self._start()
+        while True:
+            yield await self.queue.get()
+
+    def disconnect(self):
+        self.client.disconnect()
+        self.stop()
@@ -0,0 +1,164 @@
+from typing import Dict
+
+from mqttsn_client import *
+import itertools
+import heapq
+
+
+# a pooled client's view of the pool's shared transport,
+# it only sees packets meant for it and everything it sends goes out under its own node ID
+class MQTTSNPoolTransport(MQTTSNTransport):
+    def __init__(self, pool, node_id: bytes):
+        self.pool = pool
+        self.node_id = node_id
+        self.inbox = collections.deque()
+
+    def read_packet(self):
+        if self.inbox:
+            return self.inbox.popleft()
+        return b'', None
+
+    def write_packet(self, data, dest):
+        return self.pool._write_packet(self.node_id, data, dest)
+
+    def broadcast(self, data):
+        return self.pool._write_packet(self.node_id, data, None)
+
+
+# runs lots of clients over one transport, acting as a forwarder for them:
+# their msgs go out encapsulated with their node IDs, and replies get sorted back by node ID.
+# one scheduler runs each client only when it has packets waiting or a deadline comes up
+class MQTTSNClientPool:
+    def __init__(self, transport: MQTTSNTransport):
+        self.transport = transport
+
+        # clients by node ID
+        self.clients: Dict[bytes, MQTTSNClient] = {}
+
+        # heap of (deadline, seq, node ID), with the latest deadline for each client.
+        # entries that don't match it anymore are stale, and get skipped
+        self.heap = []
+        self.deadlines: Dict[bytes, float] = {}
+        self.seq = itertools.count()
+
+        # clients to run next time round, and ones that sent something and need rescheduling
+        self.ready = set()
+        self.dirty = set()
+
+    def add_client(self, client_id, node_id: bytes, **kwargs):
+        clnt = MQTTSNClient(client_id, MQTTSNPoolTransport(self, node_id), **kwargs)
+        self.clients[node_id] = clnt
+        self.ready.add(node_id)
+        return clnt
+
+    def remove_client(self, node_id: bytes):
+        self.clients.pop(node_id, None)
+        self.deadlines.pop(node_id, None)
+        self.ready.discard(node_id)
+        self.dirty.discard(node_id)
+
+    # make sure a client gets run, after changing its state from outside the pool loop
+    def wake(self, clnt: MQTTSNClient):
+        self.ready.add(clnt.transport.node_id)
+
+    def loop(self, timeout=0):
+        # anything sent from outside the loop may have moved those clients' deadlines
+        for node_id in self.dirty:
+            self._schedule(node_id)
+        self.dirty.clear()
+
+        self._wait(timeout)
+        self._handle_messages()
+
+        # pick up every client whose deadline is up
+        curr_time = time.time()
+        while self.heap and self.heap[0][0] <= curr_time:
+            deadline, _, node_id = heapq.heappop(self.heap)
+            if self.deadlines.get(node_id) == deadline:
+                del self.deadlines[node_id]
+                self.ready.add(node_id)
+
+        ready, self.ready = self.ready, set()
+        for node_id in ready:
+            clnt = self.clients.get(node_id)
+            if clnt is None:
+                continue
+
+            clnt.loop()
+            self._schedule(node_id)
+            self.dirty.discard(node_id)
+
+        # everything the clients sent goes out together
+        self.transport.flush()
+
+    def _schedule(self, node_id):
+        clnt = self.clients.get(node_id)
+        deadline = clnt.next_deadline() if clnt else None
+        if deadline is None:
+            self.deadlines.pop(node_id, None)
+            return
+
+        if self.deadlines.get(node_id) != deadline:
+            self.deadlines[node_id] = deadline
+            heapq.heappush(self.heap, (deadline, next(self.seq), node_id))
+
+    # get the time at which loop() next has something to do, or None if it's idle
+    def next_deadline(self):
+        if self.ready or self.dirty:
+            return time.time()
+
+        # drop stale entries off the top
+        while self.heap and self.deadlines.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+        return self.heap[0][0] if self.heap else None
+
+    def _wait(self, timeout):
+        deadline = self.next_deadline()
+        if deadline is not None:
+            until_deadline = max(0.0, deadline - time.time())
+            timeout = until_deadline if timeout is None else min(timeout, until_deadline)
+
+        if timeout is not None and timeout <= 0:
+            return
+
+        fds = self.transport.filenos()
+        if fds:
+            select.select(fds, [], [], timeout)
+        elif timeout is not None:
+            time.sleep(timeout)
+
+    def _handle_messages(self):
+        while True:
+            # try to read something, return if theres nothing
+            pkt, from_addr = self.transport.read_packet()
+            if not pkt:
+                return
+
+            # parse the header so we can get the msg type
+            header = MQTTSNHeader()
+            if not header.unpack(pkt):
+                continue
+
+            # replies to our clients come encapsulated with their node IDs
+            if header.msg_type == ENCAPSULATED:
+                msg = MQTTSNMessageEncapsulated()
+                if not msg.unpack(pkt) or msg.node_id not in self.clients:
+                    continue
+
+                self.clients[msg.node_id].transport.inbox.append((msg.msg, from_addr))
+                self.ready.add(msg.node_id)
+                continue
+
+            # anything else is a broadcast, e.g. an ADVERTISE, which everyone gets
+            for node_id, clnt in self.clients.items():
+                clnt.transport.inbox.append((pkt, from_addr))
+                self.ready.add(node_id)
+
+    def _write_packet(self, node_id, data, dest):
+        self.dirty.add(node_id)
+
+        msg = MQTTSNMessageEncapsulated(node_id, data)
+        if dest is None:
+            return self.transport.broadcast(msg.pack())
+        return self.transport.write_packet(msg.pack(), dest)
@@ -9,6 +9,9 @@ MQTTSN_MAX_MSG_LEN = 32
 MQTTSN_HEADER_LEN = 2
 MQTTSN_MAX_CLIENTID_LEN = 23
 
+# longest topic name that still fits in a REGISTER
+MQTTSN_MAX_TOPICNAME_LEN = MQTTSN_MAX_MSG_LEN - MQTTSN_HEADER_LEN - 4
+
 # Unassigned topic IDs set to 0 for convenience,
 # Unsubscribed topics set to max value
 MQTTSN_TOPIC_NOTASSIGNED = 0x0000
@@ -21,10 +24,35 @@ MQTTSN_DEFAULT_KEEPALIVE = 30
 MQTTSN_T_RETRY = 5
 MQTTSN_N_RETRY = 3
 
+# bounds on the adaptive retry timeout, and how much it gets randomly spread (as a fraction).
+# T_RETRY is the timeout to start with, till we've timed a reply from the gateway.
+# the floor's 1 sec as in RFC 6298, so a gateway that stalls for a moment on a fast link
+# still gets several secs over all the retries before it's given up on
+MQTTSN_MIN_RTO = 1
+MQTTSN_MAX_RTO = 60
+MQTTSN_RTO_JITTER = 0.1
+
+# max number of REGISTER/SUBSCRIBE/UNSUBSCRIBE awaiting a reply at once
+MQTTSN_MAX_INFLIGHT = 8
+
+# max number of QoS 1 publish msgs awaiting a PUBACK at once
+MQTTSN_MAX_INFLIGHT_PUBLISH = 16
+
+# max number of publish msgs held by a client while it can't send them
+MQTTSN_MAX_OFFLINE_PUBLISH = 16
+
+# round trip time assumed for a gateway we haven't measured yet, in seconds
+MQTTSN_INITIAL_RTT = 1
+
 # in seconds
 MQTTSN_T_SEARCHGW = 5
 MQTTSN_MAX_T_SEARCHGW = 300
 
+# wait before reconnecting after losing our gateway, doubling with each failed attempt up to the max.
+# the actual wait is random up to that, so nodes that lost the same gateway don't all come back at once
+MQTTSN_MIN_RECONNECT_DELAY = 1
+MQTTSN_MAX_RECONNECT_DELAY = 120
+
 #############################
 # For gateways
 #############################
@@ -35,3 +63,29 @@ MQTTSN_MAX_GATEWAY_TOPICS = 60
 MQTTSN_MAX_NUM_CLIENTS = 10
 
 MQTTSN_MAX_QUEUED_PUBLISH = 64
+
+# outgoing msgs are either control (replies, pings, advertisements) or data (publish msgs),
+# control always goes first. these are how many of each can be waiting for one destination
+# while its transport is backed up, past that the oldest get dropped
+MQTTSN_PRIORITY_CONTROL = 0
+MQTTSN_PRIORITY_DATA = 1
+MQTTSN_MAX_QUEUED_CONTROL = 16
+MQTTSN_MAX_QUEUED_DATA = 64
+
+# how many new sessions, and REGISTERs/SUBSCRIBEs, a gateway takes on per sec. the rest
+# get turned away with a congestion return code and a hint of when to try again. 0 turns it off
+MQTTSN_CONNECT_RATE = 20
+MQTTSN_REGISTER_RATE = 100
+
+# in seconds, how long a clean_session=0 session is kept after its client goes away
+MQTTSN_SESSION_EXPIRY = 3600
+
+# in seconds, time between ADVERTISE broadcasts
+MQTTSN_T_ADVERTISE = 60
+
+# in seconds, min time between GWINFO broadcasts,
+# SEARCHGWs that arrive in between all get answered by the next one
+MQTTSN_T_GWINFO_HOLDOFF = 0.5
+
+# in seconds, how often the gateway polls transports without fds when it's got nothing else to wait for
+MQTTSN_T_POLL = 0.1
@@ -1,14 +1,33 @@
-from typing import List, Callable
+from typing import List, Callable, Union
 
 from mqttsn_messages import *
 from mqttsn_transport import MQTTSNTransport
+from mqttsn_transport_queued import MQTTSNTransportQueued
+from mqttsn_ratelimit import MQTTSNTokenBucket
 from mqtt_client import MQTTClient
+from mqtt_client_pool import MQTTClientPool
 from enum import IntEnum, unique
 import time
+import math
+import itertools
+import selectors
 import collections
 import logging
 
 
+# address of a node behind a forwarder, anything for it goes back through the forwarder
+MQTTSNForwardedAddress = collections.namedtuple('MQTTSNForwardedAddress', ['forwarder', 'node_id'])
+
+
+# send a packet to an address, wrapping it up for each forwarder it has to pass through
+def write_packet(transport: MQTTSNTransportQueued, raw, addr, priority=MQTTSN_PRIORITY_CONTROL):
+    if isinstance(addr, MQTTSNForwardedAddress):
+        msg = MQTTSNMessageEncapsulated(addr.node_id, raw)
+        return write_packet(transport, msg.pack(), addr.forwarder, priority)
+
+    return transport.write_packet(raw, addr, priority)
+
+
 class MQTTSNInstancePubTopic:
     def __init__(self, tid=0):
         self.tid = tid
@@ -19,6 +38,41 @@ class MQTTSNInstanceSubTopic:
         self.tid = tid
         self.flags = flags if flags else MQTTSNFlags()
 
+        # the sub's policy, if any: the least secs between publish msgs,
+        # and whether to hold on to the newest one till it can go, rather than drop it
+        self.min_interval = 0
+        self.conflate = True
+
+        # when we last sent one, and the newest one waiting for its turn
+        self.last_sent: float = 0
+        self.pending: bytes = b''
+
+
+# gateway-side options for subscriptions matching a topic filter, for one client or for everyone
+class MQTTSNSubPolicy:
+    def __init__(self, topic_filter=b'#', client_id=None, min_interval=0, conflate=True):
+        self.topic_filter = topic_filter
+        self.client_id = client_id
+        self.min_interval = min_interval
+        self.conflate = conflate
+
+    def matches(self, cid, name):
+        if self.client_id is not None and self.client_id != cid:
+            return False
+        return topic_matches(self.topic_filter, name)
+
+
+# check a topic name against an MQTT topic filter, with + and # wildcards
+def topic_matches(topic_filter: bytes, name: bytes):
+    levels = name.split(b'/')
+    for idx, level in enumerate(topic_filter.split(b'/')):
+        if level == b'#':
+            return True
+        if idx >= len(levels) or (level != b'+' and level != levels[idx]):
+            return False
+
+    return len(levels) == len(topic_filter.split(b'/'))
+
 
 @unique
 class MQTTSNInstanceStatus(IntEnum):
@@ -28,9 +82,10 @@ class MQTTSNInstanceStatus(IntEnum):
 
 
 class MQTTSNInstance:
-    transport: MQTTSNTransport
-
     def __init__(self):
+        # the transport the client reached us on, its address is only unique within that
+        self.transport: MQTTSNTransport = None
+
         self.sub_topics: List[MQTTSNInstanceSubTopic] = \
             [MQTTSNInstanceSubTopic() for _ in range(MQTTSN_MAX_INSTANCE_TOPICS)]
         self.pub_topics: List[MQTTSNInstancePubTopic] = \
@@ -48,51 +103,94 @@ class MQTTSNInstance:
         self.last_in: float = 0
         self.status: MQTTSNInstanceStatus = MQTTSNInstanceStatus.DISCONNECTED
 
-    # insert new client's details
-    def register(self, cid, address, duration, flags):
+        # when a suspended session gets dropped
+        self.expires: float = 0
+
+    # insert new client's details, keeping its topics if we're resuming its session
+    def register(self, cid, address, duration, flags, resume=False):
         self.cid = cid
         self.address = address
         self.keepalive_duration = duration
         self.flags = flags
 
-        for topic in self.sub_topics:
-            topic.tid = 0
-
-        for topic in self.pub_topics:
-            topic.tid = 0
+        if not resume:
+            self._clear_topics()
 
         self.msg_inflight = b''
+        self.unicast_counter = 0
         self.status = MQTTSNInstanceStatus.ACTIVE
         self.mark_time()
 
     def deregister(self):
         self.cid = b''
         self.address = b''
+        self.msg_inflight = b''
+        self._clear_topics()
         self.status = MQTTSNInstanceStatus.DISCONNECTED
 
+    # client's gone, but hold on to its session till it comes back or expires
+    def suspend(self, status, expiry):
+        self.address = b''
+        self.msg_inflight = b''
+        self.status = status
+        self.expires = time.time() + expiry
+
+    def _clear_topics(self):
+        for topic in self.sub_topics:
+            topic.tid = 0
+            topic.flags = None
+            topic.pending = b''
+
+        for topic in self.pub_topics:
+            topic.tid = 0
+
+    def is_active(self):
+        return bool(self.cid) and self.status == MQTTSNInstanceStatus.ACTIVE
+
+    def is_expired(self):
+        return not self.is_active() and time.time() >= self.expires
+
     def register_transport(self, transport):
         self.transport = transport
 
+    def write_packet(self, raw, priority=MQTTSN_PRIORITY_CONTROL):
+        return write_packet(self.transport, raw, self.address, priority)
+
     def __bool__(self):
         return bool(self.cid)
 
-    def add_sub_topic(self, tid: int, flags: MQTTSNFlags):
+    def add_sub_topic(self, tid: int, flags: MQTTSNFlags, policy: MQTTSNSubPolicy = None):
         # check if we're already subbed
         # and only update the flags if so
-        for i in range(MQTTSN_MAX_INSTANCE_TOPICS):
-            if self.sub_topics[i].tid == tid:
-                self.sub_topics[i].flags = flags
-                return True
+        topic = self.get_sub_topic(tid)
+        if topic is None:
+            # else add the new topic to our list
+            topic = self.get_sub_topic(0)
+            if topic is None:
+                # no more space
+                return False
+
+            topic.tid = tid
+            topic.last_sent = 0
+            topic.pending = b''
+
+        topic.flags = flags
+        self.set_sub_policy(topic, policy)
+        return True
+
+    def set_sub_policy(self, topic: MQTTSNInstanceSubTopic, policy: MQTTSNSubPolicy = None):
+        topic.min_interval = policy.min_interval if policy else 0
+        topic.conflate = policy.conflate if policy else True
+
+    def get_sub_topic(self, tid):
+        for topic in self.sub_topics:
+            if topic.tid == tid:
+                return topic
 
-        # else add the new topic to our list
-        for i in range(MQTTSN_MAX_INSTANCE_TOPICS):
-            if self.sub_topics[i].tid == 0:
-                self.sub_topics[i].tid = tid
-                self.sub_topics[i].flags = flags
-                return True
+        return None
 
-        # no more space
-        return False
+    def has_pub_topic(self, tid: int):
+        return tid != 0 and any(topic.tid == tid for topic in self.pub_topics)
 
     def add_pub_topic(self, tid: int):
         # check if we're already registered
@@ -115,6 +213,7 @@ class MQTTSNInstance:
             if self.sub_topics[i].tid == tid:
                 self.sub_topics[i].tid = 0
                 self.sub_topics[i].flags = None
+                self.sub_topics[i].pending = b''
                 return
 
     # no real use for this yet
@@ -126,12 +225,51 @@ class MQTTSNInstance:
 
     # check if we're subbed to a topic
     def is_subbed(self, tid):
+        if not tid:
+            return False
+
         for topic in self.sub_topics:
             if topic.tid == tid:
                 return True
 
         return False
 
+    # send a publish msg for one of our subs, unless its policy says it's too soon.
+    # then the newest one waits for its turn, if the sub conflates, or it's dropped
+    def publish(self, tid, pkt):
+        topic = self.get_sub_topic(tid) if tid else None
+        if topic is None:
+            return
+
+        if time.time() < topic.last_sent + topic.min_interval:
+            if topic.conflate:
+                topic.pending = pkt
+            return
+
+        topic.last_sent = time.time()
+        topic.pending = b''
+        self.write_packet(pkt, MQTTSN_PRIORITY_DATA)
+
+    # send any held back publish msgs whose turn has come
+    def send_pending(self):
+        curr_time = time.time()
+        for topic in self.sub_topics:
+            if topic.pending and curr_time >= topic.last_sent + topic.min_interval:
+                self.publish(topic.tid, topic.pending)
+
+    # time at which check_status() or send_pending() next has something to do
+    def next_deadline(self):
+        if not self.is_active():
+            return self.expires
+
+        deadline = self.last_in + self.keepalive_duration * 1.5
+        if self.msg_inflight:
+            deadline = min(deadline, self.unicast_timer + MQTTSN_T_RETRY)
+        for topic in self.sub_topics:
+            if topic.pending:
+                deadline = min(deadline, topic.last_sent + topic.min_interval)
+        return deadline
+
     def check_status(self):
         # check last time we got a control packet
         if time.time() - self.last_in > self.keepalive_duration * 1.5:
@@ -155,7 +293,7 @@ class MQTTSNInstance:
             return self.status
 
         # resend the msg if not
-        self.transport.write_packet(self.msg_inflight, self.address)
+        self.write_packet(self.msg_inflight)
         return self.status
 
     def mark_time(self):
@@ -172,22 +310,41 @@ class MQTTSNTopicMapping:
         self.sub_qos = 0
 
 
+# serves clients on any number of transports at once, e.g. several UDP ports and a stream
 class MQTTSNGateway:
-    # for holding the broker's list of topic ID mappings
-    mappings: List[MQTTSNTopicMapping] = [MQTTSNTopicMapping() for _ in range(MQTTSN_MAX_GATEWAY_TOPICS)]
+    def __init__(self, gw_id: int, mqttc: Union[MQTTClient, List[MQTTClient]],
+                 transport: Union[MQTTSNTransport, List[MQTTSNTransport]],
+                 advertise_interval=MQTTSN_T_ADVERTISE, session_expiry=MQTTSN_SESSION_EXPIRY,
+                 connect_rate=MQTTSN_CONNECT_RATE, register_rate=MQTTSN_REGISTER_RATE,
+                 advertise_load=False):
+        self.gw_id = gw_id
 
-    # list of clients
-    clients: List[MQTTSNInstance] = [MQTTSNInstance() for _ in range(MQTTSN_MAX_NUM_CLIENTS)]
+        # for holding the broker's list of topic ID mappings
+        self.mappings: List[MQTTSNTopicMapping] = \
+            [MQTTSNTopicMapping() for _ in range(MQTTSN_MAX_GATEWAY_TOPICS)]
 
-    # handle incoming messages
-    msg_handlers: List[Callable[[bytes, bytes], None]] = [None] * len(MQTTSN_MSG_TYPES)
+        # list of clients
+        self.clients: List[MQTTSNInstance] = [MQTTSNInstance() for _ in range(MQTTSN_MAX_NUM_CLIENTS)]
 
-    def __init__(self, gw_id: int, mqttc: MQTTClient, transport: MQTTSNTransport):
-        self.gw_id = gw_id
-        self.transport = transport
+        # handle incoming messages
+        self.msg_handlers: List[Callable[[bytes, bytes], None]] = [None] * len(MQTTSN_MSG_TYPES)
 
-        # MQTT client handles, also register the relevant handlers
-        self.mqttc = mqttc
+        # wait on all our transports' fds (and the MQTT client's) at once
+        self.selector = selectors.DefaultSelector()
+        self.mqtt_fds = set()
+        self.transport_fds = {}
+
+        # the transports we serve, and the one the msg we're handling came in on
+        self.transports: List[MQTTSNTransportQueued] = []
+        for t in (transport if isinstance(transport, (list, tuple)) else [transport]):
+            self.add_transport(t)
+        if not self.transports:
+            raise ValueError('MQTTSNGateway needs at least one transport')
+        self.transport = self.transports[0]
+
+        # MQTT client handles, also register the relevant handlers.
+        # several clients get pooled, with topics spread over them
+        self.mqttc = MQTTClientPool(mqttc) if isinstance(mqttc, (list, tuple)) else mqttc
         if self.mqttc:
             self.mqttc.register_handlers(self._handle_mqtt_conn, self._handle_mqtt_publish)
 
@@ -200,6 +357,29 @@ class MQTTSNGateway:
         # queue for msgs yet to be published to MQTT-SN clients
         self.pub_queue = collections.deque(maxlen=MQTTSN_MAX_QUEUED_PUBLISH)
 
+        # load last advertised to clients, 0 - 255.
+        # it's an extra byte on the end of ADVERTISE, so only sent if asked for
+        self.advertise_load = advertise_load
+        self.load = 0
+
+        # periodic ADVERTISE, the first goes out right away. 0 turns it off
+        self.advertise_interval = advertise_interval
+        self.advertise_timer = 0
+
+        # for coalescing GWINFO replies to SEARCHGW
+        self.gwinfo_pending = False
+        self.gwinfo_timer = 0
+
+        # how long we keep clean_session=0 sessions around for their clients, 0 doesn't keep them
+        self.session_expiry = session_expiry
+
+        # admission control for new sessions, and for REGISTERs and SUBSCRIBEs together
+        self.connect_bucket = MQTTSNTokenBucket(connect_rate) if connect_rate else None
+        self.register_bucket = MQTTSNTokenBucket(register_rate) if register_rate else None
+
+        # rate limits and such for subscriptions, see add_sub_policy()
+        self.sub_policies: List[MQTTSNSubPolicy] = []
+
         # handlers for MQTT-SN msgs we get from clients
         self._assign_msg_handlers()
 
@@ -211,16 +391,40 @@ class MQTTSNGateway:
         self.msg_handlers[UNSUBSCRIBE] = self._handle_unsubscribe
         self.msg_handlers[PUBLISH] = self._handle_publish
         self.msg_handlers[PINGREQ] = self._handle_pingreq
+        self.msg_handlers[DISCONNECT] = self._handle_disconnect
 
     # main gateway loop
-    def loop(self):
-        self._handle_messages()
-
-        # check keepalive and inflight messages
+    # with a timeout, block till a packet arrives, our next deadline
+    # or the timeout, whichever comes first. None waits as long as it takes
+    def loop(self, timeout=0):
+        ready = self._wait(timeout)
+        self._handle_messages(ready)
+
+        # announce ourselves, and answer any SEARCHGWs we've been holding off on
+        curr_time = time.time()
+        if self.advertise_interval and curr_time >= self.advertise_timer + self.advertise_interval:
+            self.advertise()
+        if self.gwinfo_pending and curr_time >= self.gwinfo_timer + MQTTSN_T_GWINFO_HOLDOFF:
+            self._send_gwinfo()
+
+        # check keepalive and inflight messages, and drop sessions that have expired
         for clnt in self.clients:
-            if clnt and clnt.check_status() == MQTTSNInstanceStatus.LOST:
+            if not clnt:
+                continue
+
+            if not clnt.is_active():
+                if clnt.is_expired():
+                    logging.debug('Session for {} expired'.format(clnt.cid))
+                    self._end_session(clnt)
+                continue
+
+            if clnt.check_status() == MQTTSNInstanceStatus.LOST:
                 logging.debug('Client {} lost'.format(clnt.address))
-                clnt.deregister()
+                self._close_session(clnt, MQTTSNInstanceStatus.LOST)
+                self._update_load()
+                continue
+
+            clnt.send_pending()
 
         # now distribute any pending publish msgs
         # from the queue
@@ -242,34 +446,179 @@ class MQTTSNGateway:
 
             tid = msg.topic_id
             for clnt in self.clients:
-                if clnt.is_subbed(tid):
-                    self.transport.write_packet(pkt, clnt.address)
+                if clnt.is_active():
+                    clnt.publish(tid, pkt)
+
+        # everything we had to send this time round goes out together
+        for transport in self.transports:
+            transport.flush()
 
         # just to return something useful
         return self.connected
 
-    def _handle_messages(self):
-        while True:
-            # try to read something, return if theres nothing
-            pkt, from_addr = self.transport.read_packet()
-            if not pkt:
-                return
+    # get the time at which loop() next has something to do, or None if it's idle
+    def next_deadline(self):
+        # queued publish msgs go out right away
+        if self.pub_queue:
+            return time.time()
+
+        deadlines = [clnt.next_deadline() for clnt in self.clients if clnt]
+        if self.advertise_interval:
+            deadlines.append(self.advertise_timer + self.advertise_interval)
+        if self.gwinfo_pending:
+            deadlines.append(self.gwinfo_timer + MQTTSN_T_GWINFO_HOLDOFF)
+
+        # paced msgs waiting for their turn
+        for transport in self.transports:
+            deadline = transport.next_deadline()
+            if deadline is not None:
+                deadlines.append(deadline)
+
+        return min(deadlines) if deadlines else None
+
+    # everything we send goes through a queue in front of the transport,
+    # so control msgs can go ahead of publish msgs when it backs up.
+    # pass in a MQTTSNTransportQueued of your own to pace a slow link
+    def add_transport(self, transport: MQTTSNTransport):
+        if not isinstance(transport, MQTTSNTransportQueued):
+            transport = MQTTSNTransportQueued(transport)
+        self.transports.append(transport)
+        self.transport_fds[transport] = set(transport.filenos())
+        for fd in self.transport_fds[transport]:
+            self.selector.register(fd, selectors.EVENT_READ, transport)
+
+    # keep up with our transports' fds, e.g. a stream gives its up once the other end closes.
+    # also wake up as soon as a backed up transport can take more
+    def _update_transport_fds(self):
+        for transport in self.transports:
+            events = selectors.EVENT_READ
+            if transport.backed_up():
+                events |= selectors.EVENT_WRITE
+
+            fds = set(transport.filenos())
+            prev = self.transport_fds[transport]
+            for fd in prev - fds:
+                try:
+                    self.selector.unregister(fd)
+                except (KeyError, ValueError):
+                    pass
+                logging.debug('Transport fd {} closed, no longer waiting on it.'.format(fd))
+
+            for fd in fds:
+                if fd not in prev:
+                    self.selector.register(fd, events, transport)
+                elif self.selector.get_key(fd).events != events:
+                    self.selector.modify(fd, events, transport)
+            self.transport_fds[transport] = fds
+
+    # wait as long as we're allowed to, and return the transports with something to read
+    def _wait(self, timeout):
+        deadline = self.next_deadline()
+        if deadline is not None:
+            until_deadline = max(0.0, deadline - time.time())
+            timeout = until_deadline if timeout is None else min(timeout, until_deadline)
+
+        # also wake up for the MQTT client, if it can tell us what to wait on,
+        # its socket comes and goes as it reconnects
+        self._update_mqtt_fds()
+        self._update_transport_fds()
+
+        # nothing to wait on, so sleep till there's something to do.
+        # with no deadline either, transports without fds still need polling now and then
+        if not self.selector.get_map():
+            if timeout is None:
+                timeout = MQTTSN_T_POLL
+            if timeout > 0:
+                time.sleep(timeout)
+            return set()
+
+        # transports without fds get polled every time anyway
+        if timeout is not None and timeout <= 0:
+            timeout = 0
+        events = self.selector.select(timeout)
+        return {key.data for key, _ in events if key.data}
+
+    def _update_mqtt_fds(self):
+        fds = set(self.mqttc.filenos()) if self.mqttc else set()
+        for fd in self.mqtt_fds - fds:
+            try:
+                self.selector.unregister(fd)
+            except (KeyError, ValueError):
+                pass
+        for fd in fds - self.mqtt_fds:
+            self.selector.register(fd, selectors.EVENT_READ, None)
+        self.mqtt_fds = fds
+
+    def _handle_messages(self, ready):
+        # read in everything first, so that pings and publishes from clients we already have
+        # get handled ahead of new sessions and registrations, e.g. after a restart
+        urgent, rest = [], []
+        for transport in self.transports:
+            if transport.filenos() and transport not in ready:
+                continue
 
-            # parse the header so we can get the msg type
-            header = MQTTSNHeader()
-            rlen = header.unpack(pkt)
+            while True:
+                # try to read something, move on if theres nothing
+                pkt, from_addr = transport.read_packet()
+                if not pkt:
+                    break
 
-            # if it failed somehow
-            if not rlen:
-                continue
+                queue = urgent if self._msg_type(pkt) in (PINGREQ, PUBLISH) else rest
+                queue.append((transport, pkt, from_addr))
+
+        for transport, pkt, from_addr in itertools.chain(urgent, rest):
+            # the one it came in on is where replies go
+            self.transport = transport
+            self._handle_packet(pkt, from_addr)
+
+    # the type of a msg, or of the one inside if it's encapsulated
+    @staticmethod
+    def _msg_type(pkt):
+        header = MQTTSNHeader()
+        if not header.unpack(pkt):
+            return None
+
+        if header.msg_type == ENCAPSULATED:
+            msg = MQTTSNMessageEncapsulated()
+            if msg.unpack(pkt) and header.unpack(msg.msg):
+                return header.msg_type
+            return None
+
+        return header.msg_type
+
+    # 0 if we can take on one more, else how many secs to tell the client to wait
+    @staticmethod
+    def _admission_wait(bucket):
+        if bucket is None or bucket.take():
+            return 0
+        return min(math.ceil(bucket.defer()), 0xFFFF)
+
+    def _handle_packet(self, pkt, from_addr):
+        # parse the header so we can get the msg type
+        header = MQTTSNHeader()
+        rlen = header.unpack(pkt)
+
+        # if it failed somehow
+        if not rlen:
+            return
 
-            # check that a handler exists
-            idx = header.msg_type
-            if idx >= len(self.msg_handlers) or self.msg_handlers[idx] is None:
-                continue
+        # unwrap msgs relayed by a forwarder, the node behind it is who we're talking to
+        if header.msg_type == ENCAPSULATED:
+            msg = MQTTSNMessageEncapsulated()
+            if msg.unpack(pkt):
+                self._handle_packet(msg.msg, MQTTSNForwardedAddress(from_addr, msg.node_id))
+            return
 
-            # call the msg handler
-            self.msg_handlers[idx](pkt[rlen:], from_addr)
+        # check that a handler exists
+        idx = header.msg_type
+        if idx >= len(self.msg_handlers) or self.msg_handlers[idx] is None:
+            return
+
+        # call the msg handler
+        self.msg_handlers[idx](pkt[rlen:], from_addr)
+
+    def _write_packet(self, raw, addr):
+        return write_packet(self.transport, raw, addr)
 
     def _handle_searchgw(self, pkt, from_addr):
         msg = MQTTSNMessageSearchGW()
@@ -278,13 +627,60 @@ class MQTTSNGateway:
 
         logging.debug('SEARCHGW from {}'.format(from_addr))
 
+        # a node behind a forwarder won't hear our broadcast, so it gets its own reply
+        if isinstance(from_addr, MQTTSNForwardedAddress):
+            reply = MQTTSNMessageGWInfo()
+            reply.gwid = self.gw_id
+            self._write_packet(reply.pack(), from_addr)
+            return
+
+        # one broadcast answers everyone searching,
+        # so if we've only just sent one, wait and send the next for all of them
+        self.gwinfo_pending = True
+        if time.time() >= self.gwinfo_timer + MQTTSN_T_GWINFO_HOLDOFF:
+            self._send_gwinfo()
+
+    def _send_gwinfo(self):
         reply = MQTTSNMessageGWInfo()
-        reply.id = self.gw_id
+        reply.gwid = self.gw_id
         raw = reply.pack()
-        self.transport.broadcast(raw)
+        for transport in self.transports:
+            transport.broadcast(raw)
 
+        self.gwinfo_pending = False
+        self.gwinfo_timer = time.time()
         logging.debug('GWINFO broadcast.')
 
+    # current load as a fraction of 255, going by how many client slots are in use
+    def get_load(self):
+        used = sum(1 for clnt in self.clients if clnt.is_active())
+        return min(255, used * 255 // MQTTSN_MAX_NUM_CLIENTS)
+
+    # broadcast an ADVERTISE, letting clients know of us and how loaded we are
+    def advertise(self):
+        msg = MQTTSNMessageAdvertise(self.gw_id)
+        msg.duration = self.advertise_interval
+        if self.advertise_load:
+            msg.load = self.load = self.get_load()
+        raw = msg.pack()
+        for transport in self.transports:
+            transport.broadcast(raw)
+
+        # it also does the job of a GWINFO for anyone searching
+        self.advertise_timer = time.time()
+        self.gwinfo_pending = False
+        self.gwinfo_timer = self.advertise_timer
+
+        logging.debug('ADVERTISE broadcast, load {}.'.format(msg.load))
+
+    # let clients know once our load has moved by an eighth or more,
+    # if we're advertising at all and our load along with it
+    def _update_load(self):
+        if not self.advertise_interval or not self.advertise_load:
+            return
+        if abs(self.get_load() - self.load) >= 32:
+            self.advertise()
+
     def _handle_connect(self, pkt, from_addr):
         msg = MQTTSNMessageConnect()
         if not msg.unpack(pkt) or not msg.client_id:
@@ -296,25 +692,75 @@ class MQTTSNGateway:
         reply = MQTTSNMessageConnack()
         reply.return_code = MQTTSN_RC_ACCEPTED
 
-        # try to check if the client is already connected
+        # turn away any more than we can take on right now
+        reply.wait_time = self._admission_wait(self.connect_bucket)
+        if reply.wait_time:
+            logging.debug('Congested, {} to wait {} secs'.format(msg.client_id, reply.wait_time))
+            reply.return_code = MQTTSN_RC_CONGESTION
+            self._write_packet(reply.pack(), from_addr)
+            return
+
+        # whatever was connected from this address before is gone now
+        session = self._get_session(msg.client_id)
         clnt = self._get_instance(from_addr)
-        if clnt:
-            # if we do have an existing session, overwrite it
-            clnt.register(msg.client_id, from_addr, msg.duration, msg.flags)
+        if clnt and clnt is not session:
+            self._close_session(clnt, MQTTSNInstanceStatus.DISCONNECTED)
+
+        # pick up where the client left off, unless it wants a clean start
+        if session and (msg.flags.clean_session or not self.session_expiry):
+            self._end_session(session)
+            session = None
+
+        clnt = session if session else self._get_free_instance()
+        if clnt is not None:
+            clnt.register(msg.client_id, from_addr, msg.duration, msg.flags, resume=bool(session))
             clnt.register_transport(self.transport)
+            reply.session_present = 1 if session else 0
+            logging.debug('Session for {} {}'.format(msg.client_id, 'resumed' if session else 'started'))
         else:
-            # else create a new instance
-            for clnt in self.clients:
-                if not clnt:
-                    clnt.register(msg.client_id, from_addr, msg.duration, msg.flags)
-                    clnt.register_transport(self.transport)
-                    break
-            else:
-                # no space left for new clients
-                reply.return_code = MQTTSN_RC_CONGESTION
+            # no space left for new clients
+            reply.return_code = MQTTSN_RC_CONGESTION
 
         raw = reply.pack()
-        self.transport.write_packet(raw, from_addr)
+        self._write_packet(raw, from_addr)
+        self._update_load()
+
+    def _get_session(self, cid):
+        for clnt in self.clients:
+            if clnt and clnt.cid == cid:
+                return clnt
+
+        return None
+
+    # an unused instance, making room by dropping the oldest suspended session if needed
+    def _get_free_instance(self):
+        for clnt in self.clients:
+            if not clnt:
+                return clnt
+
+        suspended = [clnt for clnt in self.clients if not clnt.is_active()]
+        if not suspended:
+            return None
+
+        clnt = min(suspended, key=lambda c: c.expires)
+        self._end_session(clnt)
+        return clnt
+
+    # the client's gone, keep its session if it asked us to
+    def _close_session(self, clnt: MQTTSNInstance, status):
+        if clnt.flags.clean_session or not self.session_expiry:
+            self._end_session(clnt)
+        else:
+            clnt.suspend(status, self.session_expiry)
+
+    # drop the session, and any broker subs nobody else needs anymore
+    def _end_session(self, clnt: MQTTSNInstance):
+        tids = [topic.tid for topic in clnt.sub_topics if topic.tid]
+        clnt.deregister()
+
+        for tid in tids:
+            if not any(other.is_subbed(tid) for other in self.clients):
+                self.delete_subscription(tid)
 
     def _get_topic_id(self, name):
         # check if we already have that topic
@@ -337,6 +783,10 @@ class MQTTSNGateway:
         return 0
 
     def get_topic_mapping(self, tid):
+        # 0 is never assigned, and marks unused mappings
+        if tid == MQTTSN_TOPIC_NOTASSIGNED:
+            return None
+
         # check if we already have that topic
         for idx in range(MQTTSN_MAX_GATEWAY_TOPICS):
             if self.mappings[idx].tid == tid:
@@ -344,9 +794,10 @@ class MQTTSNGateway:
 
         return None
 
+    # the active session at this address, on the transport we're reading from
     def _get_instance(self, addr):
         for clnt in self.clients:
-            if clnt and clnt.address == addr:
+            if clnt.is_active() and clnt.address == addr and clnt.transport is self.transport:
                 return clnt
 
         return None
@@ -369,6 +820,13 @@ class MQTTSNGateway:
         reply.msg_id = msg.msg_id
         reply.return_code = MQTTSN_RC_ACCEPTED
 
+        # turn away any more than we can take on right now
+        reply.wait_time = self._admission_wait(self.register_bucket)
+        if reply.wait_time:
+            reply.return_code = MQTTSN_RC_CONGESTION
+            self._write_packet(reply.pack(), from_addr)
+            return
+
         # get an ID and try to add the topic to the instance
         tid = self._get_topic_id(msg.topic_name)
         if not tid:
@@ -381,21 +839,33 @@ class MQTTSNGateway:
 
         # now send our reply
         raw = reply.pack()
-        self.transport.write_packet(raw, from_addr)
+        self._write_packet(raw, from_addr)
 
     def _handle_publish(self, pkt, from_addr):
         # check that we know this client
-        if not self._get_instance(from_addr):
+        clnt = self._get_instance(from_addr)
+        if not clnt:
             return
 
-        # now unpack the message, only QoS 0 for now
+        # now unpack the message, only QoS 0 and 1 for now
         msg = MQTTSNMessagePublish()
-        if not msg.unpack(pkt) or msg.msg_id != 0x0000:
+        if not msg.unpack(pkt) or msg.flags.qos > 1:
             return
 
-        # get the topic name
-        mapping = self.get_topic_mapping(msg.topic_id)
+        # QoS 1 gets acked, and counts as proof of life
+        qos = msg.flags.qos
+        reply = MQTTSNMessagePuback()
+        reply.topic_id = msg.topic_id
+        reply.msg_id = msg.msg_id
+        if qos == 1:
+            clnt.mark_time()
+
+        # get the topic name, and let the client know if we don't have it, whatever the QoS.
+        # it has to be one this client registered, an ID from before a restart may be someone else's now
+        mapping = self.get_topic_mapping(msg.topic_id) if clnt.has_pub_topic(msg.topic_id) else None
         if not mapping:
+            reply.return_code = MQTTSN_RC_INVALIDTID
+            self._write_packet(reply.pack(), from_addr)
             return
 
         logging.debug('PUBLISH {} to topic {} from {}.'.format(msg.data, mapping.name, from_addr))
@@ -405,9 +875,14 @@ class MQTTSNGateway:
             self.mqttc.publish(mapping.name, msg.data, msg.flags.qos, msg.flags.retain)
         else:
             # else we're on our own, add the msg to our queue
-            # so we'll distribute it locally as broker
+            # so we'll distribute it locally as broker, only at QoS 0
+            msg.msg_id = 0x0000
+            msg.flags.qos = 0
             self.pub_queue.append(msg.pack())
 
+        if qos == 1:
+            self._write_packet(reply.pack(), from_addr)
+
     def _handle_subscribe(self, pkt, from_addr):
         # get the right instance for this client
         clnt = self._get_instance(from_addr)
@@ -427,6 +902,13 @@ class MQTTSNGateway:
         reply.msg_id = msg.msg_id
         reply.return_code = MQTTSN_RC_ACCEPTED
 
+        # turn away any more than we can take on right now
+        reply.wait_time = self._admission_wait(self.register_bucket)
+        if reply.wait_time:
+            reply.return_code = MQTTSN_RC_CONGESTION
+            self._write_packet(reply.pack(), from_addr)
+            return
+
         # get an ID
         tid = self._get_topic_id(msg.topic_id_name)
         if not tid:
@@ -434,19 +916,40 @@ class MQTTSNGateway:
 
         reply.return_code = MQTTSN_RC_ACCEPTED
         # add the topic to the instance
-        if not clnt.add_sub_topic(tid, msg.flags):
+        policy = self._get_sub_policy(clnt.cid, msg.topic_id_name)
+        if not clnt.add_sub_topic(tid, msg.flags, policy):
             reply.return_code = MQTTSN_RC_CONGESTION
         else:
             reply.topic_id = tid
 
         # now send our reply
         raw = reply.pack()
-        self.transport.write_packet(raw, from_addr)
+        self._write_packet(raw, from_addr)
 
         # send the new sub to MQTT broker
         if reply.return_code == MQTTSN_RC_ACCEPTED:
             self.add_subscription(tid, msg.flags.qos)
 
+    # set options for subscriptions matching a topic filter, for one client or for everyone,
+    # e.g. MQTTSNSubPolicy(b'sensors/#', min_interval=5) to send at most one publish msg
+    # every 5 secs, the newest. later policies take precedence over earlier ones,
+    # and subscriptions we already have pick them up straight away
+    def add_sub_policy(self, policy: MQTTSNSubPolicy):
+        self.sub_policies.append(policy)
+
+        for clnt in self.clients:
+            for topic in clnt.sub_topics:
+                mapping = self.get_topic_mapping(topic.tid) if clnt else None
+                if mapping:
+                    clnt.set_sub_policy(topic, self._get_sub_policy(clnt.cid, mapping.name))
+
+    def _get_sub_policy(self, cid, name):
+        for policy in reversed(self.sub_policies):
+            if policy.matches(cid, name):
+                return policy
+
+        return None
+
     def add_subscription(self, tid, qos):
         mapping = self.get_topic_mapping(tid)
 
@@ -496,7 +999,7 @@ class MQTTSNGateway:
 
         # now send our reply
         raw = reply.pack()
-        self.transport.write_packet(raw, from_addr)
+        self._write_packet(raw, from_addr)
 
         # check if anybody's still subscribed
         for clnt in self.clients:
@@ -521,7 +1024,26 @@ class MQTTSNGateway:
         # now send our reply
         reply = MQTTSNMessagePingresp()
         raw = reply.pack()
-        self.transport.write_packet(raw, from_addr)
+        self._write_packet(raw, from_addr)
+
+    def _handle_disconnect(self, pkt, from_addr):
+        clnt = self._get_instance(from_addr)
+        if not clnt:
+            return
+
+        msg = MQTTSNMessageDisconnect()
+        if not msg.unpack(pkt):
+            return
+
+        logging.debug('DISCONNECT from {}'.format(from_addr))
+
+        # no sleeping clients yet, so a duration makes no difference
+        reply = MQTTSNMessageDisconnect()
+        raw = reply.pack()
+        self._write_packet(raw, from_addr)
+
+        self._close_session(clnt, MQTTSNInstanceStatus.DISCONNECTED)
+        self._update_load()
 
     def _handle_mqtt_conn(self, conn_state: bool):
         # now we know we're no longer connected to MQTT broker
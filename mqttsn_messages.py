@@ -20,6 +20,9 @@ MSG_TYPE_NAMES = ["ADVERTISE", "SEARCHGW", "GWINFO", "reserved",
                   "reserved", "WILLTOPICUPD", "WILLTOPICRESP",
                   "WILLMSGUPD", "WILLMSGRESP"]
 
+# forwarder encapsulation sits outside the regular msg types
+ENCAPSULATED = 0xFE
+
 TOPIC_TYPE_NAMES = ["NORMAL", "PREDEFINED", "SHORT_NAME"]
 MQTTSN_TOPIC_NORMAL, MQTTSN_TOPIC_PREDEFINED, MQTTSN_TOPIC_SHORTNAME = range(3)
 
@@ -123,21 +126,32 @@ class MQTTSNMessage:
         return str(self.__dict__)
 
 
+# carries an extra trailing byte with the gateway's load (0 - 255),
+# which is optional when unpacking so plain ADVERTISEs still work
 class MQTTSNMessageAdvertise(MQTTSNMessage):
     def __init__(self, gwid=0):
         super().__init__()
         self.gwid = gwid
         self.duration = 0
+        self.load = 0
 
     def pack(self):
         header = MQTTSNHeader(ADVERTISE)
-        msg = header.pack(3)
-        msg += struct.pack(">BH", self.gwid, self.duration)
+        if self.load:
+            msg = header.pack(1 + 2 + 1)
+            msg += struct.pack(">BHB", self.gwid, self.duration, self.load)
+        else:
+            msg = header.pack(1 + 2)
+            msg += struct.pack(">BH", self.gwid, self.duration)
         return msg
 
     def unpack(self, buffer):
         try:
-            self.gwid, self.duration = struct.unpack(">BH", buffer)
+            if len(buffer) == 3:
+                self.gwid, self.duration = struct.unpack(">BH", buffer)
+                self.load = 0
+            else:
+                self.gwid, self.duration, self.load = struct.unpack(">BHB", buffer)
             return True
         except struct.error:
             return False
@@ -213,20 +227,40 @@ class MQTTSNMessageConnect(MQTTSNMessage):
             return False
 
 
+# carries an extra trailing byte when the gateway resumed a clean_session=0 session,
+# which is left off otherwise, so plain CONNACKs still work both ways
+# a congested gateway can add how long to wait (in secs) before trying again,
+# at the end of a CONNACK, REGACK or SUBACK. 0 means no hint
 class MQTTSNMessageConnack(MQTTSNMessage):
     def __init__(self, return_code=MQTTSN_RC_ACCEPTED):
         super().__init__()
         self.return_code = return_code
+        self.session_present = 0
+        self.wait_time = 0
 
     def pack(self):
         header = MQTTSNHeader(CONNACK)
-        msg = header.pack(1)
-        msg += struct.pack(">B", self.return_code)
+        if self.wait_time:
+            msg = header.pack(4)
+            msg += struct.pack(">BBH", self.return_code, self.session_present, self.wait_time)
+        elif self.session_present:
+            msg = header.pack(2)
+            msg += struct.pack(">BB", self.return_code, self.session_present)
+        else:
+            msg = header.pack(1)
+            msg += struct.pack(">B", self.return_code)
         return msg
 
     def unpack(self, buffer):
         try:
-            self.return_code = struct.unpack(">B", buffer)[0]
+            self.session_present = 0
+            self.wait_time = 0
+            if len(buffer) == 1:
+                self.return_code = struct.unpack(">B", buffer)[0]
+            elif len(buffer) == 2:
+                self.return_code, self.session_present = struct.unpack(">BB", buffer)
+            else:
+                self.return_code, self.session_present, self.wait_time = struct.unpack(">BBH", buffer)
             return True
         except struct.error:
             return False
@@ -267,17 +301,24 @@ class MQTTSNMessageRegack(MQTTSNMessage):
         self.topic_id = 0
         self.msg_id = 0
         self.return_code = return_code
+        self.wait_time = 0
 
     def pack(self):
         header = MQTTSNHeader(REGACK)
-        msg = header.pack(2 + 2 + 1)
-        msg += struct.pack(">HHB", self.topic_id, self.msg_id, self.return_code)
+        if self.wait_time:
+            msg = header.pack(2 + 2 + 1 + 2)
+            msg += struct.pack(">HHBH", self.topic_id, self.msg_id, self.return_code, self.wait_time)
+        else:
+            msg = header.pack(2 + 2 + 1)
+            msg += struct.pack(">HHB", self.topic_id, self.msg_id, self.return_code)
         return msg
 
     def unpack(self, buffer):
-        fmt = ">HHB"
+        fmt = ">HHB" if len(buffer) <= 5 else ">HHBH"
         try:
-            self.topic_id, self.msg_id, self.return_code = struct.unpack(fmt, buffer)
+            fields = struct.unpack(fmt, buffer)
+            self.topic_id, self.msg_id, self.return_code = fields[:3]
+            self.wait_time = fields[3] if len(fields) > 3 else 0
             return True
         except struct.error:
             return False
@@ -378,19 +419,26 @@ class MQTTSNMessageSuback(MQTTSNMessage):
         self.topic_id = 0
         self.msg_id = 0
         self.return_code = return_code
+        self.wait_time = 0
 
     def pack(self):
         header = MQTTSNHeader(SUBACK)
-        msg = header.pack(1 + 2 + 2 + 1)
-
         flags_bytes = self.flags.pack()
-        msg += struct.pack(">cHHB", flags_bytes, self.topic_id, self.msg_id, self.return_code)
+        if self.wait_time:
+            msg = header.pack(1 + 2 + 2 + 1 + 2)
+            msg += struct.pack(">cHHBH", flags_bytes, self.topic_id, self.msg_id, self.return_code,
+                               self.wait_time)
+        else:
+            msg = header.pack(1 + 2 + 2 + 1)
+            msg += struct.pack(">cHHB", flags_bytes, self.topic_id, self.msg_id, self.return_code)
         return msg
 
     def unpack(self, buffer):
-        fmt = ">cHHB"
+        fmt = ">cHHB" if len(buffer) <= 6 else ">cHHBH"
         try:
-            flags_bytes, self.topic_id, self.msg_id, self.return_code = struct.unpack(fmt, buffer)
+            fields = struct.unpack(fmt, buffer)
+            flags_bytes, self.topic_id, self.msg_id, self.return_code = fields[:4]
+            self.wait_time = fields[4] if len(fields) > 4 else 0
             self.flags = MQTTSNFlags()
             self.flags.unpack(flags_bytes)
             return True
@@ -503,12 +551,44 @@ class MQTTSNMessageDisconnect(MQTTSNMessage):
         # disconnect with duration
         fmt = ">H"
         try:
-            self.duration = struct.unpack(fmt, buffer)
+            self.duration = struct.unpack(fmt, buffer)[0]
             return True
         except struct.error:
             return False
 
 
+# a msg relayed by a forwarder for one of its nodes.
+# the header's length only covers the encapsulation itself, with the msg following on,
+# so unlike the others this unpacks the whole packet, header included
+class MQTTSNMessageEncapsulated(MQTTSNMessage):
+    def __init__(self, node_id=b'', msg=b''):
+        super().__init__()
+        self.radius = 0
+        self.node_id = node_id
+        self.msg = msg
+
+    def pack(self):
+        header = MQTTSNHeader(ENCAPSULATED)
+        msg = header.pack(1 + len(self.node_id))
+        msg += struct.pack(">B{}s".format(len(self.node_id)), self.radius & 0x03, self.node_id)
+        return msg + self.msg
+
+    def unpack(self, buffer):
+        header = MQTTSNHeader()
+        hlen = header.unpack(buffer)
+        if not hlen or header.msg_type != ENCAPSULATED or header.length < 1:
+            return False
+
+        end = hlen + header.length
+        if len(buffer) <= end:
+            return False
+
+        self.radius = buffer[hlen] & 0x03
+        self.node_id = bytes(buffer[hlen + 1:end])
+        self.msg = bytes(buffer[end:])
+        return True
+
+
 if __name__ == "__main__":
     test_objs = [MQTTSNMessageAdvertise, MQTTSNMessageConnack, MQTTSNMessageConnect,
                  MQTTSNMessageDisconnect, MQTTSNMessageGWInfo, MQTTSNMessagePingreq,
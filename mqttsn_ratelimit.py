@@ -0,0 +1,39 @@
+import time
+
+
+# lets through up to `rate` things a sec on average, with bursts of up to `burst` at once.
+# something bigger than a whole burst goes once the bucket's full, leaving it in debt
+class MQTTSNTokenBucket:
+    def __init__(self, rate, burst=0):
+        self.rate = rate
+        self.burst = burst if burst else max(1, rate)
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+        # when everyone we've turned away so far will have had their turn
+        self.deferred_until = 0
+
+    def _refill(self):
+        curr_time = time.time()
+        self.tokens = min(self.burst, self.tokens + (curr_time - self.stamp) * self.rate)
+        self.stamp = curr_time
+
+    def take(self, count=1):
+        self._refill()
+        if self.tokens < min(count, self.burst):
+            return False
+
+        self.tokens -= count
+        return True
+
+    # secs till we could let `count` through
+    def wait_time(self, count=1):
+        self._refill()
+        return max(0.0, (min(count, self.burst) - self.tokens) / self.rate)
+
+    # for something we've turned away, how long it should wait before trying again.
+    # each one gets its own slot, so they come back spread out at our rate instead of all at once
+    def defer(self):
+        curr_time = time.time()
+        self.deferred_until = max(self.deferred_until, curr_time + self.wait_time()) + 1 / self.rate
+        return self.deferred_until - curr_time
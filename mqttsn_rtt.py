@@ -0,0 +1,33 @@
+from mqttsn_defines import *
+import random
+
+
+# smoothed round trip time and its variance for one peer, Jacobson/Karels style,
+# giving how long to wait for a reply before resending
+class MQTTSNRtt:
+    def __init__(self, srtt=0.0, rttvar=0.0):
+        # in secs, 0 till we've timed a reply
+        self.srtt = srtt
+        self.rttvar = rttvar
+        self.rto = MQTTSN_T_RETRY
+        if self.srtt:
+            self._update_rto()
+
+    # only time replies to msgs that weren't resent, else we can't tell which one it answers
+    def update(self, sample):
+        if not self.srtt:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = self.rttvar * 3 / 4 + abs(self.srtt - sample) / 4
+            self.srtt = self.srtt * 7 / 8 + sample / 8
+        self._update_rto()
+
+    def _update_rto(self):
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MQTTSN_MIN_RTO), MQTTSN_MAX_RTO)
+
+    # how long to wait after sending for the given time, doubling with each resend.
+    # it's spread out a little so that peers that lost the same packet don't all resend at once
+    def timeout(self, retries=0):
+        rto = min(self.rto * 2 ** retries, MQTTSN_MAX_RTO)
+        return rto * random.uniform(1 - MQTTSN_RTO_JITTER, 1 + MQTTSN_RTO_JITTER)
@@ -13,3 +13,15 @@ class MQTTSNTransport(abc.ABC):
     @abc.abstractmethod
     def broadcast(self, data: bytes):
         return 0
+
+    # file descriptors to wait on for incoming packets, if any
+    def filenos(self):
+        return []
+
+    # send off anything written so far, for transports that batch their writes
+    def flush(self):
+        return True
+
+    # whether we can write more right now without it piling up, for transports that can back up
+    def writable(self):
+        return True
@@ -0,0 +1,173 @@
+from typing import Dict, List
+
+from mqttsn_transport import MQTTSNTransport
+from mqttsn_ratelimit import MQTTSNTokenBucket
+from mqttsn_defines import *
+import collections
+import logging
+import time
+
+
+# sits in front of another transport, holding back what it can't take yet.
+# each destination gets a queue for each priority class, and control msgs go out ahead of data.
+# destinations take turns, so one with a lot to send can't hold up the rest.
+# sending can also be paced, in bytes/sec (and burst sizes in bytes), over the whole transport
+# and to each destination, so a slow link never gets handed more than it can carry
+class MQTTSNTransportQueued(MQTTSNTransport):
+    def __init__(self, transport: MQTTSNTransport,
+                 max_control=MQTTSN_MAX_QUEUED_CONTROL, max_data=MQTTSN_MAX_QUEUED_DATA,
+                 rate=0, burst=0, dest_rate=0, dest_burst=0):
+        self.transport = transport
+
+        # pacing for the whole transport, and for each destination we're holding back for
+        self.bucket = MQTTSNTokenBucket(rate, burst) if rate else None
+        self.dest_rate = dest_rate
+        self.dest_burst = dest_burst
+        self.dest_buckets: Dict[object, MQTTSNTokenBucket] = {}
+
+        # how deep each class's queue can get, by priority
+        self.depths = (max_control, max_data)
+
+        # queues by destination (None for broadcasts), in the order they need to go round
+        self.queues: Dict[object, List[collections.deque]] = collections.OrderedDict()
+
+        # how many msgs we've had to drop
+        self.shed = 0
+
+    def read_packet(self):
+        return self.transport.read_packet()
+
+    def write_packet(self, data, dest, priority=MQTTSN_PRIORITY_CONTROL):
+        # straight out if nothing's waiting and there's room for it
+        if not self.queues and self._ready(data, dest) and self._send(data, dest):
+            return len(data)
+
+        self._enqueue(data, dest, priority)
+        return len(data)
+
+    def broadcast(self, data, priority=MQTTSN_PRIORITY_CONTROL):
+        return self.write_packet(data, None, priority)
+
+    # whether a msg can go right now, broadcasts only count against the whole transport
+    def _ready(self, data, dest):
+        if not self.transport.writable():
+            return False
+        return not self._pacing_wait(data, dest)
+
+    # how long pacing holds a msg back for
+    def _pacing_wait(self, data, dest):
+        wait = self.bucket.wait_time(len(data)) if self.bucket else 0
+
+        if self.dest_rate and dest is not None:
+            bucket = self.dest_buckets.get(dest)
+            if bucket is None:
+                bucket = self.dest_buckets[dest] = MQTTSNTokenBucket(self.dest_rate, self.dest_burst)
+            wait = max(wait, bucket.wait_time(len(data)))
+
+        return wait
+
+    # 0 if the transport couldn't take it after all, e.g. a full socket buffer
+    def _send(self, data, dest):
+        if dest is None:
+            sent = self.transport.broadcast(data)
+        else:
+            sent = self.transport.write_packet(data, dest)
+        if not sent:
+            return 0
+
+        if self.bucket:
+            self.bucket.take(len(data))
+        if dest in self.dest_buckets:
+            self.dest_buckets[dest].take(len(data))
+        return sent
+
+    def _enqueue(self, data, dest, priority):
+        queues = self.queues.get(dest)
+        if queues is None:
+            queues = self.queues[dest] = [collections.deque() for _ in self.depths]
+
+        # make room by dropping the oldest
+        queue = queues[priority]
+        if len(queue) >= self.depths[priority]:
+            queue.popleft()
+            self.shed += 1
+            logging.debug('Dropped queued msg for {}, {} so far'.format(dest, self.shed))
+
+        queue.append(data)
+
+    # whether there's anything waiting
+    def pending(self):
+        return bool(self.queues)
+
+    # whether what's waiting is waiting on the transport itself, rather than on pacing
+    def backed_up(self):
+        return bool(self.queues) and not self.transport.writable()
+
+    # when pacing next lets something queued go, or None if we're not waiting on pacing
+    def next_deadline(self):
+        if not self.queues or not self.transport.writable():
+            return None
+        if not self.bucket and not self.dest_rate:
+            return None
+
+        waits = []
+        for dest, queues in self.queues.items():
+            data = next(queue[0] for queue in queues if queue)
+            waits.append(self._pacing_wait(data, dest))
+        return time.time() + min(waits)
+
+    # send as much of what's queued as the transport will take
+    def flush(self):
+        while True:
+            sent = self._send_queued()
+
+            # keep going for as long as the transport can get it all out
+            if not self.transport.flush() or not self.queues or not sent:
+                break
+
+        # forget the pacing for destinations that have been quiet long enough to fill back up
+        idle = [dest for dest, bucket in self.dest_buckets.items()
+                if dest not in self.queues and not bucket.wait_time(bucket.burst)]
+        for dest in idle:
+            del self.dest_buckets[dest]
+
+        return not self.queues
+
+    # hand the transport what it'll take, all the control msgs first
+    def _send_queued(self):
+        sent = 0
+        for priority in range(len(self.depths)):
+            while self.queues and self.transport.writable():
+                # a msg for each destination in turn
+                count = sent
+                for dest in list(self.queues):
+                    if not self.transport.writable():
+                        break
+
+                    queues = self.queues[dest]
+                    if queues[priority] and self._ready(queues[priority][0], dest):
+                        # it stays queued if the transport turns it away
+                        if not self._send(queues[priority][0], dest):
+                            break
+                        queues[priority].popleft()
+                        sent += 1
+
+                        # whoever just went goes to the back, so everyone gets a fair turn
+                        self.queues.move_to_end(dest)
+                    if not any(queues):
+                        del self.queues[dest]
+
+                if sent == count:
+                    break
+
+        return sent
+
+    def writable(self):
+        return not self.queues and self.transport.writable()
+
+    def filenos(self):
+        return self.transport.filenos()
+
+    def end(self):
+        self.flush()
+        self.transport.end()
@@ -0,0 +1,173 @@
+from mqttsn_transport import MQTTSNTransport
+import collections
+import logging
+import socket
+import struct
+import os
+
+# frames are a 2 byte length (of everything after it), the node's address, then the msg.
+# the address is who it's from when reading, and who it's for when writing
+MQTTSN_STREAM_LEN_SIZE = 2
+
+# how much we try to read in one go, and how much we buffer before writing anyway
+MQTTSN_STREAM_READ_SIZE = 65536
+MQTTSN_STREAM_WRITE_SIZE = 65536
+
+# how much can be waiting to go out before we count as backed up
+MQTTSN_STREAM_BACKLOG_SIZE = 4096
+
+
+# carries many nodes' packets over one byte stream, e.g. a TCP connection from a concentrator,
+# a pty or a serial port. takes either a socket or a file descriptor.
+# writes are batched till flush(), which the client and gateway loops call when they're done
+class MQTTSNTransportStream(MQTTSNTransport):
+    def __init__(self, stream, addr_len=2):
+        super().__init__()
+
+        self.sock = stream if isinstance(stream, socket.socket) else None
+        self.fd = stream.fileno() if self.sock else stream
+        os.set_blocking(self.fd, False)
+
+        self.addr_len = addr_len
+        self.bcast_addr = b'\xff' * addr_len
+
+        # bytes read but not yet parsed, and whole frames parsed but not yet read
+        self.in_buf = bytearray()
+        self.in_frames = collections.deque()
+
+        # frames waiting to go out
+        self.out_buf = bytearray()
+
+        # set once the other end goes away
+        self.closed = False
+
+    def read_packet(self):
+        if not self.in_frames:
+            self._fill()
+
+        if not self.in_frames:
+            return b'', None
+        return self.in_frames.popleft()
+
+    def _fill(self):
+        if self.closed:
+            return
+
+        try:
+            if self.sock:
+                data = self.sock.recv(MQTTSN_STREAM_READ_SIZE)
+            else:
+                data = os.read(self.fd, MQTTSN_STREAM_READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            # a pty whose other end closed reads as an error, not EOF
+            data = b''
+
+        if not data:
+            self._close()
+            return
+
+        self.in_buf += data
+
+        # pull out every whole frame we've got, leaving any partial one for next time
+        buf = self.in_buf
+        pos = 0
+        while len(buf) - pos >= MQTTSN_STREAM_LEN_SIZE:
+            length = struct.unpack_from('>H', buf, pos)[0]
+            end = pos + MQTTSN_STREAM_LEN_SIZE + length
+            if end > len(buf):
+                break
+
+            start = pos + MQTTSN_STREAM_LEN_SIZE
+            if length > self.addr_len:
+                self.in_frames.append((bytes(buf[start + self.addr_len:end]),
+                                       bytes(buf[start:start + self.addr_len])))
+            pos = end
+
+        del buf[:pos]
+
+    def write_packet(self, data, dest):
+        # length + address + data
+        self.out_buf += struct.pack('>H', self.addr_len + len(data))
+        self.out_buf += dest[:self.addr_len].rjust(self.addr_len, b'\x00')
+        self.out_buf += data
+
+        if len(self.out_buf) >= MQTTSN_STREAM_WRITE_SIZE:
+            self.flush()
+        return len(data)
+
+    def broadcast(self, data):
+        return self.write_packet(data, self.bcast_addr)
+
+    # write out as much of what's buffered as the stream will take right now
+    def flush(self):
+        while self.out_buf and not self.closed:
+            try:
+                if self.sock:
+                    sent = self.sock.send(self.out_buf)
+                else:
+                    sent = os.write(self.fd, self.out_buf)
+            except (BlockingIOError, InterruptedError):
+                return False
+            except OSError:
+                self._close()
+                return False
+
+            del self.out_buf[:sent]
+
+        return not self.out_buf
+
+    # the other end's gone, anything still buffered for it is dropped
+    def _close(self):
+        self.closed = True
+        self.out_buf.clear()
+        logging.debug('Stream on fd {} closed by the other end.'.format(self.fd))
+
+    def writable(self):
+        return not self.closed and len(self.out_buf) < MQTTSN_STREAM_BACKLOG_SIZE
+
+    # nothing to wait on once the other end's gone, else we'd keep waking up to read nothing
+    def filenos(self):
+        return [] if self.closed else [self.fd]
+
+    def end(self):
+        self.flush()
+        if self.sock:
+            self.sock.close()
+        else:
+            os.close(self.fd)
+
+
+if __name__ == '__main__':
+    import select
+    import time
+
+    # push a burst of packets from many nodes through a socketpair, and time it
+    a, b = socket.socketpair()
+    concentrator = MQTTSNTransportStream(a)
+    gateway = MQTTSNTransportStream(b)
+
+    count = 100000
+    recvd = 0
+    start = time.time()
+    for i in range(count):
+        concentrator.write_packet(b'\x07\x0c' + struct.pack('>I', i), struct.pack('>H', i % 1000))
+
+        # keep the pipe moving
+        if i % 1000 == 999:
+            concentrator.flush()
+            while gateway.read_packet()[0]:
+                recvd += 1
+
+    while recvd < count:
+        concentrator.flush()
+        select.select(gateway.filenos(), [], [], 1)
+        while gateway.read_packet()[0]:
+            recvd += 1
+
+    elapsed = time.time() - start
+    print('{} packets in {:.3f} secs, {:.0f} packets/sec'.format(recvd, elapsed, recvd / elapsed))
+
+    concentrator.end()
+    gateway.end()
@@ -1,50 +1,148 @@
 from mqttsn_transport import MQTTSNTransport
-from mqttsn_defines import MQTTSN_MAX_MSG_LEN
+import errno
+import ipaddress
+import select
 import socket
+import struct
 
 # to do: listen on broadcast
 
+# room for the biggest datagram we expect, forwarder encapsulation included
+MQTTSN_UDP_READ_SIZE = 1024
 
+
+# every datagram carries the sender's and receiver's addresses ahead of the msg.
+# addresses can be any length, as long as every node uses the same
 class MQTTSNTransportUDP(MQTTSNTransport):
-    def __init__(self, _port, own_addr):
+    def __init__(self, _port, own_addr, unicast_port=None,
+                 multicast_group=None, multicast_ttl=1, multicast_loop=True):
         super().__init__()
 
+        # an IPv6 group takes IPv6 sockets all round
+        group = ipaddress.ip_address(multicast_group) if multicast_group else None
+        self.family = socket.AF_INET6 if group and group.version == 6 else socket.AF_INET
+        any_addr = '::' if self.family == socket.AF_INET6 else ''
+
         # Create a TCP/IP socket
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock = socket.socket(self.family, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         self.sock.setblocking(False)
 
         # Bind the socket to the port
         self.own_addr = own_addr
+        self.bcast_addr = b'\xff' * len(own_addr)
         self.to_addr = ('<broadcast>', _port)
-        self.sock.bind(('', _port))
+        self.sock.bind((any_addr, _port))
+
+        # with a unicast port (0 picks any free one), we send everything from a socket of our own,
+        # so whoever hears from us learns where to reach us directly
+        self.ucast_sock = None
+        if unicast_port is not None:
+            self.ucast_sock = socket.socket(self.family, socket.SOCK_DGRAM)
+            self.ucast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            self.ucast_sock.setblocking(False)
+            self.ucast_sock.bind((any_addr, unicast_port))
+
+        # with a multicast group, broadcasts only go to nodes that joined it
+        if group:
+            self.to_addr = (str(group), _port)
+            self._join_group(group, multicast_ttl, multicast_loop)
+
+        # (ip, port) of each node we've heard from, by address
+        self.endpoints = {}
+
+        # set when the socket buffer's full, till it has room again
+        self.blocked = False
 
     def read_packet(self):
-        try:
-            data, address = self.sock.recvfrom(MQTTSN_MAX_MSG_LEN)
-        except OSError:
-            return b'', None
+        for sock in self._socks():
+            while True:
+                try:
+                    data, address = sock.recvfrom(MQTTSN_UDP_READ_SIZE)
+                except OSError:
+                    break
+
+                pkt, from_addr = self._parse(data, address)
+                if pkt:
+                    return pkt, from_addr
 
-        # make sure its for us or a broadcast, and that we didnt send it either
-        if data[1:2] in (self.own_addr, b'\xff') and data[0:1] != self.own_addr:
-            return data[2:], data[0:1]
         return b'', None
 
+    def _parse(self, data, address):
+        n = len(self.own_addr)
+        from_addr, to_addr = data[:n], data[n:2 * n]
+
+        # make sure its for us or a broadcast, and that we didnt send it either
+        if to_addr not in (self.own_addr, self.bcast_addr) or from_addr == self.own_addr:
+            return b'', None
+
+        # unicast nodes send everything from their own socket, so this is where to reach them
+        if self.ucast_sock:
+            self.endpoints[from_addr] = address
+        return data[2 * n:], from_addr
+
     def write_packet(self, data, dest):
         # from + to + data
         data = self.own_addr + dest + data
-        self.sock.sendto(data, self.to_addr)
-        return len(data)
+
+        # straight to the node if we know where it is, else everyone gets it
+        endpoint = self.endpoints.get(dest)
+        if endpoint:
+            return self._sendto(self.ucast_sock, data, endpoint)
+        return self._sendto(self._send_sock(), data, self.to_addr)
 
     def broadcast(self, data):
         # from + to + data
-        data = self.own_addr + b'\xff' + data
-        self.sock.sendto(data, self.to_addr)
+        data = self.own_addr + self.bcast_addr + data
+        return self._sendto(self._send_sock(), data, self.to_addr)
+
+    # 0 if the socket buffer's full, so whoever's sending can hold on to it and try later
+    def _sendto(self, sock, data, address):
+        try:
+            sock.sendto(data, address)
+        except (BlockingIOError, InterruptedError):
+            self.blocked = True
+            return 0
+        except OSError as e:
+            if e.errno != errno.ENOBUFS:
+                raise
+            self.blocked = True
+            return 0
         return len(data)
 
+    def writable(self):
+        if self.blocked:
+            _, ready, _ = select.select([], [self._send_sock()], [], 0)
+            self.blocked = not ready
+        return not self.blocked
+
+    def _join_group(self, group, ttl, loop):
+        if group.version == 6:
+            mreq = group.packed + struct.pack('@I', 0)
+            self.sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, mreq)
+            for sock in self._socks():
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_HOPS, ttl)
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_LOOP, int(loop))
+        else:
+            mreq = group.packed + struct.pack('=I', socket.INADDR_ANY)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+            for sock in self._socks():
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, int(loop))
+
+    def _send_sock(self):
+        return self.ucast_sock if self.ucast_sock else self.sock
+
+    def _socks(self):
+        return [self.sock, self.ucast_sock] if self.ucast_sock else [self.sock]
+
+    def filenos(self):
+        return [sock.fileno() for sock in self._socks()]
+
     def end(self):
-        self.sock.close()
+        for sock in self._socks():
+            sock.close()
 
 
 if __name__ == '__main__':
@@ -62,7 +160,7 @@ if __name__ == '__main__':
             while True:
                 read, addr = clnt.read_packet()
                 if read:
-                    print("Recvd: ", read.decode(), "from", addr.bytes)
+                    print("Recvd: ", read.decode(), "from", addr)
                     break
         except KeyboardInterrupt:
             clnt.end()
@@ -24,8 +24,7 @@ clnt.connect(gwid=1)
 
 # wait till we're connected
 while not clnt.is_connected() or clnt.state == MQTTSNState.CONNECTING:
-    time.sleep(0.05)
-    clnt.loop()
+    clnt.loop(timeout=1)
 
 # pub and sub topics
 sub_topics = [MQTTSNSubTopic(b'state')]
@@ -48,13 +47,10 @@ clnt.on_message(message_callback)
 
 
 def init_tasks():
-    if not clnt.register_topics(pub_topics):
-        return False
-
-    if not clnt.subscribe_topics(sub_topics):
-        return False
-
-    return True
+    # both get pipelined, so they complete together
+    registered = clnt.register_topics(pub_topics)
+    subscribed = clnt.subscribe_topics(sub_topics)
+    return registered and subscribed
 
 
 last_publish = time.time()
@@ -62,8 +58,8 @@ last_publish = time.time()
 print('Entering client loop.')
 while True:
     try:
-        time.sleep(0.05)
-        clnt.loop()
+        # sleep till there's something to do, or it's time to publish
+        clnt.loop(timeout=last_publish + 5 - time.time())
 
         if clnt.state in (MQTTSNState.DISCONNECTED, MQTTSNState.LOST):
             print("Gateway connection lost.")
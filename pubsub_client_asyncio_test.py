@@ -0,0 +1,51 @@
+from mqttsn_transport_udp import MQTTSNTransportUDP
+from mqttsn_client import MQTTSNGWInfo, MQTTSNPubTopic, MQTTSNSubTopic
+from mqttsn_client_asyncio import MQTTSNClientAsync
+import asyncio
+import logging
+import sys
+
+
+logging.basicConfig(stream=sys.stdout, format='[+]%(message)s', level=logging.DEBUG)
+
+# list of gateways
+gateways = [MQTTSNGWInfo(1, b'\x01')]
+
+# setup transport info
+port = 20000
+transport = MQTTSNTransportUDP(port, b'\x05')
+
+
+async def toggle_led(clnt: MQTTSNClientAsync):
+    led_state = bytearray([0])
+
+    # toggle led state and publish every 5 secs
+    while True:
+        await asyncio.sleep(5)
+        led_state[0] ^= 1
+        await clnt.publish(b'led', led_state)
+
+
+async def main():
+    print("Starting client.")
+
+    # create client and connect, each retry waits out the client's backoff first
+    clnt = MQTTSNClientAsync(b'AsyncClient', transport)
+    clnt.add_gateways(gateways)
+    while not await clnt.connect(gwid=1):
+        print("Gateway connection failed.")
+
+    # pub and sub topics, all sent off together
+    await asyncio.gather(clnt.register(MQTTSNPubTopic(b'led')),
+                         clnt.subscribe(MQTTSNSubTopic(b'button')))
+
+    print('Entering client loop.')
+    asyncio.create_task(toggle_led(clnt))
+    async for topic, data, flags in clnt.messages():
+        print('Topic: {}, Data: {}, Flags: {}'.format(topic, data, flags.union))
+
+
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    transport.end()
@@ -1,7 +1,6 @@
 from mqttsn_transport_udp import MQTTSNTransportUDP
 from mqttsn_client import MQTTSNClient, MQTTSNState, MQTTSNGWInfo, MQTTSNPubTopic, MQTTSNSubTopic
 from mqttsn_messages import MQTTSNFlags
-import time
 import logging
 import sys
 
@@ -24,8 +23,7 @@ clnt.connect(gwid=1)
 
 # wait till we're connected
 while not clnt.is_connected() or clnt.state == MQTTSNState.CONNECTING:
-    time.sleep(0.05)
-    clnt.loop()
+    clnt.loop(timeout=1)
 
 # pub and sub topics
 sub_topics = [MQTTSNSubTopic(b'led')]
@@ -49,20 +47,16 @@ clnt.on_message(message_callback)
 
 
 def init_tasks():
-    if not clnt.register_topics(pub_topics):
-        return False
-
-    if not clnt.subscribe_topics(sub_topics):
-        return False
-
-    return True
+    # both get pipelined, so they complete together
+    registered = clnt.register_topics(pub_topics)
+    subscribed = clnt.subscribe_topics(sub_topics)
+    return registered and subscribed
 
 
 print('Entering client loop.')
 while True:
     try:
-        time.sleep(0.05)
-        clnt.loop()
+        clnt.loop(timeout=None)
 
         if clnt.state in (MQTTSNState.DISCONNECTED, MQTTSNState.LOST):
             print("Gateway connection lost.")
@@ -0,0 +1,52 @@
+from mqttsn_transport import MQTTSNTransport
+import collections
+import pytest
+
+
+# a broadcast medium in memory, every transport on it gets what's sent to its address
+class FakeNet:
+    def __init__(self):
+        self.nodes = {}
+        self.log = []
+        self.down = set()
+
+    def transport(self, addr):
+        return FakeTransport(self, addr)
+
+    def deliver(self, src, dest, data):
+        self.log.append((src, dest, bytes(data)))
+        for addr, node in self.nodes.items():
+            if addr == src or addr in self.down:
+                continue
+            if dest is None or dest == addr:
+                node.inbox.append((bytes(data), src))
+
+    # msg types sent to an address so far
+    def sent_to(self, dest):
+        return [data[1] for _, to, data in self.log if to == dest]
+
+
+class FakeTransport(MQTTSNTransport):
+    def __init__(self, net, addr):
+        self.net = net
+        self.addr = addr
+        self.inbox = collections.deque()
+        net.nodes[addr] = self
+
+    def read_packet(self):
+        if self.inbox:
+            return self.inbox.popleft()
+        return b'', None
+
+    def write_packet(self, data, dest):
+        self.net.deliver(self.addr, dest, data)
+        return len(data)
+
+    def broadcast(self, data):
+        self.net.deliver(self.addr, None, data)
+        return len(data)
+
+
+@pytest.fixture
+def net():
+    return FakeNet()
@@ -0,0 +1,137 @@
+from mqttsn_client import *
+import mqttsn_client
+import pytest
+
+GW_ADDR = b'\x01'
+CLIENT_ADDR = b'\x02'
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(mqttsn_client.time, 'time', lambda: now[0])
+    return now
+
+
+# a client with a registered topic, talking to a gateway we play by hand
+@pytest.fixture
+def setup(net, clock):
+    gw = net.transport(GW_ADDR)
+    client = MQTTSNClient(b'c1', net.transport(CLIENT_ADDR), publish_window=2)
+    client.add_gateways([MQTTSNGWInfo(1, GW_ADDR)])
+    client.connect(1)
+    gw.write_packet(MQTTSNMessageConnack().pack(), CLIENT_ADDR)
+    client.loop()
+
+    client.register(MQTTSNPubTopic(b'a'))
+    msg_id, = client.transactions
+    msg = MQTTSNMessageRegack()
+    msg.msg_id = msg_id
+    msg.topic_id = 5
+    gw.write_packet(msg.pack(), CLIENT_ADDR)
+    client.loop()
+    assert client.pub_by_name[b'a'].tid == 5
+
+    drain(gw)
+    return client, gw
+
+
+def drain(gw):
+    while gw.read_packet()[0]:
+        pass
+
+
+def qos1():
+    flags = MQTTSNFlags()
+    flags.qos = 1
+    return flags
+
+
+def received(gw):
+    msgs = []
+    while True:
+        pkt, _ = gw.read_packet()
+        if not pkt:
+            return msgs
+        msg = MQTTSNMessagePublish()
+        assert pkt[1] == PUBLISH and msg.unpack(pkt[MQTTSN_HEADER_LEN:])
+        msgs.append(msg)
+
+
+def puback(gw, msg_id):
+    msg = MQTTSNMessagePuback()
+    msg.msg_id = msg_id
+    msg.topic_id = 5
+    gw.write_packet(msg.pack(), CLIENT_ADDR)
+
+
+def test_window(setup):
+    client, gw = setup
+    done = []
+    for i in range(4):
+        assert client.publish(b'a', b'%d' % i, qos1(), lambda ok, i=i: done.append((i, ok)))
+
+    # only as many as the window takes go out, the rest wait their turn
+    sent = received(gw)
+    assert [msg.data for msg in sent] == [b'0', b'1']
+    assert client.publish_inflight == 2
+    assert len(client.offline_pubs) == 2
+
+    # each ack lets the next one go, in order
+    puback(gw, sent[0].msg_id)
+    client.loop()
+    assert done == [(0, True)]
+    assert [msg.data for msg in received(gw)] == [b'2']
+
+    # QoS 0 doesn't need room in the window, but still goes behind what's held for its topic
+    assert client.publish(b'a', b'q0')
+    assert len(client.offline_pubs) == 2
+
+    puback(gw, sent[1].msg_id)
+    client.loop()
+    assert [msg.data for msg in received(gw)] == [b'3', b'q0']
+    assert not client.offline_pubs
+
+
+def test_dup_retransmit(setup, clock):
+    client, gw = setup
+    done = []
+    client.publish(b'a', b'x', qos1(), done.append)
+    first, = received(gw)
+    assert not first.flags.dup
+
+    # no ack in time, so it goes again as a duplicate, same msg ID
+    transaction = client.transactions[first.msg_id]
+    clock[0] += transaction.timeout + 0.1
+    client.loop()
+    again, = received(gw)
+    assert again.flags.dup
+    assert (again.msg_id, again.data) == (first.msg_id, b'x')
+    assert transaction.counter == 1
+
+    puback(gw, first.msg_id)
+    client.loop()
+    assert done == [True]
+    assert client.publish_inflight == 0
+
+
+def test_unacked_go_again_after_reconnect(setup):
+    client, gw = setup
+    client.publish(b'a', b'x', qos1())
+    received(gw)
+
+    # the session's kept, so it goes again as it was, not as a duplicate
+    client.disconnect()
+    assert client.publish_inflight == 0
+    assert [entry[1] for entry in client.offline_pubs] == [b'x']
+
+    client.connect(1)
+    msg = MQTTSNMessageConnack()
+    msg.session_present = 1
+    drain(gw)
+    gw.write_packet(msg.pack(), CLIENT_ADDR)
+    client.loop()
+
+    resent, = received(gw)
+    assert resent.data == b'x' and not resent.flags.dup
+    assert client.publish_inflight == 1
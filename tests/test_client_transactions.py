@@ -0,0 +1,111 @@
+from mqttsn_client import *
+import pytest
+
+GW_ADDR = b'\x01'
+CLIENT_ADDR = b'\x02'
+
+
+# a client talking to a gateway we play by hand
+@pytest.fixture
+def setup(net):
+    gw = net.transport(GW_ADDR)
+    client = MQTTSNClient(b'c1', net.transport(CLIENT_ADDR))
+    client.add_gateways([MQTTSNGWInfo(1, GW_ADDR)])
+    client.connect(1)
+
+    gw.write_packet(MQTTSNMessageConnack().pack(), CLIENT_ADDR)
+    client.loop()
+    assert client.is_connected()
+    return client, gw
+
+
+def regack(msg_id, return_code=MQTTSN_RC_ACCEPTED, topic_id=0, wait_time=0):
+    msg = MQTTSNMessageRegack(return_code)
+    msg.msg_id = msg_id
+    msg.topic_id = topic_id
+    msg.wait_time = wait_time
+    return msg.pack()
+
+
+def test_msg_ids_skip_zero_and_inflight(setup):
+    client, gw = setup
+
+    # wraps round past 0xFFFF, never using 0
+    client.curr_msg_id = 0xFFFD
+    topics = [MQTTSNPubTopic(name) for name in (b'a', b'b', b'c')]
+    client.register_topics(topics)
+    assert sorted(client.transactions) == [1, 0xFFFE, 0xFFFF]
+
+    # answer one, the others still hold their IDs
+    gw.write_packet(regack(0xFFFF, topic_id=7), CLIENT_ADDR)
+    client.loop()
+    assert topics[1].tid == 7
+    assert sorted(client.transactions) == [1, 0xFFFE]
+
+    client.curr_msg_id = 0xFFFD
+    assert client._next_msg_id() == 0xFFFF
+    assert client._next_msg_id() == 2
+
+
+def test_rejected_register(setup):
+    client, gw = setup
+    done = []
+    topic = MQTTSNPubTopic(b'a')
+    assert client.register(topic, done.append)
+    msg_id, = client.transactions
+
+    gw.write_packet(regack(msg_id, MQTTSN_RC_NOTSUPPORTED, topic_id=7), CLIENT_ADDR)
+    client.loop()
+
+    # the caller hears about it, the topic stays unassigned, and the gateway's still fine
+    assert done == [False]
+    assert topic.tid == MQTTSN_TOPIC_NOTASSIGNED
+    assert not client.transactions
+    assert client.is_connected()
+
+
+def test_rejected_subscribe(setup):
+    client, gw = setup
+    done = []
+    topic = MQTTSNSubTopic(b's')
+    assert client.subscribe(topic, done.append)
+    msg_id, = client.transactions
+
+    msg = MQTTSNMessageSuback(MQTTSN_RC_NOTSUPPORTED)
+    msg.msg_id = msg_id
+    msg.topic_id = 9
+    gw.write_packet(msg.pack(), CLIENT_ADDR)
+    client.loop()
+
+    assert done == [False]
+    assert topic.tid == MQTTSN_TOPIC_NOTASSIGNED
+    assert 9 not in client.sub_by_tid
+    assert not client.transactions
+    assert client.is_connected()
+
+
+def test_congestion_without_hint(setup):
+    client, gw = setup
+    done = []
+    topic = MQTTSNPubTopic(b'a')
+    client.register(topic, done.append)
+    msg_id, = client.transactions
+    transaction = client.transactions[msg_id]
+
+    # each one backs off further, and doesn't count as a retry
+    timeouts = []
+    for _ in range(MQTTSN_N_RETRY):
+        gw.write_packet(regack(msg_id, MQTTSN_RC_CONGESTION), CLIENT_ADDR)
+        client.loop()
+        assert client.transactions[msg_id] is transaction
+        assert transaction.counter == -1
+        timeouts.append(transaction.timeout)
+    assert timeouts == sorted(timeouts)
+    assert timeouts[-1] > MQTTSN_T_RETRY
+
+    # till we give up on it, without giving up on the gateway
+    gw.write_packet(regack(msg_id, MQTTSN_RC_CONGESTION), CLIENT_ADDR)
+    client.loop()
+    assert done == [False]
+    assert not client.transactions
+    assert client.is_connected()
@@ -0,0 +1,126 @@
+from mqttsn_client import *
+from mqttsn_gateway import MQTTSNGateway, MQTTSNForwardedAddress
+from mqttsn_transport import MQTTSNTransport
+import collections
+import pytest
+
+GW_ADDR = b'\x01'
+FW_ADDR = b'\x09'
+
+
+# stands in for a forwarder: wraps up whatever its nodes send, and unwraps replies for them
+class Forwarder:
+    def __init__(self, net):
+        self.transport = net.transport(FW_ADDR)
+        self.inboxes = {}
+
+    def node(self, node_id):
+        self.inboxes[node_id] = collections.deque()
+        return ForwardedNode(self, node_id)
+
+    def relay(self):
+        while True:
+            pkt, from_addr = self.transport.read_packet()
+            if not pkt:
+                return
+
+            assert pkt[1] == ENCAPSULATED
+            msg = MQTTSNMessageEncapsulated()
+            assert msg.unpack(pkt)
+            self.inboxes[msg.node_id].append((msg.msg, from_addr))
+
+
+class ForwardedNode(MQTTSNTransport):
+    def __init__(self, forwarder, node_id):
+        self.forwarder = forwarder
+        self.node_id = node_id
+
+    def read_packet(self):
+        inbox = self.forwarder.inboxes[self.node_id]
+        if inbox:
+            return inbox.popleft()
+        return b'', None
+
+    def write_packet(self, data, dest):
+        return self.forwarder.transport.write_packet(MQTTSNMessageEncapsulated(self.node_id, data).pack(), dest)
+
+    def broadcast(self, data):
+        return self.forwarder.transport.broadcast(MQTTSNMessageEncapsulated(self.node_id, data).pack())
+
+
+@pytest.fixture
+def setup(net):
+    gw = MQTTSNGateway(1, None, net.transport(GW_ADDR), advertise_interval=0)
+    forwarder = Forwarder(net)
+    return gw, forwarder
+
+
+def run(gw, forwarder, clients):
+    for _ in range(4):
+        gw.loop()
+        forwarder.relay()
+        for client in clients:
+            client.loop()
+
+
+def test_encapsulated_round_trip():
+    msg = MQTTSNMessageEncapsulated(b'\xaa\x01', MQTTSNMessagePingreq().pack())
+    msg.radius = 1
+    raw = msg.pack()
+    assert raw[:3] == bytes([5, ENCAPSULATED, 1])
+
+    out = MQTTSNMessageEncapsulated()
+    assert out.unpack(raw)
+    assert (out.radius, out.node_id, out.msg) == (1, b'\xaa\x01', MQTTSNMessagePingreq().pack())
+
+    # nothing inside, nothing to relay
+    assert not MQTTSNMessageEncapsulated().unpack(raw[:5])
+
+
+def test_nodes_behind_forwarder(net, setup):
+    gw, forwarder = setup
+    clients = []
+    for node_id in (b'\xaa\x01', b'\xaa\x02'):
+        client = MQTTSNClient(b'node' + node_id, forwarder.node(node_id))
+        client.add_gateways([MQTTSNGWInfo(1, GW_ADDR)])
+        client.connect(1)
+        clients.append(client)
+    run(gw, forwarder, clients)
+
+    # one session each, both reached through the forwarder
+    assert all(client.is_connected() for client in clients)
+    addrs = {clnt.address for clnt in gw.clients if clnt}
+    assert addrs == {MQTTSNForwardedAddress(FW_ADDR, b'\xaa\x01'), MQTTSNForwardedAddress(FW_ADDR, b'\xaa\x02')}
+
+    # and topics work as they would for any other client
+    got = []
+    sub = MQTTSNSubTopic(b's')
+    clients[1].subscribe(sub)
+    clients[1].on_message(lambda topic, data, flags: got.append(data))
+    pub = MQTTSNPubTopic(b'p')
+    clients[0].register(pub)
+    run(gw, forwarder, clients)
+    assert sub.tid and pub.tid
+
+    gw._handle_mqtt_publish(b's', b'hi', MQTTSNFlags())
+    run(gw, forwarder, clients)
+    assert got == [b'hi']
+
+    # everything the gateway sent went to the forwarder, wrapped up
+    sent = [(dest, data) for src, dest, data in net.log if src == GW_ADDR]
+    assert sent and all(dest == FW_ADDR and data[1] == ENCAPSULATED for dest, data in sent)
+
+
+def test_searchgw_behind_forwarder(setup):
+    gw, forwarder = setup
+    node = forwarder.node(b'\xaa\x01')
+    node.broadcast(MQTTSNMessageSearchGW().pack())
+    gw.loop()
+    forwarder.relay()
+
+    # the node can't hear broadcasts, so it gets its own GWINFO
+    pkt, from_addr = node.read_packet()
+    msg = MQTTSNMessageGWInfo()
+    assert from_addr == GW_ADDR
+    assert pkt[1] == GWINFO and msg.unpack(pkt[MQTTSN_HEADER_LEN:])
+    assert msg.gwid == 1
@@ -0,0 +1,163 @@
+from mqtt_client_asyncio import *
+import pytest
+
+
+class Broker:
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.conns = []
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        threading.Thread(target=self._run, args=(ready,), daemon=True).start()
+        ready.wait()
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+
+        def factory():
+            conn = self.protocol()
+            self.conns.append(conn)
+            return conn
+
+        self.server = self.loop.run_until_complete(self.loop.create_server(factory, '127.0.0.1', 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        ready.set()
+        self.loop.run_forever()
+
+    # drop the latest client connection, as if the network went
+    def drop(self):
+        self.loop.call_soon_threadsafe(self.conns[-1].transport.abort)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+# keeps every PUBLISH it gets, and only acks them while told to
+class RecordingBroker(StandInBroker):
+    publishes = []
+    ack = True
+
+    def __init__(self):
+        super().__init__()
+        self.frames = MQTTPacketReader()
+
+    def data_received(self, data):
+        for ptype, flags, body in self.frames.feed(data):
+            if ptype == PUBLISH:
+                self.publishes.append((flags, body))
+                if not self.ack:
+                    continue
+            super().data_received(pack_packet(ptype, flags, body))
+
+
+@pytest.fixture(autouse=True)
+def reset_broker():
+    StandInBroker.subs.clear()
+    StandInBroker.receive_max = 0
+    RecordingBroker.publishes = []
+    RecordingBroker.ack = True
+
+
+def start_client(broker, version=MQTT_V311):
+    state = {'connected': False, 'recvd': []}
+    clnt = MQTTClientAsyncio('127.0.0.1', broker.port, cid='test', version=version)
+    clnt.register_handlers(lambda connected: state.update(connected=connected),
+                           lambda topic, payload, flags: state['recvd'].append((topic, payload)))
+    clnt.connect()
+    return clnt, state
+
+
+def wait_for(clnt, cond, timeout=5):
+    end = time.time() + timeout
+    while not cond() and time.time() < end:
+        clnt.loop(timeout=0.05)
+    return cond()
+
+
+def test_parse_properties():
+    props = encode_length(15) + b'\x11\x00\x00\x00\x3c' + b'\x21\x00\x05' + b'\x1f\x00\x02ab' + b'\x25\x01'
+    assert parse_properties(b'\x00\x00' + props, 2) == {0x11: 60, MQTT_PROP_RECEIVE_MAX: 5, 0x25: 1}
+
+
+def test_sub_packet_ids_are_reserved():
+    clnt = MQTTClientAsyncio('127.0.0.1', 0)
+    clnt.aloop = asyncio.new_event_loop()
+    clnt.connected = True
+
+    clnt._subscribe(b'a', 1)
+    clnt._unsubscribe(b'b')
+    assert clnt.pending_ids == {1, 2}
+
+    # wraps round, but skips the IDs still awaiting acks
+    clnt.curr_packet_id = 0
+    clnt._publish(b'a', b'x', 1, False)
+    assert list(clnt.inflight) == [3]
+
+    clnt._handle_packet(SUBACK, 0, b'\x00\x01\x01')
+    clnt._handle_packet(UNSUBACK, 0, b'\x00\x02')
+    assert not clnt.pending_ids
+    clnt.aloop.close()
+
+
+def test_publish_acked():
+    broker = Broker(StandInBroker)
+    clnt, state = start_client(broker)
+    assert wait_for(clnt, lambda: state['connected'])
+
+    clnt.subscribe(b'led', 1)
+    for i in range(500):
+        clnt.publish(b'led', struct.pack('>I', i), qos=1)
+
+    assert wait_for(clnt, lambda: len(state['recvd']) == 500 and not clnt.inflight and not clnt.waiting)
+    assert [payload for _, payload in state['recvd']] == [struct.pack('>I', i) for i in range(500)]
+    assert not clnt.pending_ids
+
+    clnt.disconnect()
+    broker.stop()
+
+
+def test_receive_max():
+    StandInBroker.receive_max = 5
+    RecordingBroker.ack = False
+    broker = Broker(RecordingBroker)
+    clnt, state = start_client(broker, MQTT_V5)
+    assert wait_for(clnt, lambda: state['connected'])
+
+    for i in range(20):
+        clnt.publish(b'led', bytes([i]), qos=1)
+
+    # nothing's acked, so only the first 5 go out
+    assert wait_for(clnt, lambda: len(RecordingBroker.publishes) == 5)
+    time.sleep(0.1)
+    assert clnt.receive_max == 5
+    assert len(RecordingBroker.publishes) == 5
+    assert len(clnt.inflight) == 5 and len(clnt.waiting) == 15
+
+    clnt.disconnect()
+    broker.stop()
+
+
+def test_reconnect_resends_unacked():
+    RecordingBroker.ack = False
+    broker = Broker(RecordingBroker)
+    clnt, state = start_client(broker)
+    assert wait_for(clnt, lambda: state['connected'])
+
+    clnt.publish(b'led', b'\x01', qos=1)
+    assert wait_for(clnt, lambda: len(RecordingBroker.publishes) == 1)
+    flags, body = RecordingBroker.publishes[0]
+    assert not flags & 0x08
+
+    # once it's back, the same msg goes again, marked as a resend, and this time it's acked
+    RecordingBroker.ack = True
+    broker.drop()
+    assert wait_for(clnt, lambda: not state['connected'])
+    assert wait_for(clnt, lambda: state['connected'])
+    assert wait_for(clnt, lambda: not clnt.inflight)
+
+    flags, resent = RecordingBroker.publishes[1]
+    assert flags & 0x08
+    assert resent == body
+
+    clnt.disconnect()
+    broker.stop()
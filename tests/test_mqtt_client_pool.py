@@ -0,0 +1,103 @@
+from mqtt_client import MQTTClient
+from mqtt_client_pool import MQTTClientPool
+import collections
+import pytest
+
+TOPICS = [b't/%d' % i for i in range(2000)]
+
+
+# a broker connection that just notes what it's asked to do
+class FakeClient(MQTTClient):
+    def __init__(self):
+        self.conn_cb = None
+        self.subs = set()
+        self.pubs = []
+
+    def register_handlers(self, conn_disconn_cb, msg_cb):
+        self.conn_cb = conn_disconn_cb
+
+    def publish(self, topic, data, qos=0, retain=False):
+        self.pubs.append(topic)
+        return True
+
+    def subscribe(self, topic, qos=0):
+        self.subs.add(topic)
+
+    def unsubscribe(self, topic):
+        self.subs.discard(topic)
+
+
+@pytest.fixture
+def pool():
+    clients = [FakeClient() for _ in range(4)]
+    pool = MQTTClientPool(clients)
+    states = []
+    pool.register_handlers(states.append, None)
+    for clnt in clients:
+        clnt.conn_cb(True)
+    assert states == [True]
+    return pool
+
+
+def test_shards_are_stable():
+    clients = [FakeClient() for _ in range(4)]
+    pool = MQTTClientPool(clients)
+
+    # the same topic always goes the same way, even from another pool, and they all get some
+    homes = [clients.index(pool.client_for(topic)) for topic in TOPICS]
+    assert homes == [clients.index(MQTTClientPool(clients).client_for(topic)) for topic in TOPICS]
+    counts = collections.Counter(homes)
+    assert all(counts[i] > len(TOPICS) / 8 for i in range(4))
+
+    # losing a connection only moves its own topics
+    smaller = MQTTClientPool(clients[:3])
+    moved = [home for topic, home in zip(TOPICS, homes) if clients.index(smaller.client_for(topic)) != home]
+    assert set(moved) == {3}
+    assert len(moved) == counts[3]
+
+
+def test_reroute_while_down(pool):
+    topics = TOPICS[:40]
+    for topic in topics:
+        pool.subscribe(topic)
+    homes = {topic: pool.client_for(topic) for topic in topics}
+    for clnt in pool.clients:
+        assert clnt.subs == {topic for topic in topics if homes[topic] is clnt}
+
+    # its subs move to the others, everyone else's stay put
+    down = pool.clients[0]
+    assert down.subs
+    down.conn_cb(False)
+    assert pool.connected
+    ups = pool.clients[1:]
+    assert set().union(*(clnt.subs for clnt in ups)) == set(topics)
+    for clnt in ups:
+        assert {topic for topic in topics if homes[topic] is clnt} <= clnt.subs
+
+    # and so do its publishes
+    for topic in topics:
+        pool.publish(topic, b'x')
+    assert not down.pubs
+    for clnt in ups:
+        assert set(clnt.pubs) == {topic for topic in clnt.subs}
+
+    # once it's back, they all go home
+    down.subs.clear()
+    down.conn_cb(True)
+    for clnt in pool.clients:
+        assert clnt.subs == {topic for topic in topics if homes[topic] is clnt}
+
+
+def test_all_down(pool):
+    states = []
+    pool.broker_conn_cb = states.append
+    for clnt in pool.clients:
+        clnt.conn_cb(False)
+    assert states == [False]
+    assert pool.publish(b'a', b'x') is None
+
+    # subs made meanwhile go out once there's somewhere to put them
+    pool.subscribe(b'a')
+    pool.clients[2].conn_cb(True)
+    assert states == [False, True]
+    assert pool.clients[2].subs == {b'a'}
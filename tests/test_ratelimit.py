@@ -0,0 +1,56 @@
+from mqttsn_ratelimit import MQTTSNTokenBucket
+import mqttsn_ratelimit
+import pytest
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(mqttsn_ratelimit.time, 'time', lambda: now[0])
+    return now
+
+
+def test_take_and_refill(clock):
+    bucket = MQTTSNTokenBucket(10, 5)
+    assert all(bucket.take() for _ in range(5))
+    assert not bucket.take()
+    assert bucket.wait_time() == pytest.approx(0.1)
+
+    clock[0] += 0.1
+    assert bucket.take()
+    assert not bucket.take()
+
+    # never fills past a burst
+    clock[0] += 100
+    assert bucket.wait_time(5) == 0
+    assert bucket.take(5)
+    assert not bucket.take()
+
+
+def test_bigger_than_a_burst(clock):
+    bucket = MQTTSNTokenBucket(10, 5)
+    assert bucket.take(8)
+    assert bucket.wait_time() == pytest.approx(0.4)
+
+
+def test_defer_spreads_retries(clock):
+    bucket = MQTTSNTokenBucket(10)
+    while bucket.take():
+        pass
+
+    # each one turned away gets the next slot at our rate
+    waits = [bucket.defer() for _ in range(4)]
+    assert waits == pytest.approx([0.2, 0.3, 0.4, 0.5])
+
+    # time moves on, so the waits shrink, but the slots don't move
+    clock[0] += 0.25
+    assert bucket.defer() == pytest.approx(0.35)
+
+
+def test_defer_catches_up(clock):
+    bucket = MQTTSNTokenBucket(10)
+    assert bucket.defer() == pytest.approx(0.1)
+
+    # once those slots have gone by, it starts over from the bucket
+    clock[0] += 10
+    assert bucket.defer() == pytest.approx(0.1)
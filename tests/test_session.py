@@ -0,0 +1,101 @@
+from mqttsn_client import *
+from mqttsn_gateway import MQTTSNGateway
+import pytest
+
+GW_ADDR = b'\x01'
+CLIENT_ADDR = b'\x02'
+
+
+def make(net, session_expiry=60):
+    gw = MQTTSNGateway(1, None, net.transport(GW_ADDR), advertise_interval=0, session_expiry=session_expiry)
+    client = MQTTSNClient(b'c1', net.transport(CLIENT_ADDR))
+    client.add_gateways([MQTTSNGWInfo(1, GW_ADDR)])
+    return gw, client
+
+
+def run(gw, client):
+    for _ in range(3):
+        gw.loop()
+        client.loop()
+
+
+# connected, with a topic registered and one subscribed
+@pytest.fixture
+def setup(net):
+    gw, client = make(net)
+    client.connect(1)
+    run(gw, client)
+
+    pubs, subs = [MQTTSNPubTopic(b'p')], [MQTTSNSubTopic(b's')]
+    client.register_topics(pubs)
+    client.subscribe_topics(subs)
+    run(gw, client)
+    assert pubs[0].tid and subs[0].tid
+    return gw, client, pubs[0], subs[0]
+
+
+def reconnect(gw, client, flags=None):
+    client.disconnect()
+    run(gw, client)
+    client.connect(1, flags)
+    run(gw, client)
+    assert client.is_connected()
+
+
+def test_resume(net, setup):
+    gw, client, pub, sub = setup
+    tids = pub.tid, sub.tid
+
+    net.log.clear()
+    reconnect(gw, client)
+    assert client.session_present
+
+    # nothing needs registering or subscribing again
+    assert (pub.tid, sub.tid) == tids
+    assert client.register_topics(client.pub_topics)
+    assert client.subscribe_topics(client.sub_topics)
+    assert set(net.sent_to(GW_ADDR)) == {DISCONNECT, CONNECT}
+
+    # and the IDs still work both ways
+    got = []
+    client.on_message(lambda topic, data, flags: got.append((topic, data)))
+    gw._handle_mqtt_publish(b's', b'hi', MQTTSNFlags())
+    client.publish(b'p', b'x')
+    run(gw, client)
+    assert got == [(b's', b'hi')]
+    assert PUBACK not in net.sent_to(CLIENT_ADDR)
+
+
+def test_clean_session(setup):
+    gw, client, pub, sub = setup
+    flags = MQTTSNFlags()
+    flags.clean_session = 1
+    reconnect(gw, client, flags)
+
+    # a fresh start on both ends
+    assert not client.session_present
+    assert (pub.tid, sub.tid) == (0, 0)
+    assert not any(mapping.subbed for mapping in gw.mappings)
+
+    assert not client.register_topics(client.pub_topics)
+    assert not client.subscribe_topics(client.sub_topics)
+    run(gw, client)
+    assert pub.tid and sub.tid
+
+
+def test_no_session_kept(net):
+    gw, client = make(net, session_expiry=0)
+    client.connect(1)
+    run(gw, client)
+    pub = MQTTSNPubTopic(b'p')
+    client.register(pub)
+    run(gw, client)
+    assert pub.tid
+
+    # the gateway forgot us, so the ID it gave us before isn't used
+    reconnect(gw, client)
+    assert not client.session_present
+    assert pub.tid == 0
+    net.log.clear()
+    client.register(pub)
+    assert REGISTER in net.sent_to(GW_ADDR)
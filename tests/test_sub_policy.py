@@ -0,0 +1,32 @@
+from mqttsn_gateway import MQTTSNSubPolicy, topic_matches
+import pytest
+
+
+@pytest.mark.parametrize('topic_filter, name, matches', [
+    (b'a/b', b'a/b', True),
+    (b'a/b', b'a/c', False),
+    (b'a/b', b'a', False),
+    (b'a', b'a/b', False),
+    (b'a/+', b'a/b', True),
+    (b'a/+', b'a/b/c', False),
+    (b'+/b', b'a/b', True),
+    (b'+', b'a/b', False),
+    (b'+/+', b'/b', True),
+    (b'a/#', b'a/b/c', True),
+    (b'a/#', b'a', True),
+    (b'a/#', b'b/c', False),
+    (b'a/+/#', b'a/b/c/d', True),
+    (b'#', b'a/b', True),
+])
+def test_topic_matches(topic_filter, name, matches):
+    assert topic_matches(topic_filter, name) == matches
+
+
+def test_policy_client_id():
+    policy = MQTTSNSubPolicy(b'sensors/#', client_id=b'node1', min_interval=5)
+    assert policy.matches(b'node1', b'sensors/temp')
+    assert not policy.matches(b'node2', b'sensors/temp')
+    assert not policy.matches(b'node1', b'actuators/led')
+
+    # no client ID goes for everyone
+    assert MQTTSNSubPolicy(b'sensors/#').matches(b'node2', b'sensors/temp')
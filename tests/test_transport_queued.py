@@ -0,0 +1,127 @@
+from mqttsn_transport import MQTTSNTransport
+from mqttsn_transport_queued import MQTTSNTransportQueued
+from mqttsn_defines import *
+import mqttsn_ratelimit
+import pytest
+
+CONTROL, DATA = MQTTSN_PRIORITY_CONTROL, MQTTSN_PRIORITY_DATA
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(mqttsn_ratelimit.time, 'time', lambda: now[0])
+    return now
+
+
+# notes what it sends, and can be made to back up
+class RecordingTransport(MQTTSNTransport):
+    def __init__(self):
+        self.sent = []
+        self.blocked = False
+
+    def read_packet(self):
+        return b'', None
+
+    def write_packet(self, data, dest):
+        if self.blocked:
+            return 0
+        self.sent.append((dest, data))
+        return len(data)
+
+    def broadcast(self, data):
+        return self.write_packet(data, None)
+
+    def writable(self):
+        return not self.blocked
+
+
+def test_control_goes_first(clock):
+    inner = RecordingTransport()
+    queued = MQTTSNTransportQueued(inner)
+
+    inner.blocked = True
+    for i in range(3):
+        queued.write_packet(b'a%d' % i, b'A', DATA)
+    queued.write_packet(b'b0', b'B', DATA)
+    queued.write_packet(b'ping', b'B', CONTROL)
+    queued.broadcast(b'adv')
+    assert not inner.sent and queued.pending()
+
+    # control msgs for anyone go ahead of data, and then everyone takes turns
+    inner.blocked = False
+    assert queued.flush()
+    assert [data for _, data in inner.sent] == [b'ping', b'adv', b'a0', b'b0', b'a1', b'a2']
+
+
+def test_kept_while_backed_up(clock):
+    inner = RecordingTransport()
+    queued = MQTTSNTransportQueued(inner)
+    queued.write_packet(b'a0', b'A', DATA)
+
+    # turned away, so it stays queued rather than getting lost
+    inner.blocked = True
+    queued.write_packet(b'a1', b'A', DATA)
+    assert not queued.flush()
+    assert queued.backed_up()
+    assert queued.next_deadline() is None
+
+    inner.blocked = False
+    assert queued.flush()
+    assert [data for _, data in inner.sent] == [b'a0', b'a1']
+
+
+def test_shed_oldest(clock):
+    inner = RecordingTransport()
+    queued = MQTTSNTransportQueued(inner, max_data=2)
+
+    inner.blocked = True
+    for i in range(4):
+        queued.write_packet(b'a%d' % i, b'A', DATA)
+    assert queued.shed == 2
+
+    inner.blocked = False
+    queued.flush()
+    assert [data for _, data in inner.sent] == [b'a2', b'a3']
+
+
+def test_dest_rate(clock):
+    inner = RecordingTransport()
+    queued = MQTTSNTransportQueued(inner, dest_rate=100, dest_burst=20)
+
+    # each destination gets its own burst, then has to wait for its rate
+    for dest in (b'A', b'B'):
+        for i in range(5):
+            queued.write_packet(b'%s%d........' % (dest, i), dest, DATA)
+    queued.flush()
+    assert [data[:2] for _, data in inner.sent] == [b'A0', b'A1', b'B0', b'B1']
+    assert queued.next_deadline() == pytest.approx(clock[0] + 0.1)
+
+    # a control msg still has to wait its turn at the rate, but goes ahead of what's queued
+    queued.write_packet(b'ping......', b'A', CONTROL)
+    queued.flush()
+    assert len(inner.sent) == 4
+
+    for _ in range(3):
+        clock[0] += 0.1
+        queued.flush()
+    assert [data[:2] for _, data in inner.sent[4:]] == [b'pi', b'B2', b'A2', b'B3', b'A3', b'B4']
+
+    # never more than the burst, plus the rate, for each over the whole time
+    for dest in (b'A', b'B'):
+        sent = sum(len(data) for to, data in inner.sent if to == dest)
+        assert sent <= 20 + 100 * 0.3
+
+
+def test_rate(clock):
+    inner = RecordingTransport()
+    queued = MQTTSNTransportQueued(inner, rate=100, burst=20)
+
+    for dest in (b'A', b'B', b'C'):
+        queued.write_packet(b'%s.........' % dest, dest, DATA)
+    queued.flush()
+    assert len(inner.sent) == 2
+
+    clock[0] += 0.1
+    queued.flush()
+    assert [to for to, _ in inner.sent] == [b'A', b'B', b'C']
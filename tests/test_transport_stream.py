@@ -0,0 +1,78 @@
+from mqttsn_transport_stream import MQTTSNTransportStream
+import socket
+import struct
+import pytest
+
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    ends = MQTTSNTransportStream(a), MQTTSNTransportStream(b)
+    yield ends
+    for end in ends:
+        end.sock.close()
+
+
+def frame(addr, data):
+    return struct.pack('>H', len(addr) + len(data)) + addr + data
+
+
+def test_round_trip(pair):
+    a, b = pair
+    a.write_packet(b'\x03\x16', b'\x00\x07')
+    a.broadcast(b'\x02\x01')
+    assert a.flush()
+
+    assert b.read_packet() == (b'\x03\x16', b'\x00\x07')
+    assert b.read_packet() == (b'\x02\x01', b'\xff\xff')
+    assert b.read_packet() == (b'', None)
+
+
+def test_short_dest_is_padded(pair):
+    a, b = pair
+    a.write_packet(b'\x03\x16', b'\x07')
+    a.flush()
+    assert b.read_packet() == (b'\x03\x16', b'\x00\x07')
+
+
+def test_partial_frames(pair):
+    a, b = pair
+    raw = frame(b'\x00\x01', b'\x04\x0c\x00') + frame(b'\x00\x02', b'\x02\x16')
+
+    # a byte at a time, nothing comes out till a frame is whole
+    for i, byte in enumerate(raw):
+        a.sock.send(bytes([byte]))
+        pkt, addr = b.read_packet()
+        if i == 6:
+            assert (pkt, addr) == (b'\x04\x0c\x00', b'\x00\x01')
+        elif i == len(raw) - 1:
+            assert (pkt, addr) == (b'\x02\x16', b'\x00\x02')
+        else:
+            assert pkt == b''
+
+
+def test_frames_without_data_are_skipped(pair):
+    a, b = pair
+    a.sock.send(frame(b'\x00\x01', b'') + frame(b'\x00\x02', b'\x02\x16'))
+    assert b.read_packet() == (b'\x02\x16', b'\x00\x02')
+
+
+def test_eof(pair):
+    a, b = pair
+    a.write_packet(b'\x02\x16', b'\x00\x01')
+    a.flush()
+
+    # a half frame, then the other end goes away
+    a.sock.send(frame(b'\x00\x02', b'\x02\x16')[:3])
+    a.sock.close()
+
+    assert b.filenos() == [b.fd]
+    assert b.read_packet() == (b'\x02\x16', b'\x00\x01')
+    assert b.read_packet() == (b'', None)
+    assert b.closed
+
+    # nothing left to wait on, or to write to
+    assert b.filenos() == []
+    assert not b.writable()
+    b.write_packet(b'\x02\x16', b'\x00\x01')
+    assert not b.flush()